@@ -3,10 +3,6 @@
 # vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
 # Author: "Chris Ward" <cward@redhat.com>
 
-# FIXME: add to *Container a 'sync' command which will export
-# across the network all data, persist to some other container
-# and enable future 'delta' syncs.
-
 '''
 metrique.core_api
 ~~~~~~~~~~~~~~~~~
@@ -36,7 +32,6 @@ remote storage of MetriqueObjects, which also comes equipped with:
 Things to improve going forward:
 
  * Performance. Will look into Cython for next release.
- * support local querying using MPL parser
 
 '''
 
@@ -45,29 +40,66 @@ from __future__ import unicode_literals, absolute_import
 import logging
 logger = logging.getLogger('metrique')
 
+import atexit
+from bisect import bisect_right
 from collections import Mapping, MutableMapping
+from contextlib import contextmanager
 from copy import copy
+import cPickle
 from datetime import datetime, date
+from functools import partial
 from inspect import isclass
-from itertools import groupby
+from itertools import groupby, imap, izip
+from multiprocessing import Pool
 import os
 from operator import add
+from Queue import Queue
+
+try:
+    import numpy as np
+    HAS_NUMPY = True
+except ImportError:
+    HAS_NUMPY = False
+    logger.warn('numpy module is not installed!')
+
+try:
+    import pandas as pd
+    try:
+        from pandas.api.types import infer_dtype
+    except ImportError:
+        from pandas.lib import infer_dtype
+    HAS_PANDAS = True
+except ImportError:
+    HAS_PANDAS = False
+    logger.warn('pandas module is not installed!')
+
 import re
+import sys
+from threading import Thread
 from time import time
 from types import NoneType
 import warnings
+from weakref import WeakValueDictionary
 
 from metrique._version import __version__
-from metrique.utils import utcnow, jsonhash, load, autoschema
-from metrique.utils import dt2ts, configure, to_encoding
-from metrique.utils import is_null, is_array, is_defined
-from metrique.result import Result
+from metrique.utils import utcnow, jsonhash, jsonhasher, load, autoschema
+from metrique.utils import dt2ts, configure, to_encoding, batch_gen
+from metrique.utils import is_null, is_array, is_defined, is_true
+from metrique.utils import sample_objects
+from metrique.parse import parse_fields, parse_local
+from metrique.result import Result, epoch2datetime64
+from metrique.store import get_store, InternPool, KeyTable, RecordView
+from metrique.store import SortedKeys
 
 ETC_DIR = os.environ.get('METRIQUE_ETC')
 CACHE_DIR = os.environ.get('METRIQUE_CACHE') or '/tmp'
 DEFAULT_CONFIG = os.path.join(ETC_DIR, 'metrique.json')
 HASH_EXCLUDE_KEYS = ('_hash', '_id', '_start', '_end', '__v__', 'id')
 IMMUTABLE_OBJ_KEYS = set(['_oid', '_hash', '_id', 'id'])
+# column value types which are safe to factorize (hash) without
+# mixing up equal values of different types (eg, 1 == 1.0 == True)
+FACTORIZE_DTYPES = ('string', 'unicode', 'bytes', 'integer', 'floating',
+                    'boolean', 'datetime', 'datetime64', 'date')
 
 
 def gen_id(_oid, _start, _end=None):
@@ -83,7 +115,8 @@ def gen_id(_oid, _start, _end=None):
 
 
 def metrique_object(_oid, _id=None, _hash=None, _start=None, _end=None,
-                    _e=None, _v=None, id=None, __v__=None, **kwargs):
+                    _e=None, _v=None, id=None, __v__=None, _hasher=None,
+                    **kwargs):
     '''
     Function which takes a dictionary (Mapping) object as input
     and returns return back a metrique object.
@@ -93,6 +126,9 @@ def metrique_object(_oid, _id=None, _hash=None, _start=None, _end=None,
         _start: ...
         ...
         FIXME
+
+    _hasher, if set, is the function used to generate the object's _hash
+    (see utils.jsonhasher); default is utils.jsonhash.
     '''
     # NOTE: we completely ignore incoming 'id' keys!
     # id is RESERVED and ALWAYS expected to be 'autoincrement'
@@ -121,7 +157,7 @@ def metrique_object(_oid, _id=None, _hash=None, _start=None, _end=None,
     # generate unique, consistent object _hash based on 'frozen' obj contents
     # FIXME: make _hash == None valid
     #kwargs['_hash'] = jsonhash(kwargs) if _hash else None
-    kwargs['_hash'] = jsonhash(kwargs)
+    kwargs['_hash'] = _hasher(kwargs) if _hasher else jsonhash(kwargs)
 
     # add some additional non-hashable meta data
     kwargs['_start'] = _start
@@ -131,6 +167,85 @@ def metrique_object(_oid, _id=None, _hash=None, _start=None, _end=None,
     return kwargs
 
 
+def _index_key(value):
+    ''' make the given value hashable, for use as an index key '''
+    if isinstance(value, list):
+        return tuple(_index_key(v) for v in value)
+    elif isinstance(value, Mapping):
+        return tuple(sorted((k, _index_key(v)) for k, v in value.iteritems()))
+    else:
+        return value
+
+
+def _schema_fingerprint(value):
+    '''
+    Picklable, comparable form of a schema (eg, to send from worker
+    processes); types and functions are replaced with their names.
+    '''
+    if isinstance(value, Mapping):
+        return tuple(sorted((k, _schema_fingerprint(v))
+                            for k, v in value.iteritems()))
+    elif isinstance(value, (list, tuple)):
+        return tuple(_schema_fingerprint(v) for v in value)
+    elif isclass(value) or callable(value):
+        return '%s.%s' % (getattr(value, '__module__', None),
+                          getattr(value, '__name__', repr(value)))
+    else:
+        return value
+
+
+def _sizeof(obj):
+    ''' approximate size (bytes) of an object and its (top level) values '''
+    size = sys.getsizeof(obj)
+    if isinstance(obj, RecordView):
+        # compact records hold their values in a (backing) tuple
+        size += sys.getsizeof(obj._values)
+    return size + sum(imap(sys.getsizeof, obj.itervalues()))
+
+
+# container to prep objects with in extend() worker processes;
+# set in each worker (inherited through fork) by _extend_worker_init
+_extend_container = None
+
+
+def _extend_worker_init(container):
+    global _extend_container
+    _extend_container = container
+
+
+def _extend_worker_prep(objs):
+    '''
+    prep objs in a worker; returns the objects prepared before the first
+    which failed, if any, and the error (the traceback isn't picklable)
+    '''
+    objects, error = _extend_container._prep_objects_prefix(objs)
+    return objects, error[1] if error else None
+
+
+# containers with a running autoflush writer; joined at exit, so
+# batches still queued aren't lost if flush() is never called
+_autoflush_containers = WeakValueDictionary()
+
+
+@atexit.register
+def _autoflush_atexit():
+    for container in _autoflush_containers.values():
+        try:
+            container._autoflush_join()
+        except Exception as e:
+            logger.error('autoflush failed at exit: %s' % e)
+
+
+def batch_variant(func):
+    '''
+    Mark a schema variant function as batch (vectorized); it's called
+    once per batch of objects with the list of the field's values (and
+    the container's store) and returns the list of variant values.
+    '''
+    func.batch = True
+    return func
+
+
 # FIXME: all objects should have the SAME keys;
 # if an object is added with fewer keys, it should
 # have the missing keys added with null values
@@ -150,6 +265,36 @@ class MetriqueContainer(MutableMapping):
     :param cache_dir: overide of default cache path
     :param autotable: bool to automatically issue 'create' command to
                         storage proxy, if set
+    :param workers: default number of processes extend() preps objs with
+    :param autoflush: flush _oid groups with a current (_end: None)
+                      version in the background, once the store holds
+                      this many objects
+    :param autoflush_bytes: same as autoflush, but for the (approximate)
+                            size in bytes of all objects in the store
+    :param autoflush_queue: max number of autoflush batches to queue up
+    :param store: object store to use; 'dict' (default), 'sqlite' (spills
+                  objects to disk) or a MutableMapping class
+    :param store_hot_size: max number of objects the 'sqlite' store
+                           keeps in memory
+    :param compact: store objects as compact, read-only records (views)
+                    rather than dicts
+    :param local_indexes: fields to maintain local (hash) indexes for,
+                          which speed up filter()
+    :param dedup: skip (current value) objects which are unchanged since
+                  they were last flushed, before preparing them
+    :param hash_digest: digest used to generate object _hash (eg, blake2b)
+    :param hash_compat: generate _hash compatible with metrique <= 0.3.2
+    :param coalesce: on flush, merge adjacent versions of an _oid with the
+                     same _hash into a single version
+    :param intern: intern the values of string fields, while the number
+                   of unique values of the field is low; so equal values
+                   share a single object
+    :param intern_max: max number of unique values of a field to intern
+    :param autoschema_sample: number of objects (the first n, plus n
+                              at random) to generate the schema from,
+                              if there's none yet, when extending
+    :param stats: count objects and time spent per ingest stage (see
+                  stats()) and log them after each extend() and flush()
 
     Additional kwargs are accepted, but ignored.
 
@@ -213,8 +358,11 @@ class MetriqueContainer(MutableMapping):
         is_old = {'type': bool},
         )
 
+    Variant functions decorated with @batch_variant are called once per
+    batch of objects, with the list of values, instead of once per value.
+
     If no schema is pre-defined, a schema will be automatically
-    generated based on the first object added!
+    generated based on a sample of the objects added!
 
     Example container config file (~/.metrique/metrique.json)::
     {
@@ -229,17 +377,43 @@ class MetriqueContainer(MutableMapping):
             }
         }
     '''
+    _autoflush_error = None
+    _autoflush_ids = None
+    _autoflush_oids = None
+    _autoflush_queue = None
+    _autoflush_thread = None
+    _coalesce_hasher = None
+    _dedup_cache = None
+    _dedup_changed = False
+    _dedup_hasher = None
+    _dedup_pending = None
+    _field_counts = None
+    _fields_sorted = None
+    _indexes = None
+    _intern_pools = None
     _key_map = None
+    _key_table = None
     _object_cls = None
+    _oid_current = None
+    _oid_historic = None
+    _oid_index = None
+    _oids_sorted = None
+    _preps = None
+    _preps_schema = None
+    _sorted_ids = None
+    _stats = None
+    _temporal = None
     _proxy_cls = None
     _proxy = None
     config = None
     config_file = DEFAULT_CONFIG
     config_key = 'container'
     db = None
+    dedup_skipped = 0
     name = None
     proxy_config_key = 'proxy'
     store = None
+    store_bytes = 0
     version = 0
     HASH_EXCLUDE_KEYS = tuple(HASH_EXCLUDE_KEYS)
     RESTRICTED_KEYS = ('id', '_id', '_hash', '_start', '_end',
@@ -247,23 +421,62 @@ class MetriqueContainer(MutableMapping):
     FIELDS_RE = re.compile('[\W]+')
     SPACE_RE = re.compile('\s+')
     UNDA_RE = re.compile('_+')
+    # min number of sample values to generate the schema in parallel
+    AUTOSCHEMA_PARALLEL_MIN = 100000
 
     def __init__(self, name=None, db=None, schema=None, version=None,
                  objects=None, proxy=None, proxy_config=None,
                  batch_size=None, config=None, config_file=None,
                  config_key=None, cache_dir=None, autotable=None,
+                 hash_digest=None, hash_compat=None, workers=None,
+                 autoflush=None, autoflush_bytes=None, autoflush_queue=None,
+                 store=None, store_hot_size=None, compact=None,
+                 local_indexes=None, dedup=None, coalesce=None, intern=None,
+                 intern_max=None, autoschema_sample=None, stats=None,
                  **kwargs):
         # null name -> anonymous table; no native ability to persist
         options = dict(autotable=autotable,
                        cache_dir=cache_dir,
                        batch_size=batch_size,
+                       hash_digest=hash_digest,
+                       hash_compat=hash_compat,
+                       workers=workers,
+                       autoflush=autoflush,
+                       autoflush_bytes=autoflush_bytes,
+                       autoflush_queue=autoflush_queue,
+                       store=store,
+                       store_hot_size=store_hot_size,
+                       compact=compact,
+                       local_indexes=local_indexes,
+                       dedup=dedup,
+                       coalesce=coalesce,
+                       intern=intern,
+                       intern_max=intern_max,
+                       autoschema_sample=autoschema_sample,
+                       stats=stats,
                        name=None,
                        schema=schema,
                        version=int(version or 0))
 
         defaults = dict(autotable=True,
                         cache_dir=CACHE_DIR,
-                        batch_size=999,
+                        batch_size=50000,
+                        hash_digest='sha1',
+                        hash_compat=True,
+                        workers=1,
+                        autoflush=None,
+                        autoflush_bytes=None,
+                        autoflush_queue=2,
+                        store=None,
+                        store_hot_size=None,
+                        compact=False,
+                        local_indexes=None,
+                        dedup=False,
+                        coalesce=False,
+                        intern=True,
+                        intern_max=10000,
+                        autoschema_sample=100,
+                        stats=False,
                         name=name,
                         schema={},
                         version=0)
@@ -290,16 +503,34 @@ class MetriqueContainer(MutableMapping):
         proxy_config.setdefault('config_file', self.config_file)
         self.config.setdefault(self.proxy_config_key, {}).update(proxy_config)
 
+        self._stats = {}
         if self._object_cls is None:
             self._object_cls = metrique_object
+        digest = self.config.get('hash_digest')
+        compat = self.config.get('hash_compat')
+        if self._object_cls is metrique_object:
+            hasher = None
+            if not (digest == 'sha1' and compat):
+                # changing the hash changes the _hash of ALL objects; on
+                # next autosnap all objects will appear to have been
+                # updated!
+                hasher = jsonhasher(digest=digest, compat=compat)
+            if self.config.get('stats'):
+                hasher = self._stats_wrap('hash', hasher or jsonhash)
+            if hasher:
+                self._object_cls = partial(metrique_object, _hasher=hasher)
 
         if self._proxy_cls is None:
             from metrique.sqlalchemy import SQLAlchemyProxy
             self._proxy_cls = SQLAlchemyProxy
         self._proxy = proxy
+        self._key_map = {}
+        self._intern_pools = {}
+        self._autoflush_ids = []
+        self._autoflush_oids = set()
 
         # init and update internal store with passed in objects, if any
-        self.store = copy(MetriqueContainer.store or {})
+        self._store_init()
         self._update(objects)
 
     def __getitem__(self, key):
@@ -308,11 +539,11 @@ class MetriqueContainer(MutableMapping):
         _id index values.
         '''
         if isinstance(key, slice):
-            keys = sorted(self.store.keys())[key]
-            return [dict(self.store[i]) for i in keys]
+            keys = self._sorted_ids[key]
+            return [self._view(self.store[i]) for i in keys]
         else:
             key = to_encoding(key)
-            return dict(self.store[key])
+            return self._view(self.store[key])
 
     def __setitem__(self, key, value):
         '''
@@ -322,41 +553,255 @@ class MetriqueContainer(MutableMapping):
         self.add(value)
 
     def __delitem__(self, key):
-        key = to_encoding(key)
-        del self.store[key]
+        self.pop(key)
 
     def __iter__(self):
-        return iter(self.store)
+        # iterate in _id order
+        return iter(self._sorted_ids)
 
     def __len__(self):
         return len(self.store)
 
     def __contains__(self, key):
         key = to_encoding(key)
-        return key in self.store.keys()
+        return key in self.store
 
     def __repr__(self):
         return repr(self.store)
 
-    def _add_variants(self, key, value, schema):
-        ''' also possible to define some function that takes
-            current value and creates a new value from it
+    def _add_variants(self, objs, batch=None):
+        '''
+        Add the variant fields defined in the schema to the given
+        (prepared) objects; ie, fields with values derived from the
+        value of another field by some function.
+
+        Functions are called with each value and the store; or, if
+        marked as batch_variant, once with the list of all values.
+
+        :param batch: if True (False), only add batch (per value) variants
         '''
-        variants = schema.get('variants')
-        obj = {}
-        if variants:
+        if not objs:
+            return
+        store = self.store
+        for key, (prep, variants) in self._preps.iteritems():
+            if not variants:
+                continue
+            _objs = [o for o in objs if key in o]
+            if not _objs:
+                continue
+            values = [o[key] for o in _objs]
             for _key, func in variants.iteritems():
-                _value = func(value, self.store)
-                obj.update({_key: _value})
+                is_batch = getattr(func, 'batch', False)
+                if batch is not None and is_batch != batch:
+                    continue
+                if is_batch:
+                    _values = func(values, store)
+                else:
+                    _values = [func(value, store) for value in values]
+                for obj, value in izip(_objs, _values):
+                    obj[_key] = value
+
+    def _store_set(self, obj):
+        ''' store the (prepped) object, indexed by _id '''
+        if self.config.get('compact'):
+            obj = self._key_table.record(obj)
+        _id = obj['_id']
+        store = self.store
+        if _id in store:
+            self._index_remove(store[_id])
+        store[_id] = obj
+        self._index_add(obj)
+
+    def _store_pop(self, _id):
+        ''' remove and return the object with the given _id '''
+        obj = self.store.pop(_id)
+        self._index_remove(obj)
         return obj
 
+    def _index_add(self, obj):
+        _id, _oid = obj['_id'], obj['_oid']
+        ids = self._oid_index.get(_oid)
+        if ids is None:
+            ids = self._oid_index[_oid] = set()
+            self._oids_sorted = None
+        ids.add(_id)
+        self._sorted_ids.add(_id)
+        self._temporal.pop(_oid, None)
+        versions = self._oid_current if obj['_end'] is None \
+            else self._oid_historic
+        versions[_oid] = versions.get(_oid, 0) + 1
+        counts = self._field_counts
+        for k in obj:
+            if k in counts:
+                counts[k] += 1
+            else:
+                counts[k] = 1
+                self._fields_sorted = None
+        for field, index in self._indexes.iteritems():
+            if field in obj:
+                value = _index_key(obj[field])
+                index.setdefault(value, set()).add(_id)
+
+    def _index_remove(self, obj):
+        _id, _oid = obj['_id'], obj['_oid']
+        ids = self._oid_index[_oid]
+        ids.discard(_id)
+        if not ids:
+            del self._oid_index[_oid]
+            self._oids_sorted = None
+        self._sorted_ids.remove(_id)
+        self._temporal.pop(_oid, None)
+        versions = self._oid_current if obj['_end'] is None \
+            else self._oid_historic
+        versions[_oid] -= 1
+        if not versions[_oid]:
+            del versions[_oid]
+        counts = self._field_counts
+        for k in obj:
+            counts[k] -= 1
+            if not counts[k]:
+                del counts[k]
+                self._fields_sorted = None
+        for field, index in self._indexes.iteritems():
+            if field in obj:
+                value = _index_key(obj[field])
+                ids = index[value]
+                ids.discard(_id)
+                if not ids:
+                    del index[value]
+
+    @staticmethod
+    def _view(obj):
+        '''
+        objects are handed out as copies; compact records are read-only
+        already, so they're handed out as-is
+        '''
+        return obj if isinstance(obj, RecordView) else dict(obj)
+
+    def _query_local(self, query=None, date=None):
+        '''
+        Return the (stored) objects matching the given MQL query and
+        date range. Indexes are used to find candidate objects for
+        top level `field == value` (or `field in [...]`) terms.
+        '''
+        pred, equalities = parse_local(query=query, date=date)
+        store = self.store
+        candidates = []
+        for field, values in equalities:
+            if field == '_id':
+                ids = {to_encoding(v) for v in values}
+                ids = {_id for _id in ids if _id in store}
+            elif field == '_oid':
+                ids = set().union(*[self._oid_index.get(v, ())
+                                    for v in values])
+            elif None in values:
+                # objects missing the field match None too; they
+                # aren't indexed, so check these with the predicate
+                continue
+            elif field in self._indexes and not (
+                    self.schema.get(field) or {}).get('container'):
+                index = self._indexes[field]
+                ids = set().union(*[index.get(_index_key(v), ())
+                                    for v in values])
+            else:
+                continue
+            candidates.append(ids)
+        if candidates:
+            candidates.sort(key=len)
+            _ids = candidates[0].intersection(*candidates[1:])
+            objects = (store[_id] for _id in _ids)
+        else:
+            objects = store.itervalues()
+        return [o for o in objects if pred(o)]
+
+    def _find_local(self, query=None, fields=None, date=None, sort=None,
+                    descending=False, one=False, raw=False, limit=None,
+                    as_cursor=False, scalar=False, default_fields=True):
+        objects = self._query_local(query=query, date=date)
+        limit = limit if limit and limit >= 1 else 0
+        if sort:
+            sort = parse_fields(fields=sort)[0]
+            objects.sort(key=lambda o: o.get(sort), reverse=descending)
+        if limit:
+            objects = objects[:limit]
+        fields = parse_fields(fields)
+        if fields and default_fields:
+            fields += [f for f in ('_start', '_end', '_oid')
+                       if f not in fields]
+        if fields:
+            rows = [{f: o.get(f) for f in fields} for o in objects]
+        else:
+            rows = [dict(o) for o in objects]
+        if scalar:
+            # first field of the first row
+            row = rows[0] if rows else {}
+            return row.get(fields[0]) if fields else None
+        elif as_cursor:
+            return iter(rows)
+        elif one or limit == 1:
+            return rows[0] if rows else {}
+        elif raw:
+            return rows
+        else:
+            return Result(rows, date)
+
+    def _store_init(self):
+        self.store = get_store(self.config.get('store'),
+                               cache_dir=self.config.get('cache_dir'),
+                               hot_size=self.config.get('store_hot_size'))
+        self.store_bytes = 0
+        # all compact records share the same key table; schema fields
+        # first (sorted), then other keys in the order they're seen
+        self._key_table = KeyTable(sorted(self.schema or []))
+        self._oid_index = {}
+        # number of current/historical versions per _oid; _oids with a
+        # current version are the complete groups autoflush hands off
+        self._oid_current = {}
+        self._oid_historic = {}
+        self._oids_sorted = None
+        self._sorted_ids = SortedKeys()
+        self._field_counts = {}
+        self._fields_sorted = None
+        self._indexes = {}
+        self._temporal = {}
+        for field in self.config.get('local_indexes') or []:
+            self.local_index(field)
+
     @property
     def _ids(self):
-        return sorted(self.store.keys())
+        return list(self._sorted_ids)
+
+    def _temporal_index(self, _oid):
+        '''
+        Get the _start dates and _ids of all versions of the given
+        _oid, sorted by _start; built on first use and cached until
+        the _oid's versions change.
+        '''
+        index = self._temporal.get(_oid)
+        if index is None:
+            store = self.store
+            versions = sorted((store[_id]['_start'], _id)
+                              for _id in self._oid_index.get(_oid, ()))
+            index = ([v[0] for v in versions], [v[1] for v in versions])
+            if versions:
+                self._temporal[_oid] = index
+        return index
+
+    def _as_of(self, _oid, ts):
+        starts, ids = self._temporal_index(_oid)
+        i = bisect_right(starts, ts)
+        if i:
+            obj = self.store[ids[i - 1]]
+            _end = obj['_end']
+            if _end is None or _end > ts:
+                return obj
+        return None
 
     @property
     def _oids(self):
-        return sorted({o['_oid'] for o in self.store.itervalues()})
+        if self._oids_sorted is None:
+            self._oids_sorted = sorted(self._oid_index)
+        return list(self._oids_sorted)
 
     def _parse_query(self, query=None, fields=None, date=None,
                      alias=None, distinct=None, limit=None):
@@ -364,18 +809,6 @@ class MetriqueContainer(MutableMapping):
                                        fields=fields, date=date, alias=alias,
                                        distinct=distinct, limit=limit)
 
-    def _normalize_container(self, value, schema):
-        container = bool(schema.get('container'))
-        _is_list = isinstance(value, list)
-        if container and not _is_list:
-            # NORMALIZE to empty list []
-            return list(value) if value else []
-        elif not container and _is_list:
-            raise ValueError(
-                "expected single value, got list (%s)" % value)
-        else:
-            return value
-
     def _unwrap(self, value):
         if type(value) is buffer:
             # unwrap/convert the aggregated string 'buffer'
@@ -419,37 +852,235 @@ class MetriqueContainer(MutableMapping):
         return key
 
     def _normalize_keys(self, obj):
-        return {self._normalize_key(k): v for k, v in obj.iteritems()}
+        # optimization; normalizing keys is regex heavy, so cache a key
+        # map from original key -> normalized key and reuse it
+        kmap = self._key_map
+        _obj = {}
+        for k, v in obj.iteritems():
+            _k = kmap.get(k)
+            if _k is None:
+                _k = kmap[k] = self._normalize_key(k)
+            _obj[_k] = v
+        return _obj
+
+    def _prep_compile(self, schema):
+        '''
+        Compile the given schema into a map of field -> (prep, variants)
+        pairs, where prep runs only the value prep steps (unwrap,
+        normalize_container, convert, typecast, intern) the field
+        actually needs. Unknown fields are mapped under the None key.
+        '''
+        preps = {None: (self._prep_compile_value({}), None)}
+        for key, _schema in schema.iteritems():
+            _schema = _schema or {}
+            _variants = _schema.get('variants') or None
+            preps[key] = (self._prep_compile_value(_schema, key), _variants)
+        logger.debug('prep steps compiled for %s fields' % len(schema))
+        return preps
+
+    def _prep_compile_value(self, schema, key=None):
+        '''
+        compile the prep steps of a (key's) schema into a function
+        which prepares a single value
+        '''
+        steps = [('unwrap', self._unwrap)]
+        container = bool(schema.get('container'))
+        if container:
+            def _normalize(value):
+                if isinstance(value, list):
+                    return value
+                # NORMALIZE to empty list []
+                return list(value) if value else []
+        else:
+            def _normalize(value):
+                if isinstance(value, list):
+                    raise ValueError(
+                        "expected single value, got list (%s)" % value)
+                return value
+        steps.append(('normalize_container', _normalize))
+
+        if schema.get('convert'):
+            steps.append(('convert', partial(self._convert, schema=schema)))
+
+        _typecast = self._prep_compile_typecast(schema.get('type'), container)
+        if _typecast:
+            steps.append(('typecast', _typecast))
+
+        _intern = self._prep_compile_intern(key, schema.get('type'),
+                                            container)
+        if _intern is not None:
+            steps.append(('intern', _intern))
+
+        if self.config.get('stats'):
+            # per value timers; only compiled in with stats on
+            steps = [self._stats_wrap(k, f) for k, f in steps]
+        else:
+            steps = [f for k, f in steps]
+
+        def prep(value):
+            for step in steps:
+                value = step(value)
+            return value
+        return prep
+
+    def _prep_compile_intern(self, key, _type, container=False):
+        ''' intern step for a string field; if not disabled already '''
+        if not (key and self.config.get('intern')):
+            return None
+        elif _type not in (unicode, str):
+            return None
+        pool = self._intern_pools.get(key)
+        if pool is None:
+            # recompile the prep steps, without this one, once disabled
+            pool = InternPool(max_size=self.config.get('intern_max'),
+                              on_disable=self._prep_reset)
+            self._intern_pools[key] = pool
+        if not pool.enabled:
+            return None
+        if not container:
+            return pool
+
+        def multi(value):
+            return [pool(item) for item in value]
+        return multi
+
+    def _prep_reset(self):
+        ''' recompile the prep steps on next use '''
+        self._preps_schema = None
+
+    def _prep_compile_typecast(self, _type, container=False):
+        '''
+        typecast step for a type; None if values aren't converted. Dates
+        are normalized to epochs and strings to unicode; containers
+        (lists) are typecast per item and sorted, null ones to [].
+        '''
+        if _type in (None, NoneType):
+            # don't convert values; default type is the original type
+            single = None
+        elif _type in (datetime, date):
+            def single(value):
+                # normalize all dates to epochs
+                return None if value is None else dt2ts(value)
+        elif _type in (unicode, str):
+            def single(value):
+                if value is None or isinstance(value, _type):
+                    return value
+                # make sure all string types are properly unicoded
+                return to_encoding(value)
+        else:
+            def single(value):
+                if value is None or isinstance(value, _type):
+                    return value
+                try:
+                    return _type(value)
+                except Exception:
+                    value = to_encoding(value)
+                    logger.error("typecast failed: %s(value=%s)" % (
+                        _type.__name__, value))
+                    raise
+
+        if not container:
+            return single
+
+        def multi(value):
+            ' apply type to all values in the list '
+            if value is None:
+                # normalize null containers to empty list
+                return []
+            elif not isinstance(value, list):
+                raise ValueError("expected list type, got: %s" % type(value))
+            elif single is None:
+                return sorted(value)
+            else:
+                return sorted(single(item) for item in value)
+        return multi
 
     def _prep_object(self, obj):
+        return self._prep_objects([obj])[0]
+
+    def _prep_objects(self, objs):
+        '''
+        Prepare a batch of objects; variants are added once all the
+        objects' values are prepared, then the objects are hashed.
+        '''
+        result, error = self._prep_objects_prefix(objs)
+        if error:
+            raise error[0], error[1], error[2]
+        return result
+
+    def _build_objects(self, objs):
+        '''
+        Build (hash) the metrique objects of the given prepared objects.
+
+        Returns the objects built and, if one failed, the exc_info of
+        the failure; objects after the failed one are not built.
+        '''
+        version = self.version
+        _object_cls = self._object_cls
+        result = []
+        with self._stats_timed('object', len(objs)):
+            for obj in objs:
+                obj['_v'] = version
+                try:
+                    result.append(_object_cls(**obj))
+                except Exception:
+                    return result, sys.exc_info()
+        return result, None
+
+    def _value_variants(self):
+        ''' check if the schema defines any per value (non-batch) variants '''
+        for _schema in (self.schema or {}).itervalues():
+            for func in ((_schema or {}).get('variants') or {}).itervalues():
+                if not getattr(func, 'batch', False):
+                    return True
+        return False
+
+    def _prep_values_prefix(self, objs):
+        '''
+        Prepare the values of the given objects, up to the first which
+        fails; returns those prepared and the exc_info of the failure.
+        '''
+        prepped, error = [], None
+        with self._stats_timed('prep', len(objs)):
+            for obj in objs:
+                try:
+                    prepped.append(self._prep_values(obj))
+                except Exception:
+                    error = sys.exc_info()
+                    break
+        return prepped, error
+
+    def _prep_objects_prefix(self, objs):
+        '''
+        Same as _prep_objects, but rather than raising, returns the
+        objects prepared before the first which failed, and the
+        exc_info of the failure (or None).
+        '''
+        prepped, error = self._prep_values_prefix(objs)
+        with self._stats_timed('variants', len(prepped)):
+            self._add_variants(prepped)
+        built, _error = self._build_objects(prepped)
+        return built, _error or error
+
+    def _prep_values(self, obj):
         obj = self._normalize_keys(obj)
-        schema = self.schema
-        if not schema:
-            # build schema off normalized key version
-            _obj = self._normalize_keys(obj)
-            # cache a key map from old key->normalized keys
-            self._key_map = {k: self._normalize_key(k) for k in obj.iterkeys()}
-            # in the case we don't have a schema already defined, we need to
-            # build on now; all objects are assumed to have the SAME SCHEMA!
-            schema = autoschema([_obj], exclude_keys=self.RESTRICTED_KEYS)
-            self.config['schema'] = schema
+        self._prep_schema(obj)
 
         # optimization; lookup in local scope
-        kmap = self._key_map or {}
+        preps = self._preps
+        default = preps[None]
         for key, value in obj.items():
-            # map original key to normalized key, if normal map exists
-            _key = kmap.get(key) or key
-            _schema = schema.get(_key) or {}
+            prep = (preps.get(key) or default)[0]
             try:
-                value = self._prep_value(value, schema=_schema)
+                value = prep(value)
             except Exception as e:
                 # make sure the value contents are loggable
                 _value = to_encoding(value)
                 obj.setdefault('_e', {})
-                msg = 'prep(key=%s, value=%s) failed: %s' % (_key, _value, e)
+                msg = 'prep(key=%s, value=%s) failed: %s' % (key, _value, e)
                 logger.error(msg)
                 # set error field with original values
-                obj['_e'].update({_key: value})
+                obj['_e'].update({key: value})
 
                 # FIXME: should we leave original as-is? if not of correct
                 # type, etc, this might cause problems
@@ -457,87 +1088,461 @@ class MetriqueContainer(MutableMapping):
                 # normalize invalid value to None
                 value = None
             obj[key] = value
-            variants = self._add_variants(_key, value, _schema)
-            obj.update(variants)
-        obj['_v'] = self.version
-        obj = self._object_cls(**obj)
         return obj
 
-    def _prep_value(self, value, schema):
-        # NOTE: if we fail anywhere in here, no changes made here will
-        # be 'saved'; buffer's for example will remain buffers, etc.
-        # PERFORMANCE NOTES
-        # 26 seconds for 450k values, baseline; none of the folling are run
-        value = self._unwrap(value)
-        # +2 seconds (28s)
-        value = self._normalize_container(value, schema)
-        # +12 seconds (40s)
-        value = self._convert(value, schema)
-        # +6 seconds (46s)
-        value = self._typecast(value, schema)
-        # +10 seconds (56s)
-        return value
+    def _prep_column(self, key, series):
+        '''
+        Prep a full column (pandas.Series) of values at once.
+
+        Nulls (None, NaN, NaT) are normalized to None. Dates and numbers
+        in columns of (already) homogenious numpy dtype are typecast
+        vectorized; all other values are prepped once per unique value.
 
-    def _typecast(self, value, schema):
+        Returns back a list of prepped values and a dict of row index ->
+        original value for those values which failed to be prepped.
+        '''
+        prep = (self._preps.get(key) or self._preps[None])[0]
+        schema = self.schema.get(key) or {}
         _type = schema.get('type')
-        container = schema.get('container')
-        if container:
-            value = self._type_container(value, _type)
+        container = bool(schema.get('container'))
+        kind = series.dtype.kind
+        nulls = series.isnull().values
+        values = None
+        if container or schema.get('convert'):
+            # no vectorized equivalent available
+            pass
+        elif _type in (datetime, date) and kind == 'M':
+            if getattr(series.dt, 'tz', None) is None:
+                # same math as dt2ts; keep micros, drop nanos
+                ns = series.values.view('i8')
+                seconds = ns // 10 ** 9
+                micros = (ns // 1000) % 10 ** 6
+                values = ((seconds * 1000.0) + (micros / 1000.0)) / 1000.0
+        elif _type in (datetime, date) and kind in 'iuf':
+            values = series.values.astype('float64')
+            # dt2ts considers 0 to be an empty date
+            nulls = nulls | (values == 0)
+        elif _type is float and kind in 'iufb':
+            values = series.values.astype('float64')
+        elif _type is int and kind in 'iu':
+            values = series.values.astype('int64')
+        elif _type is int and kind == 'f':
+            # int(inf) raises, so let the slow path record the error
+            if np.isfinite(series.values[~nulls]).all():
+                values = series.values.astype('int64')
+
+        if values is None:
+            return self._prep_column_values(key, series, prep, container)
+        values = values.astype(object)
+        values[nulls] = None
+        return values.tolist(), {}
+
+    def _prep_column_values(self, key, series, prep, container=False):
+        ''' prep column values one at a time; unique values only once '''
+        if series.dtype.kind == 'M':
+            # get back Timestamp objects, not datetime64 ints
+            series = series.astype(object)
+        values = series.values
+        nulls = series.isnull().values
+        errors = {}
+
+        def _prep(value):
+            try:
+                return prep(value), False
+            except Exception as e:
+                _value = to_encoding(value)
+                msg = 'prep(key=%s, value=%s) failed: %s' % (key, _value, e)
+                logger.error(msg)
+                return None, True
+
+        # containers must prep null values too (None -> [])
+        factorize = not container
+        if factorize and values.dtype.kind == 'O':
+            _dtype = infer_dtype(values[~nulls]) if (~nulls).any() else None
+            factorize = _dtype is None or _dtype in FACTORIZE_DTYPES
+        if factorize:
+            codes, uniques = pd.factorize(values)
+            prepped = np.empty(len(uniques) + 1, dtype=object)
+            failed = []
+            for i, value in enumerate(uniques):
+                prepped[i], _failed = _prep(value)
+                if _failed:
+                    failed.append(i)
+            # nulls are coded as -1; the last (extra) slot is None
+            prepped[-1] = None
+            result = prepped.take(codes)
+            if failed:
+                for i in np.nonzero(np.in1d(codes, failed))[0]:
+                    errors[int(i)] = values[i]
+            return result.tolist(), errors
         else:
-            value = self._type_single(value, _type)
-        return value
+            result = []
+            for i, value in enumerate(values):
+                if not container and nulls[i]:
+                    value, _failed = None, False
+                else:
+                    value, _failed = _prep(value)
+                if _failed:
+                    errors[i] = values[i]
+                result.append(value)
+            return result, errors
+
+    def _prep_schema(self, obj):
+        '''
+        Make sure we have a schema and that it's compiled; if we don't
+        have a schema, generate one based on the given (normalized) obj.
+        '''
+        schema = self.schema
+        if not schema:
+            # in the case we don't have a schema already defined, we need to
+            # build on now; all objects are assumed to have the SAME SCHEMA!
+            schema = autoschema([obj], exclude_keys=self.RESTRICTED_KEYS)
+            self.config['schema'] = schema
 
-    def _type_container(self, value, _type):
-        ' apply type to all values in the list '
-        if value is None:
-            # normalize null containers to empty list
-            return []
-        elif not isinstance(value, list):
-            raise ValueError("expected list type, got: %s" % type(value))
-        else:
-            return sorted(self._type_single(item, _type) for item in value)
+        # compile the schema once; recompile only if schema is replaced
+        if self._preps_schema is not schema:
+            self._preps = self._prep_compile(schema)
+            self._preps_schema = schema
+        return schema
 
-    def _type_single(self, value, _type):
-        ' apply type to the single value '
-        if value is None or _type in (None, NoneType):
-            # don't convert null values
-            # default type is the original type if none set
-            pass
-        elif isinstance(value, _type):  # or values already of correct type
-            # normalize all dates to epochs
-            value = dt2ts(value) if _type in [datetime, date] else value
-        else:
-            if _type in (datetime, date):
-                # normalize all dates to epochs
-                value = dt2ts(value)
-            elif _type in (unicode, str):
-                # make sure all string types are properly unicoded
-                value = to_encoding(value)
-            else:
-                try:
-                    value = _type(value)
-                except Exception:
-                    value = to_encoding(value)
-                    logger.error("typecast failed: %s(value=%s)" % (
-                        _type.__name__, value))
-                    raise
-        return value
+    def _autoschema(self, objs):
+        '''
+        If we don't have a schema yet, generate one based on a sample of
+        the given (raw) objects, before any of them are prepared.
+        '''
+        if self.schema or not objs:
+            return
+        size = self.config.get('autoschema_sample')
+        objs = [self._normalize_keys(o) for o in sample_objects(objs, size)]
+        workers = self.config.get('workers')
+        if sum(len(o) for o in objs) < self.AUTOSCHEMA_PARALLEL_MIN:
+            workers = 1
+        schema = autoschema(objs, exclude_keys=self.RESTRICTED_KEYS,
+                            workers=workers)
+        self.config['schema'] = dict(schema)
+
+    def _autoschema_df(self, df):
+        '''
+        Same as _autoschema, for a DataFrame; the sampled rows are
+        converted to dicts of python values, with nulls as None.
+        '''
+        if self.schema or not len(df):
+            return
+        size = self.config.get('autoschema_sample')
+        rows = sample_objects(range(len(df)), size)
+        sample = df.iloc[rows]
+        columns = []
+        for key in sample.columns:
+            series = sample[key]
+            nulls = series.isnull().tolist()
+            values = []
+            for value, null in izip(series.astype(object).tolist(), nulls):
+                if null:
+                    value = None
+                elif isinstance(value, pd.Timestamp):
+                    value = value.to_pydatetime()
+                values.append(value)
+            columns.append((key, values))
+        self._autoschema([{key: values[i] for key, values in columns}
+                          for i in xrange(len(rows))])
+
+    @contextmanager
+    def _stats_timed(self, stage, k=1):
+        ''' count a call, for k objects, and the time spent in stats '''
+        if not self.config.get('stats'):
+            yield
+            return
+        s = time()
+        try:
+            yield
+        finally:
+            counter = self._stats.setdefault(stage, [0, 0, 0.0])
+            counter[0] += 1
+            counter[1] += k
+            counter[2] += time() - s
+
+    def _stats_wrap(self, stage, func):
+        ''' wrap func so each of its calls counts in stats, for 1 object '''
+        counter = self._stats.setdefault(stage, [0, 0, 0.0])
+
+        def timed(*args, **kwargs):
+            s = time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                counter[0] += 1
+                counter[1] += 1
+                counter[2] += time() - s
+        return timed
+
+    def _stats_log(self):
+        if self.config.get('stats'):
+            stages = sorted(self.stats()['stages'].iteritems())
+            logger.debug('stats: %s' % ', '.join(
+                '%s: %s objs in %.3fs' % (k, v['objects'], v['seconds'])
+                for k, v in stages))
+
+    def stats(self):
+        '''
+        Get the number of calls (batches), objects and time spent
+        (seconds) per ingest stage, if the stats config option is on,
+        and the (approximate) memory footprint of the objects in the
+        store.
+
+        Stages are timed once per batch of objects:
+            * prep: normalizing keys and preparing (typecasting, etc)
+                    values; or prep_column, in extend_columns()
+            * variants: adding schema variant fields
+            * object: building metrique objects (_id, _hash, etc)
+            * store: storing objects, including autoflush hand-offs
+            * upsert: writing objects to the proxy db
+
+        and, within those, per value or object (calls == objects):
+            * unwrap, normalize_container, convert, typecast, intern:
+              the (compiled) steps of preparing a value
+            * hash: generating an object's _hash
+
+        Note, objects prepared in extend() worker processes aren't
+        counted, other than in store.
+        '''
+        store = self.store
+        # only objects in memory count; not those spilled to disk
+        objects = (store.hot_values() if hasattr(store, 'hot_values')
+                   else store.itervalues())
+        stages = {k: {'calls': c, 'objects': n, 'seconds': t}
+                  for k, (c, n, t) in self._stats.iteritems()}
+        return {'objects': len(store),
+                'memory_bytes': sum(imap(_sizeof, objects)),
+                'stages': stages}
+
+    def stats_reset(self):
+        for counter in self._stats.itervalues():
+            counter[:] = [0, 0, 0.0]
 
     def _update(self, objects):
         if is_null(objects):
             pass
         elif is_array(objects, except_=False):
-            [self.add(x) for x in tuple(objects)]
+            self.extend(objects)
         elif isinstance(objects, MetriqueContainer):
-            [self.add(o) for o in objects.itervalues()]
+            if self._merge_compatible(objects):
+                self.merge(objects)
+            else:
+                self.extend(list(objects.itervalues()))
         else:
             raise ValueError(
                 "objs must be None, a list, tuple, dict or MetriqueContainer")
 
     def add(self, obj):
+        self._autoflush_raise()
+        if self.config.get('dedup') and self._dedup_skip(obj):
+            return
         obj = self._prep_object(obj)
-        # objects are stored indexed by _id
-        self.store[obj['_id']] = obj
+        self._store_objects([obj])
+
+    def _store_objects(self, objs):
+        ''' store the (prepped) objects, autoflushing as needed '''
+        with self._stats_timed('store', len(objs)):
+            for obj in objs:
+                self._store_set(obj)
+                self._autoflush(obj)
+
+    @property
+    def _dedup_path(self):
+        db = self.proxy_config.get('db') or 'default'
+        name = self.name or 'default'
+        cache_dir = self.config.get('cache_dir')
+        return os.path.join(cache_dir, '%s.%s.dedup' % (db, name))
+
+    def _dedup_load(self):
+        path = self._dedup_path
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                self._dedup_cache = cPickle.load(f)
+        else:
+            self._dedup_cache = {}
+        self._dedup_pending = {}
+        # raw objects are hashed as-is; no need for canonical json
+        self._dedup_hasher = jsonhasher(digest='md5', compat=True,
+                                        exclude=HASH_EXCLUDE_KEYS)
+        logger.debug('dedup cache loaded: %s _oids (%s)' % (
+            len(self._dedup_cache), path))
+
+    def _dedup_skip(self, obj):
+        '''
+        Check if the given raw object is unchanged since last flushed.
+
+        Only current value (_end: None) objects are considered; the
+        fingerprint is a hash of the raw object and container version.
+        '''
+        if obj.get('_end') is not None:
+            return False
+        if self._dedup_cache is None:
+            self._dedup_load()
+        _oid = obj.get('_oid')
+        fingerprint = '%s:%s' % (self.version, self._dedup_hasher(obj))
+        if self._dedup_cache.get(_oid) == fingerprint:
+            self.dedup_skipped += 1
+            return True
+        self._dedup_pending[_oid] = fingerprint
+        return False
+
+    def _dedup_update(self, objects, fingerprints=None):
+        '''
+        remember fingerprints of the objects flushed; popped from the
+        given fingerprints, or the pending ones if flushing in the
+        main thread (the autoflush writer gets its own, see _autoflush)
+        '''
+        if fingerprints is None:
+            fingerprints = self._dedup_pending
+        if fingerprints:
+            cache = self._dedup_cache
+            for o in objects:
+                fingerprint = fingerprints.pop(o['_oid'], None)
+                if fingerprint is not None:
+                    cache[o['_oid']] = fingerprint
+                    self._dedup_changed = True
+
+    def _dedup_save(self):
+        if self._dedup_cache is None or not self._dedup_changed:
+            return
+        path = self._dedup_path
+        _path = '%s.tmp' % path
+        with open(_path, 'wb') as f:
+            cPickle.dump(self._dedup_cache, f, 2)
+        os.rename(_path, path)
+        self._dedup_changed = False
+        logger.debug('dedup cache saved: %s _oids (%s skipped)' % (
+            len(self._dedup_cache), self.dedup_skipped))
+
+    def dedup_clear(self):
+        ''' forget all dedup fingerprints; eg, if the db was modified '''
+        self._dedup_cache = self._dedup_pending = None
+        self._dedup_changed = False
+        path = self._dedup_path
+        if os.path.exists(path):
+            os.remove(path)
+
+    def _autoflush(self, obj):
+        '''
+        If the store is over its high-water mark, hand off all complete
+        _oid groups, ie those with a current (_end: None) version, to
+        the background writer; the group of the object just added is
+        kept, since more versions of it might follow.
+
+        Groups of only current versions are upserted with autosnap;
+        those with historical versions without, which deletes all the
+        _oid's existing versions, so all of them must be flushed
+        together. Groups without a current version are kept until
+        flush(). The complete groups are tracked as objects are stored,
+        so a store full of incomplete groups isn't rescanned.
+        '''
+        limit = self.config.get('autoflush')
+        limit_bytes = self.config.get('autoflush_bytes')
+        if not (limit or limit_bytes):
+            return
+        if obj['_end'] is not None and obj['_oid'] in self._autoflush_oids:
+            raise ValueError(
+                'autoflush: historical version of _oid %s added after its '
+                'versions were flushed; add all versions of an _oid '
+                'together or disable autoflush' % obj['_oid'])
+        if limit_bytes:
+            self.store_bytes += _sizeof(obj)
+        if not ((limit and len(self.store) >= limit) or
+                (limit_bytes and self.store_bytes >= limit_bytes)):
+            return
+        _oid = obj['_oid']
+        oids = [k for k in self._oid_current if k != _oid]
+        if not oids:
+            return
+        historic = self._oid_historic
+        current_ids, history_ids = [], []
+        for k in oids:
+            ids = history_ids if k in historic else current_ids
+            ids.extend(self._oid_index[k])
+        self._autoflush_oids.update(oids)
+        for _ids, autosnap in ((current_ids, True), (history_ids, False)):
+            if _ids:
+                self._autoflush_put(_ids, autosnap)
+        if limit_bytes:
+            self.store_bytes = sum(imap(_sizeof, self.store.itervalues()))
+
+    def _autoflush_put(self, _ids, autosnap):
+        ''' pop the given objects and queue them for the writer '''
+        batch = [self._store_pop(_id) for _id in _ids]
+        # the writer gets the fingerprints of the objects handed off;
+        # pending ones may be replaced by newer versions meanwhile
+        fingerprints = None
+        if self._dedup_pending:
+            pending = self._dedup_pending
+            fingerprints = {}
+            for o in batch:
+                if o['_oid'] in pending:
+                    fingerprints[o['_oid']] = pending.pop(o['_oid'])
+        logger.debug('autoflushing %s objects...' % len(batch))
+        if self._autoflush_thread is None:
+            maxsize = int(self.config.get('autoflush_queue') or 0)
+            self._autoflush_queue = Queue(maxsize=maxsize)
+            self._autoflush_thread = Thread(target=self._autoflush_writer,
+                                            name='metrique-autoflush')
+            self._autoflush_thread.daemon = True
+            self._autoflush_thread.start()
+            _autoflush_containers[id(self)] = self
+        # blocks, if the writer is behind by more than queue size batches
+        self._autoflush_queue.put((batch, fingerprints or {}, autosnap))
+
+    def _autoflush_writer(self):
+        queue = self._autoflush_queue
+        while True:
+            item = queue.get()
+            if item is None:
+                break
+            batch, fingerprints, autosnap = item
+            if self._autoflush_error:
+                logger.error('autoflush failed; dropped %s objects' % (
+                    len(batch)))
+                continue
+            try:
+                self._autoflush_ids.extend(self._flush(
+                    batch, fingerprints=fingerprints, autosnap=autosnap))
+            except Exception as e:
+                logger.error('autoflush failed: %s' % e)
+                self._autoflush_error = sys.exc_info()
+
+    def _autoflush_join(self):
+        ''' wait for the background writer to finish queued batches '''
+        if self._autoflush_thread is not None:
+            self._autoflush_queue.put(None)
+            self._autoflush_thread.join()
+            self._autoflush_thread = self._autoflush_queue = None
+            _autoflush_containers.pop(id(self), None)
+        self._autoflush_raise()
+
+    def _autoflush_raise(self):
+        if self._autoflush_error:
+            _type, value, tb = self._autoflush_error
+            self._autoflush_error = None
+            raise _type, value, tb
+
+    def as_of(self, date, oid=None):
+        '''
+        Get the state of the objects in the container, as of the given
+        date; ie, the versions with _start <= date < _end (or _end null).
+
+        Versions of an _oid are expected not to overlap; they don't,
+        as stored by upsert().
+
+        :param date: date (or epoch) to get the object states for
+        :param oid: get only the state of the object with this _oid
+        :returns: the object (or None) if oid is given; otherwise a list
+                  of all objects alive at date, sorted by _oid
+        '''
+        ts = dt2ts(date)
+        if oid is not None:
+            obj = self._as_of(oid, ts)
+            return None if obj is None else self._view(obj)
+        objects = (self._as_of(_oid, ts) for _oid in self._oids)
+        return [self._view(o) for o in objects if o is not None]
 
     def autotable(self):
         name = self.config.get('name')
@@ -561,47 +1566,321 @@ class MetriqueContainer(MutableMapping):
         return result
 
     def clear(self):
-        self.store = {}
+        if hasattr(self.store, 'close'):
+            self.store.close()
+        self._store_init()
 
     def columns(self):
         return self.proxy.db_columns
 
     def df(self):
         '''Return a pandas dataframe (metrique.result.Result) from objects'''
-        return Result(self.store.values())
+        objects = self.store.values()
+        # build column by column; no intermediate dict per object
+        columns = [(f, self._df_column(f, objects)) for f in self.fields]
+        return Result.from_columns(columns)
 
-    def extend(self, objs):
+    def _df_column(self, field, objects):
+        '''
+        Get the objects' values of field as a numpy array of the field's
+        schema type; missing values are NaN (NaT for dates). Ints with
+        missing values are floats, as in pandas. Values of fields
+        without a (numerical or date) type are left for pandas to infer.
+        '''
+        schema = self.schema.get(field) or {}
+        _type = schema.get('type')
+        if field in ('_start', '_end'):
+            _type = datetime
+        elif field == '_v':
+            _type = int
+        elif schema.get('container'):
+            _type = None
+        k = len(objects)
+        values = [o.get(field) for o in objects]
+        try:
+            if _type is bool and None not in values:
+                return np.fromiter(values, 'bool', k)
+            elif _type in (int, long) and None not in values:
+                return np.fromiter(values, 'int64', k)
+            elif _type in (datetime, date, float, int, long):
+                nan = np.nan
+                array = np.fromiter((nan if v is None else v
+                                     for v in values), 'float64', k)
+                if _type in (datetime, date):
+                    # dates are stored as epochs
+                    array = epoch2datetime64(array)
+                return array
+        except (TypeError, ValueError, OverflowError):
+            # values not (all) of the schema type; eg, merged as-is
+            pass
+        if _type in (unicode, str, bool):
+            array = np.empty(k, dtype=object)
+            for i, v in enumerate(values):
+                array[i] = v
+            return array
+        return values
+
+    def extend(self, objs, workers=None, chunk_size=None, prepared=False):
+        '''
+        Add the given objects to the container.
+
+        :param workers: number of processes to prep objects with in
+                        parallel; (default: config 'workers', or 1)
+        :param chunk_size: number of objects to send to a worker at once
+        :param prepared: objects are already prepared (eg, by another
+                         container with the same schema and version) and
+                         are added as-is; see merge()
+        '''
+        objs = objs if isinstance(objs, (list, tuple)) else list(objs)
+        workers = int(workers or self.config.get('workers') or 1)
         logger.debug('extending container by %s objs...' % len(objs))
         s = time()
-        [self.add(i) for i in objs]
+        if not prepared:
+            # fix the schema (if not defined) before the hot loop
+            self._autoschema(objs)
+        if prepared:
+            self._extend_prepared(objs, len(objs))
+        elif workers > 1 and len(objs) > 1 and not self._value_variants():
+            # (per value variants need to see the objects before them
+            # in the store; not a stale copy of it, in worker processes)
+            if self.config.get('dedup'):
+                objs = [o for o in objs if not self._dedup_skip(o)]
+            self._extend_parallel(objs, workers, chunk_size)
+        else:
+            # prep in batches; eg, so batch variants get whole batches
+            for batch in batch_gen(objs, self.config.get('batch_size')):
+                self._extend_batch(batch)
         diff = time() - s
         k = len(objs)
         rate = (k / diff) if k > 0 else 0
         logger.debug('... extended container by %s objs in %ss at %.2f/s' % (
             len(objs), int(diff), rate))
+        self._stats_log()
+
+    def _extend_batch(self, objs):
+        '''
+        Prep and store a batch of objects. As with add(), if an object
+        fails, the objects before it are kept and the error is raised;
+        and per value variants see the objects before them in the store.
+        '''
+        self._autoflush_raise()
+        if self.config.get('dedup'):
+            objs = [o for o in objs if not self._dedup_skip(o)]
+        if not self._value_variants():
+            built, error = self._prep_objects_prefix(objs)
+            self._store_objects(built)
+        else:
+            prepped, error = self._prep_values_prefix(objs)
+            with self._stats_timed('variants', len(prepped)):
+                self._add_variants(prepped, batch=True)
+            # objects are built and stored one at a time, so the per
+            # value variants of each see those before it in the store
+            for obj in prepped:
+                with self._stats_timed('variants'):
+                    self._add_variants([obj], batch=False)
+                built, _error = self._build_objects([obj])
+                self._store_objects(built)
+                if _error:
+                    error = _error
+                    break
+        if error:
+            raise error[0], error[1], error[2]
+
+    def _extend_prepared(self, objs, k):
+        self._autoflush_raise()
+        version = self.version
+        with self._stats_timed('store', k):
+            for obj in objs:
+                # cheap sanity check; objects are otherwise trusted as-is
+                if obj.get('_v') != version or '_hash' not in obj:
+                    raise ValueError(
+                        'object not prepared for version %s: %s' % (
+                            version, obj.get('_id')))
+                if isinstance(obj, RecordView):
+                    obj = dict(obj)
+                self._store_set(obj)
+                self._autoflush(obj)
+
+    def _prep_config(self):
+        '''
+        the settings objects are prepared (and hashed) with; picklable,
+        with a fingerprint of the schema, rather than the schema itself
+        '''
+        return dict(version=self.version,
+                    schema=_schema_fingerprint(self.schema or {}),
+                    hash_digest=self.config.get('hash_digest'),
+                    hash_compat=self.config.get('hash_compat'))
+
+    def _prep_compatible(self, config):
+        ''' check if objects prepared with config are prepared as ours '''
+        ours = self._prep_config()
+        for key in ('version', 'hash_digest', 'hash_compat'):
+            if ours[key] != config.get(key):
+                return False
+        return not self.schema or ours['schema'] == config.get('schema')
+
+    def _merge_compatible(self, other):
+        ''' check if other's objects were prepared the same as ours '''
+        return self._prep_compatible(other._prep_config())
+
+    def merge(self, other):
+        '''
+        Add all objects of another container as-is, without preparing
+        (normalizing, typecasting, hashing) them again.
+
+        Both containers must have the same version and hash config,
+        and the same schema, unless this container has none yet.
+        '''
+        if not self._merge_compatible(other):
+            raise ValueError(
+                'container %s is not compatible (schema, version or hash)'
+                % other.name)
+        if not self.schema:
+            self.config['schema'] = dict(other.schema)
+        self._extend_prepared(other.itervalues(), len(other))
+
+    def _extend_parallel(self, objs, workers, chunk_size=None):
+        # prep the first object here, so the schema (if any is to be
+        # generated) and compiled prep steps are inherited by the workers
+        if not objs:
+            return
+        self.add(objs[0])
+        objs = objs[1:]
+        if not objs:
+            return
+        chunk_size = int(chunk_size or -(-len(objs) // (workers * 4)))
+        chunks = batch_gen(objs, chunk_size)
+        pool = Pool(workers, _extend_worker_init, (self,))
+        try:
+            # chunks come back in order; objs added later with the same
+            # _id replace those added earlier, same as with add(); as
+            # with extend(workers=1), objects before a failed one are
+            # kept and the error is raised
+            for result, error in pool.imap(_extend_worker_prep, chunks):
+                self._store_objects(result)
+                if error:
+                    raise error
+            pool.close()
+        except BaseException:
+            # objects from chunks completed so far are kept
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
 
     def flush(self, objects=None, batch_size=None, **kwargs):
-        ''' flush objects stored in self.container or those passed in'''
-        batch_size = batch_size or self.config.get('batch_size')
+        '''
+        flush objects stored in self.container or those passed in
+
+        Waits for any background (autoflush) writes to complete; _ids
+        of objects autoflushed are included in the _ids returned, as are
+        those of versions coalesced into others.
+        '''
+        self._autoflush_join()
         # if we're flushing these from self.store, we'll want to
         # pop them later.
         if objects:
             from_store = False
+            _ids = self._flush(objects, batch_size, **kwargs)
+        elif isinstance(self.store, dict):
+            from_store = True
+            # objects are already grouped by _oid in the _oid index
+            store = self.store
+            groups = ([store[_id] for _id in ids]
+                      for ids in self._oid_index.itervalues())
+            _ids = self._flush_groups(groups, batch_size, **kwargs)
+        elif hasattr(self.store, 'itervalues_by_oid'):
+            # (spilling) stores are cheaper to stream than random access;
+            # streamed in _oid order, without loading them all at once
+            from_store = True
+            groups = (list(group) for key, group in groupby(
+                self.store.itervalues_by_oid(), lambda x: x['_oid']))
+            _ids = self._flush_groups(groups, batch_size, **kwargs)
         else:
             from_store = True
-            objects = self.itervalues()
+            _ids = self._flush(self.store.itervalues(), batch_size,
+                               **kwargs)
+        if from_store:
+            for _id in _ids:
+                # try to pop the _id's flushed from store; warn / ignore
+                # the KeyError if they're not there
+                try:
+                    self._store_pop(_id)
+                except KeyError:
+                    logger.warn(
+                        "failed to pop {} from self.store!".format(_id))
+            self.store_bytes = 0
+        _ids.extend(self._autoflush_ids)
+        self._autoflush_ids = []
+        self._autoflush_oids = set()
+        self._dedup_save()
+        self._stats_log()
+        return sorted(_ids)
+
+    def _flush(self, objects, batch_size=None, fingerprints=None,
+               **kwargs):
         # sort by _oid for grouping by _oid below
         objects = sorted(objects, key=lambda x: x['_oid'])
+        groups = (group for key, group in groupby(objects,
+                                                  lambda x: x['_oid']))
+        return self._flush_groups(groups, batch_size, fingerprints,
+                                  **kwargs)
+
+    def _coalesce(self, group):
+        '''
+        Merge adjacent versions (one's _end is the next one's _start)
+        of an _oid with the same content into a single version.
+
+        Note, _hash includes the _id, which includes _start for
+        historical versions; so the content is compared without it.
+
+        Returns the versions left and the _ids of those merged away.
+        '''
+        if len(group) < 2:
+            return group, []
+        group = sorted(group, key=lambda o: o['_start'])
+        hasher = self._coalesce_hasher
+        if hasher is None:
+            hasher = self._coalesce_hasher = jsonhasher(
+                digest='md5', exclude=HASH_EXCLUDE_KEYS)
+        versions = group[:1]
+        last_hash = hasher(group[0])
+        for obj in group[1:]:
+            last, _hash = versions[-1], hasher(obj)
+            if last_hash == _hash and last['_end'] == obj['_start']:
+                # (re)generates _id and _hash for the merged interval
+                versions[-1] = self._object_cls(**dict(last,
+                                                       _end=obj['_end']))
+            else:
+                versions.append(obj)
+            last_hash = _hash
+        if len(versions) == len(group):
+            return group, []
+        dropped = set(o['_id'] for o in group)
+        dropped.difference_update(o['_id'] for o in versions)
+        return versions, list(dropped)
+
+    def _flush_groups(self, groups, batch_size=None, fingerprints=None,
+                      **kwargs):
+        batch_size = batch_size or self.config.get('batch_size')
+        coalesce = self.config.get('coalesce')
         batch, _ids = [], []
         # batch in groups with _oid, since upsert's delete
         # all _oid rows when autosnap=False!
-        for key, group in groupby(objects, lambda x: x['_oid']):
-            _grouped = list(group)
+        for group in groups:
+            # proxies expect dicts, not (compact) record views
+            _grouped = [dict(o) if isinstance(o, RecordView) else o
+                        for o in group]
+            if coalesce:
+                _grouped, dropped = self._coalesce(_grouped)
+                _ids.extend(dropped)
             if len(batch) + len(_grouped) > batch_size:
                 logger.debug("Upserting %s objects" % len(batch))
-                _ = self.upsert(objects=batch, **kwargs)
+                with self._stats_timed('upsert', len(batch)):
+                    _ = self.upsert(objects=batch, **kwargs)
                 logger.debug("... done upserting %s objects" % len(batch))
                 _ids.extend(_)
+                self._dedup_update(batch, fingerprints)
                 # start a new batch
                 batch = _grouped
             else:
@@ -611,50 +1890,165 @@ class MetriqueContainer(MutableMapping):
             if batch:
                 # get the last batch too
                 logger.debug("Upserting last batch of %s objects" % len(batch))
-                _ = self.upsert(objects=batch, **kwargs)
+                with self._stats_timed('upsert', len(batch)):
+                    _ = self.upsert(objects=batch, **kwargs)
                 _ids.extend(_)
+                self._dedup_update(batch, fingerprints)
             logger.debug("... Finished upserting all objects!")
-
-        if from_store:
-            for _id in _ids:
-                # try to pop the _id's flushed from store; warn / ignore
-                # the KeyError if they're not there
-                try:
-                    self.store.pop(_id)
-                except KeyError:
-                    logger.warn(
-                        "failed to pop {} from self.store!".format(_id))
-        return sorted(_ids)
+        return _ids
 
     def find(self, query=None, fields=None, date=None, sort=None,
              descending=False, one=False, raw=False, limit=None,
-             as_cursor=False, scalar=False, default_fields=True):
+             as_cursor=False, scalar=False, default_fields=True,
+             local=False):
+        '''
+        Run a query on the container's proxy db; or, if local, on the
+        objects in the container itself. Local results are the same,
+        except that (raw) objects don't have the db's row `id`.
+        '''
+        if local:
+            return self._find_local(query=query, fields=fields, date=date,
+                                    sort=sort, descending=descending,
+                                    one=one, raw=raw, limit=limit,
+                                    as_cursor=as_cursor, scalar=scalar,
+                                    default_fields=default_fields)
         return self.proxy.find(table=self.name, query=query, fields=fields,
                                date=date, sort=sort, descending=descending,
                                one=one, raw=raw, limit=limit,
                                as_cursor=as_cursor, scalar=scalar,
                                default_fields=default_fields)
 
+    def extend_columns(self, objs):
+        '''
+        Batch (columnar) version of extend().
+
+        Accepts a list of dicts or a pandas DataFrame (eg, from
+        utils.load(..., as_df=True)) and normalizes keys, typecasts
+        and normalizes nulls (None, NaN, NaT -> None) a column at a time,
+        rather than one value at a time.
+
+        Keys missing from some of the given dicts are left out of
+        the resulting objects, same as with extend(). Note, the dedup
+        cache only applies to lists of dicts, not DataFrames.
+        '''
+        is_true(HAS_PANDAS, "`pip install pandas` required")
+        self._autoflush_raise()
+        s = time()
+        missing = {}
+        if isinstance(objs, pd.DataFrame):
+            k = len(objs)
+            self._autoschema_df(objs)
+            columns = [(key, objs[key]) for key in objs.columns]
+        else:
+            objs = list(objs)
+            if self.config.get('dedup'):
+                objs = [o for o in objs if not self._dedup_skip(o)]
+            self._autoschema(objs)
+            k = len(objs)
+            keys = set()
+            [keys.update(o.iterkeys()) for o in objs]
+            columns = []
+            for key in keys:
+                values = [o.get(key, missing) for o in objs]
+                _missing = [i for i, v in enumerate(values) if v is missing]
+                if _missing:
+                    missing[key] = set(_missing)
+                    for i in _missing:
+                        values[i] = None
+                columns.append((key, pd.Series(values)))
+        logger.debug('extending container by %s objs (columnar)...' % k)
+        if not k:
+            return
+
+        # normalize the keys once per column, rather than once per value
+        _columns = []
+        _missing = {}
+        for key, series in columns:
+            _key = self._key_map.get(key)
+            if _key is None:
+                _key = self._key_map[key] = self._normalize_key(key)
+            _columns.append((_key, series))
+            if key in missing:
+                _missing[_key] = missing[key]
+        columns, missing = _columns, _missing
+
+        # build the schema (if still needed) based on the first object
+        # note: tolist() to get back python, not numpy, types
+        first = {key: series[:1].tolist()[0] for key, series in columns
+                 if 0 not in missing.get(key, ())}
+        self._prep_schema(first)
+
+        keys, values, errors = [], [], {}
+        with self._stats_timed('prep_column', k):
+            for key, series in columns:
+                _values, _errors = self._prep_column(key, series)
+                keys.append(key)
+                values.append(_values)
+                for i, value in _errors.iteritems():
+                    errors.setdefault(i, {})[key] = value
+
+            objs = []
+            for i, row in enumerate(izip(*values)):
+                obj = dict(izip(keys, row))
+                for key, rows in missing.iteritems():
+                    if i in rows:
+                        del obj[key]
+                if i in errors:
+                    obj['_e'] = dict(obj.get('_e') or {})
+                    obj['_e'].update(errors[i])
+                objs.append(obj)
+        with self._stats_timed('variants', k):
+            self._add_variants(objs)
+
+        version = self.version
+        with self._stats_timed('object', k):
+            for obj in objs:
+                obj['_v'] = version
+            objs = [self._object_cls(**obj) for obj in objs]
+        self._store_objects(objs)
+
+        diff = time() - s
+        rate = (k / diff) if diff > 0 else 0
+        logger.debug('... extended container by %s objs in %ss at %.2f/s' % (
+            k, int(diff), rate))
+        self._stats_log()
+
     def filter(self, where):
+        '''
+        Return all objects matching ALL the field == value pairs given.
+
+        _id, _oid and fields with local indexes are looked up in the
+        indexes; only the remaining fields are scanned for, and only
+        in the objects found in the indexes.
+        '''
         if not isinstance(where, Mapping):
             raise ValueError("where must be a dict")
+        where = dict(where)
+        candidates = []
+        if '_id' in where:
+            _id = to_encoding(where.pop('_id'))
+            candidates.append({_id} if _id in self.store else set())
+        if '_oid' in where:
+            candidates.append(self._oid_index.get(where.pop('_oid'), set()))
+        for field in where.keys():
+            # missing fields are matched as '', which isn't indexed
+            if field in self._indexes and where[field] != '':
+                value = _index_key(where.pop(field))
+                candidates.append(self._indexes[field].get(value, set()))
+        if candidates:
+            candidates.sort(key=len)
+            _ids = candidates[0].intersection(*candidates[1:])
+            objects = (self.store[_id] for _id in _ids)
         else:
-            result = []
-            for obj in self.store.itervalues():
-                found = False
-                for k, v in where.iteritems():
-                    if obj.get(k, '') == v:
-                        found = True
-                    else:
-                        found = False
-                if found:
-                    result.append(obj)
-        return result
+            objects = self.store.itervalues()
+        return [obj for obj in objects
+                if all(obj.get(k, '') == v for k, v in where.iteritems())]
 
     @property
     def fields(self):
-        return sorted({k for o in self.store.itervalues()
-                       for k in o.iterkeys()})
+        if self._fields_sorted is None:
+            self._fields_sorted = sorted(self._field_counts)
+        return list(self._fields_sorted)
 
     @staticmethod
     def load(*args, **kwargs):
@@ -662,15 +2056,29 @@ class MetriqueContainer(MutableMapping):
         return load(*args, **kwargs)
 
     def itervalues(self):
+        _view = self._view
         for v in self.store.itervalues():
-            yield dict(v)
+            yield _view(v)
 
     def ls(self):
         raise NotImplementedError
 
+    def local_index(self, field):
+        '''
+        Maintain a local (hash) index of the values of the given field,
+        which speeds up filter(); objects already stored are indexed.
+        '''
+        if field in self._indexes:
+            return
+        index = self._indexes[field] = {}
+        for obj in self.store.itervalues():
+            if field in obj:
+                value = _index_key(obj[field])
+                index.setdefault(value, set()).add(obj['_id'])
+
     def pop(self, key):
         key = to_encoding(key)
-        return self.store.pop(key)
+        return self._store_pop(key)
 
     @property
     def proxy(self):
@@ -699,13 +2107,19 @@ class MetriqueContainer(MutableMapping):
         return self.store.values()
 
     def values(self):
-        return [dict(v) for v in self.store.itervalues()]
+        return list(self.itervalues())
+
+    def versions(self, oid):
+        ''' get all versions of the object with the given _oid, in order '''
+        store = self.store
+        ids = self._temporal_index(oid)[1]
+        return [self._view(store[_id]) for _id in ids]
 
     @property
     def schema(self):
         return self.config.get('schema')
 
-    def count(self, query=None, date=None):
+    def count(self, query=None, date=None, local=False):
         '''
         Run a query on the given cube and return only
         the count of resulting matches.
@@ -714,9 +2128,10 @@ class MetriqueContainer(MutableMapping):
         :param date: date (metrique date range) that should be queried
                     If date==None then the most recent versions of the
                     objects will be queried.
-        :param collection: cube name
-        :param owner: username of cube owner
+        :param local: query the objects in the container, not the proxy
         '''
+        if local:
+            return len(self._query_local(query=query, date=date))
         return self.proxy.count(table=self.name, query=query, date=date)
 
     def deptree(self, field, oids, date=None, level=None):
@@ -735,6 +2150,8 @@ class MetriqueContainer(MutableMapping):
 
     def drop(self, quiet=True):
         result = self.proxy.drop(tables=self.name, quiet=quiet)
+        # fingerprints of objects in the dropped table are stale
+        self.dedup_clear()
         return result
 
     @property
@@ -778,6 +2195,85 @@ class MetriqueContainer(MutableMapping):
         return self.proxy.share(table=self.name, with_user=with_user,
                                 roles=roles)
 
+    def _sync_path(self, target):
+        # watermarks are per source and target db; same db names on
+        # different hosts or dialects are different dbs
+        def _db(c):
+            config = c.proxy_config
+            return '_'.join([config.get('dialect') or 'sqlite',
+                             config.get('host') or 'local',
+                             config.get('db') or 'default'])
+        cache_dir = self.config.get('cache_dir')
+        return os.path.join(cache_dir, '%s.%s.sync.%s.%s' % (
+            _db(self), self.name, _db(target), target.name))
+
+    def sync(self, target, since=None, batch_size=None, full=False):
+        '''
+        Copy the object versions in the container's proxy db which
+        changed since the last sync to target's proxy db (eg, from
+        the local SQLite cache to a PostgreSQL warehouse).
+
+        Changes are found by _start/_end dates since the last sync's
+        watermark; only _oids whose (_id, _hash) versions differ from
+        those in target are copied, in batches of batch_size _oids,
+        with all their versions (autosnap: False).
+
+        Note, the watermark is the latest _start/_end date synced, not
+        the time the sync ran; there's no record of when rows were
+        written. Versions written later with older dates (eg, backfills
+        or history imports) are only found by a full sync.
+
+        :param target: MetriqueContainer to copy the objects to
+        :param since: date (or epoch) to sync changes since; overrides
+                      the last sync's watermark
+        :param full: compare all _oids, ignoring the watermark; same as
+                     since=0
+        :returns list: _ids of the objects copied
+        '''
+        batch_size = batch_size or self.config.get('batch_size')
+        path = self._sync_path(target)
+        if full:
+            since = 0
+        elif since is None and os.path.exists(path):
+            with open(path) as f:
+                since = float(f.readline())
+        else:
+            since = dt2ts(since)
+        oids, last = self.proxy.changed(since=since, table=self.name)
+        logger.info('sync %s -> %s: %s changed _oids since %s' % (
+            self.name, target.name, len(oids), since))
+        _ids = []
+        for batch in batch_gen(oids, batch_size):
+            objects = self.proxy.versions(batch, table=self.name)
+            if target.exists:
+                existing = target.proxy.versions(
+                    batch, fields=['_oid', '_id', '_hash'],
+                    table=target.name)
+            else:
+                target.proxy.autotable(name=target.name, objects=objects,
+                                       schema=target.schema or self.schema)
+                existing = []
+            source, dest = {}, {}
+            for o in existing:
+                dest.setdefault(o['_oid'], set()).add((o['_id'], o['_hash']))
+            for o in objects:
+                # target has its own row ids
+                o.pop('id', None)
+                source.setdefault(o['_oid'], set()).add(
+                    (o['_id'], o['_hash']))
+            objects = [o for o in objects
+                       if source[o['_oid']] != dest.get(o['_oid'])]
+            if objects:
+                _ids.extend(target.proxy.upsert(objects=objects,
+                                                autosnap=False,
+                                                table=target.name))
+        if last is not None:
+            with open(path, 'w') as f:
+                f.write(repr(dt2ts(last)))
+        logger.info('sync %s -> %s: %s objects copied' % (
+            self.name, target.name, len(_ids)))
+        return sorted(_ids)
+
     def upsert(self, objects=None, autosnap=None):
         objects = objects or self
         return self.proxy.upsert(table=self.name, objects=objects,
@@ -51,7 +51,10 @@ def get_objects(cube, oids, full_history, flush=False, cube_name=None,
         else:
             _ = m._get_objects(oids=batch, flush=flush)
         results.extend(_)
-    return results
+    if flush:
+        return results
+    # objects are returned prepared; along with how they were prepared
+    return m.objects._prep_config(), results
 
 
 class Generic(pyclient):
@@ -126,6 +129,8 @@ class Generic(pyclient):
         '''
         Import activities for a single document into timeline.
         '''
+        # time_doc might be a read-only (compact) record; copy it
+        time_doc = dict(time_doc)
         batch_updates = [time_doc]
         # We want to consider only activities that happend before time_doc
         # do not move this, because time_doc._start changes
@@ -407,10 +412,12 @@ class Generic(pyclient):
                 proxy=type(self.proxy),
                 proxy_config=self.proxy_config)
                 for batch in batch_gen(oids, w_batch_size))
-            # merge list of lists (batched) into single list
-            result = [i for l in result for i in l]
-            if not flush:
-                self.objects.extend(result)
+            if flush:
+                # merge list of lists (batched) into single list
+                result = [i for l in result for i in l]
+            else:
+                for config, objects in result:
+                    self._extend_worker_objects(config, objects)
         else:
             logger.debug('%s (%s@%s)' % (msg, workers, w_batch_size))
             result = []
@@ -434,6 +441,26 @@ class Generic(pyclient):
         else:
             return self
 
+    def _extend_worker_objects(self, config, objects):
+        '''
+        Add the objects prepared by a worker's container; as-is if they
+        were prepared the same as our container would, otherwise (eg,
+        different version, hash settings or generated schema) they're
+        prepared again.
+
+        Workers send only a fingerprint of their schema; so, if our
+        container has no schema yet, the first objects are prepared
+        again, which generates it.
+        '''
+        container = self.objects
+        if container.schema and container._prep_compatible(config):
+            container.extend(objects, prepared=True)
+        else:
+            if container.schema:
+                logger.warn('worker objects prepared differently; '
+                            'preparing %s objects again' % len(objects))
+            container.extend(objects)
+
     def _left_join(self, select_as, select_prop, join_prop, join_table,
                    on_col, on_db=None, on_table=None, join_db=None, **kwargs):
         on_table = on_table or self.lconfig.get('table')
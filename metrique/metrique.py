@@ -3,10 +3,6 @@
 # vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
 # Author: "Chris Ward" <cward@redhat.com>
 
-# FIXME: add to *Container a 'sync' command which will export
-# across the network all data, persist to some other container
-# and enable future 'delta' syncs.
-
 '''
 metrique.metrique
 ~~~~~~~~~~~~~~~~~
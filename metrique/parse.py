@@ -12,7 +12,8 @@ for consistently generating date range query syntax
 and field inclusion/exclusion mappers, along with a custom
 Metrique Query Parser which supports consisten querying
 against mulitple datastorage backends (eg, postgresql,
-sqlite) using a single syntax.
+sqlite) using a single syntax, as well as against local
+(in-memory) objects.
 '''
 
 from __future__ import unicode_literals, absolute_import
@@ -21,6 +22,7 @@ import logging
 logger = logging.getLogger('metrique')
 
 import ast
+from operator import eq, ne, gt, ge, lt, le
 import re
 
 try:
@@ -287,6 +289,253 @@ class MQLInterpreter(object):
             raise ValueError('Unknown function: %s' % node.func.id)
 
 
+class MQLLocalInterpreter(object):
+    '''
+    Interpreter that compiles MQL into a python predicate function,
+    which takes an object (Mapping) and returns True if it matches.
+
+    Semantics follow those of MQLInterpreter, as run against SQL
+    backends; eg, list (array) values match if any of their items
+    match (or, for != and not in, if all items match). Logic is SQL's
+    three-valued one: comparisons with null values (other than
+    == None and != None) are null (None) rather than true or false;
+    `not` keeps them null and `and`/`or` are null unless some other
+    term decides them. Objects match only if the predicate is True.
+
+    Top level (and'ed) `field == value` and `field in [...]` terms are
+    collected in `equalities`, as (field, [values]) pairs, so callers
+    can use them to look up candidate objects in indexes.
+    '''
+    def __init__(self, fields=None):
+        '''
+        :param fields: known field names; None to accept any field
+        '''
+        self.fields = set(fields) if fields is not None else None
+        self.equalities = []
+
+    def parse(self, s):
+        tree = ast.parse(s, mode='eval').body
+        self.equalities = []
+        self._equalities(tree)
+        return self.p(tree)
+
+    def _equalities(self, node):
+        if isinstance(node, ast.BoolOp) and isinstance(node.op, ast.And):
+            for value in node.values:
+                self._equalities(value)
+        elif (isinstance(node, ast.Compare) and len(node.ops) == 1 and
+              isinstance(node.left, ast.Name) and
+              isinstance(node.ops[0], (ast.Eq, ast.In))):
+            right = node.comparators[0]
+            if isinstance(node.ops[0], ast.Eq):
+                if isinstance(right, (ast.Num, ast.Str)):
+                    values = [self.p(right)]
+                elif isinstance(right, ast.Name) and right.id in (
+                        'None', 'True', 'False'):
+                    values = [self.p(right)]
+                else:
+                    return
+            elif isinstance(right, (ast.List, ast.Tuple)) and all(
+                    isinstance(e, (ast.Num, ast.Str)) for e in right.elts):
+                values = self.p(right)
+            else:
+                return
+            self.equalities.append((node.left.id, values))
+
+    def p(self, node):
+        try:
+            p = getattr(self, 'p_' + node.__class__.__name__)
+        except:
+            raise ValueError('Cannot parse: %s' % node)
+        return p(node)
+
+    def p_BoolOp(self, node):
+        preds = map(self.p, node.values)
+        _and = isinstance(node.op, ast.And)
+        return lambda o: _bool3((pred(o) for pred in preds), _and)
+
+    def p_UnaryOp(self, node):
+        if not isinstance(node.op, ast.Not):
+            raise ValueError('Cannot parse: %s' % node.op)
+        pred = self.p(node.operand)
+
+        def _not(o):
+            value = pred(o)
+            return None if value is None else not value
+        return _not
+
+    op_dict = {
+        'Eq': eq,
+        'NotEq': ne,
+        'Gt': gt,
+        'GtE': ge,
+        'Lt': lt,
+        'LtE': le,
+        'In': lambda left, right: _in3(left, right),
+        'NotIn': lambda left, right: _not3(_in3(left, right)),
+    }
+
+    def p_Compare(self, node):
+        if len(node.comparators) != 1:
+            raise ValueError('Wrong number of comparators: %s' % node.ops)
+        field = self.p_field(node.left)
+        right = self.p(node.comparators[0])
+        op = node.ops[0].__class__.__name__
+        if op not in self.op_dict:
+            raise ValueError('Unsupported operation: %s' % op)
+        # Eq, NotEq, Gt, GtE, Lt, LtE, In, NotIn
+        if isinstance(right, tuple) and right[0] in ['regex', 'iregex']:
+            return self._handle_regex(field, op, right)
+        cmp = self.op_dict[op]
+        # any item of arrays must match; all, for negated operations
+        _any = op not in ('NotEq', 'NotIn')
+        if op in ('In', 'NotIn'):
+            func = cmp
+        else:
+            # as in SQL, comparisons with NULL are null
+            func = lambda v, right: None if v is None or right is None \
+                else cmp(v, right)
+        null_cmp = op in ('Eq', 'NotEq') and right is None
+
+        def pred(o):
+            value = o.get(field)
+            if isinstance(value, list):
+                return _bool3((func(v, right) for v in value), not _any)
+            elif null_cmp:
+                # IS NULL, IS NOT NULL
+                return cmp(value, right)
+            else:
+                return func(value, right)
+        return pred
+
+    def _handle_regex(self, field, op, right):
+        if op not in ('Eq', 'NotEq'):
+            raise ValueError('Unsupported operation for regex: %s' % op)
+        flags = re.IGNORECASE if right[0] == 'iregex' else 0
+        search = re.compile(right[1], flags).search
+        match = lambda v: None if v is None else bool(search(unicode(v)))
+
+        def pred(o):
+            value = o.get(field)
+            if isinstance(value, list):
+                found = _bool3((match(v) for v in value), False)
+            else:
+                found = match(value)
+            return found if op == 'Eq' else _not3(found)
+        return pred
+
+    def p_Num(self, node):
+        return node.n
+
+    def p_Str(self, node):
+        return node.s
+
+    def p_List(self, node):
+        return map(self.p, node.elts)
+
+    def p_Tuple(self, node):
+        return map(self.p, node.elts)
+
+    def p_Name(self, node):
+        if node.id in ['None', 'True', 'False']:
+            return eval(node.id)
+        raise ValueError('Unexpected field: %s' % node.id)
+
+    def p_field(self, node):
+        if not isinstance(node, ast.Name):
+            raise ValueError('Expected field: %s' % node)
+        if self.fields is not None and node.id not in self.fields:
+            raise ValueError('Unknown field: %s' % node.id)
+        return node.id
+
+    def p_Call(self, node):
+        if node.func.id == 'empty':
+            if len(node.args) != 1:
+                raise ValueError('empty expects 1 argument.')
+            field = self.p_field(node.args[0])
+
+            def empty(o):
+                value = o.get(field)
+                return None if value is None else value == []
+            return empty
+        elif node.func.id == 'date':
+            if len(node.args) != 1:
+                raise ValueError('date expects 1 argument.')
+            else:
+                # convert all datetimes to float epoch
+                return dt2ts(self.p(node.args[0]))
+        elif node.func.id in ['regex', 'iregex']:
+            return (node.func.id, self.p(node.args[0]))
+        else:
+            raise ValueError('Unknown function: %s' % node.func.id)
+
+
+def _not3(value):
+    ''' SQL (three-valued) not; null (None) stays null '''
+    return None if value is None else not value
+
+
+def _bool3(values, _and):
+    '''
+    SQL (three-valued) and (or, if not _and) of the given values;
+    decided by the first false (true) value, otherwise null (None)
+    if any value is null
+    '''
+    result = _and
+    for value in values:
+        if value is None:
+            result = None
+        elif bool(value) is not _and:
+            return not _and
+    return result
+
+
+def _in3(value, values):
+    ''' SQL (three-valued) in; null if not found and any is null '''
+    if value is None:
+        return None
+    elif value in values:
+        return True
+    elif None in values:
+        return None
+    return False
+
+
+def _date_query(query=None, date=None):
+    ''' and the given query with the given date range query '''
+    date = date_range(date)
+    if query and date:
+        query = '%s and %s' % (query, date)
+    elif date:
+        query = date
+    elif query:
+        pass
+    else:  # date is null, query is not
+        query = None
+    return query
+
+
+def parse_local(query=None, date=None, fields=None):
+    '''
+    Given a MQL query and date range, generate a python predicate
+    function which returns True for the (local) objects matching.
+
+    Returns the predicate along with the top level equality terms
+    found (see MQLLocalInterpreter.equalities).
+
+    :param query: MQL query
+    :param date: metrique date range query
+    :param fields: known field names; None to accept any field
+    '''
+    query = _date_query(query, date)
+    logger.debug('parse_local(query=%s)' % query)
+    if not query:
+        return (lambda o: True), []
+    interpreter = MQLLocalInterpreter(fields)
+    pred = interpreter.parse(query)
+    return pred, interpreter.equalities
+
+
 def parse(table, query=None, date=None, fields=None,
           distinct=False, limit=None, alias=None):
     '''
@@ -302,16 +551,8 @@ def parse(table, query=None, date=None, fields=None,
     :param limit: apply LIMIT to this query
     :param alias: apply ALIAS AS to this query
     '''
-    date = date_range(date)
+    query = _date_query(query, date)
     limit = int(limit or -1)
-    if query and date:
-        query = '%s and %s' % (query, date)
-    elif date:
-        query = date
-    elif query:
-        pass
-    else:  # date is null, query is not
-        query = None
 
     fields = parse_fields(fields=fields) or None
     # we must pass in the table column objects themselves to ensure
@@ -25,6 +25,7 @@ except ImportError:
     logger.warn('decorator module is not installed')
 
 
+from collections import Mapping, OrderedDict
 from datetime import timedelta, datetime
 
 try:
@@ -73,6 +74,21 @@ def filtered(f):
         return err_func
 
 
+def epoch2datetime64(values):
+    '''
+    Convert a sequence of epoch (float) timestamps and nulls into
+    a datetime64[ns] array (with NaT for nulls), in one vectorized step.
+
+    Timestamps are rounded to microseconds, same as pandas.to_datetime.
+    '''
+    epochs = np.asarray(values, dtype='float64')
+    nat = np.isnan(epochs)
+    with np.errstate(invalid='ignore'):
+        ns = np.round(epochs * 1e6).astype('int64') * 1000
+    ns[nat] = np.iinfo('int64').min  # NaT
+    return ns.view('M8[ns]')
+
+
 class Result(DataFrame):
     ''' Custom DataFrame implementation for Metrique '''
     def __init__(self, data=None, date=None, **kwargs):
@@ -101,6 +117,37 @@ class Result(DataFrame):
         if '_end' in self.columns:
             self._end_isnull = self._end.isnull()
 
+    @classmethod
+    def from_columns(cls, columns, date=None):
+        '''
+        Build a Result from columns of values, rather than from rows.
+
+        Epoch _start and _end columns are converted to datetime64 in one
+        vectorized step; other columns are passed to pandas as-is.
+
+        :param columns: dict (or list of (name, values) pairs) of columns
+        :param date: Date (date range) that was queried
+        '''
+        if not HAS_PANDAS:
+            raise RuntimeError("`pip install pandas` required")
+        if not HAS_NUMPY:
+            raise RuntimeError("`pip install numpy` required")
+        if isinstance(columns, Mapping):
+            columns = columns.iteritems()
+        data = OrderedDict()
+        for name, values in columns:
+            if name in ('_start', '_end') and \
+                    getattr(values, 'dtype', None) != 'M8[ns]':
+                try:
+                    values = epoch2datetime64(values)
+                except (TypeError, ValueError):
+                    # not epochs; leave it to to_datetime()
+                    pass
+            data[name] = values
+        if not data or not len(data.values()[0]):
+            return cls(None, date)
+        return cls(data, date, columns=data.keys())
+
     def __getitem__(self, key):
         try:
             return super(Result, self).__getitem__(key)
@@ -126,7 +173,9 @@ class Result(DataFrame):
         :param column: column to convert from current state -> datetime
         '''
         if column in self:
-            if self[column].dtype in NUMPY_NUMERICAL:
+            if self[column].dtype.kind == 'M':
+                pass  # already datetime
+            elif self[column].dtype in NUMPY_NUMERICAL:
                 self[column] = pd.to_datetime(self[column], unit='s')
             else:
                 self[column] = pd.to_datetime(self[column], utc=True)
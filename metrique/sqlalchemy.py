@@ -3,10 +3,6 @@
 # vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
 # Author: "Chris Ward" <cward@redhat.com>
 
-# FIXME: add to *Container a 'sync' command which will export
-# across the network all data, persist to some other container
-# and enable future 'delta' syncs.
-
 '''
 metrique.sqlalchemy
 ~~~~~~~~~~~~~~~~~~~
@@ -33,9 +29,12 @@ import logging
 logger = logging.getLogger('metrique')
 
 from collections import Mapping
+from contextlib import contextmanager
 from copy import copy
+from cStringIO import StringIO
 from datetime import datetime
 from getpass import getuser
+from itertools import izip
 try:
     from lockfile import LockFile
     HAS_LOCKFILE = True
@@ -59,18 +58,21 @@ try:
 except ImportError:
     import json
 
+from uuid import uuid4
+
 # FIXME: use http://sqlalchemy-utils.readthedocs.org/
 try:
     from sqlalchemy import create_engine, MetaData, Table
     from sqlalchemy import Index, Column, Integer
     from sqlalchemy import Float, BigInteger, Boolean, UnicodeText
     from sqlalchemy import TypeDecorator
-    from sqlalchemy import select, update, desc
-    from sqlalchemy import inspect
+    from sqlalchemy import select, update, desc, or_
+    from sqlalchemy import event, inspect
     from sqlalchemy.orm import sessionmaker
     from sqlalchemy.ext.declarative import declarative_base
     from sqlalchemy.sql.expression import func
-    from sqlalchemy.exc import OperationalError
+    from sqlalchemy.exc import DBAPIError, OperationalError
+    from sqlalchemy.pool import QueuePool
     import sqlalchemy.dialects.sqlite as sqlite
     import sqlalchemy.dialects.postgresql as pg
 
@@ -156,12 +158,30 @@ from metrique.utils import configure, to_encoding, autoschema
 from metrique.utils import debug_setup, str2list, list2str
 from metrique.utils import validate_roles, validate_password, validate_username
 from metrique.utils import json_encode_default, is_true, is_array, is_defined
-from metrique.utils import DictDiffer
+from metrique.utils import DictDiffer, batch_gen
 from metrique.result import Result
 
 CACHE_DIR = os.environ.get('METRIQUE_CACHE')
 LOG_DIR = os.environ.get('METRIQUE_LOGS')
 
+# key lists longer than this are filtered on with a temp table join,
+# rather than an IN list of bound parameters
+KEY_TABLE_MIN = 500
+
+# applied to each new sqlite connection; override with the proxy's
+# sqlite_pragmas config (a value of None skips that pragma)
+SQLITE_PRAGMAS = dict(
+    # wait for locks held by other connections (ms)
+    busy_timeout=60000,
+    # negative; size in KiB
+    cache_size=-65536,
+    # readers don't block the writer, nor the writer readers
+    journal_mode='WAL',
+    mmap_size=268435456,
+    # durable (in WAL mode) except on OS crash or power loss
+    synchronous='NORMAL',
+    temp_store='MEMORY')
+
 
 class SQLAlchemyProxy(object):
     _object_cls = None
@@ -173,12 +193,17 @@ class SQLAlchemyProxy(object):
     type_map = TYPE_MAP
     VALID_SHARE_ROLES = ['SELECT', 'INSERT', 'UPDATE', 'DELETE']
     _Base = None
+    _bulk_copy = False
     _engine = None
     _engine_uri = None
+    _inspector = None
     _lock_required = True
     _meta = None
     _session = None
+    _session_auto = None
     _sessionmaker = None
+    _sqlite_pragmas = None
+    _temp_tables = True
 
     def __init__(self, db=None, table=None, debug=None, config=None,
                  dialect=None, driver=None, host=None,
@@ -187,7 +212,8 @@ class SQLAlchemyProxy(object):
                  cache_dir=None, db_schema=None,
                  log_file=None, log_dir=None, log2file=None,
                  log2stdout=None, log_format=None, schema=None,
-                 retries=None, **kwargs):
+                 retries=None, sqlite_pragmas=None, pool_size=None,
+                 pool_pre_ping=None, bulk_copy=None, **kwargs):
         '''
         Accept additional kwargs, but ignore them.
         '''
@@ -199,6 +225,7 @@ class SQLAlchemyProxy(object):
 
         options = dict(
             batch_size=batch_size,
+            bulk_copy=bulk_copy,
             cache_dir=cache_dir,
             connect_args=connect_args,
             db=db,
@@ -214,13 +241,17 @@ class SQLAlchemyProxy(object):
             log2file=log2file,
             log2stdout=log2stdout,
             password=password,
+            pool_pre_ping=pool_pre_ping,
+            pool_size=pool_size,
             port=None,
             retries=retries,
             schema=schema,
+            sqlite_pragmas=sqlite_pragmas,
             table=table,
             username=username)
         defaults = dict(
-            batch_size=999,
+            batch_size=50000,
+            bulk_copy=False,
             cache_dir=CACHE_DIR,
             connect_args=None,
             db=None,
@@ -236,9 +267,12 @@ class SQLAlchemyProxy(object):
             log2file=True,
             log2stdout=False,
             password=None,
+            pool_pre_ping=False,
+            pool_size=5,
             port=5432,
             retries=1,
             schema=None,
+            sqlite_pragmas=None,
             table=None,
             username=getuser())
         self.config = copy(config or self.config or {})
@@ -312,6 +346,49 @@ class SQLAlchemyProxy(object):
         ix = 'ix_%s' % ix
         return ix
 
+    @contextmanager
+    def _keys(self, conn, column, keys):
+        '''
+        Context yielding what to filter the given column on with in_()
+        for the given keys; large key lists are loaded into a temp
+        table on conn and a select of them is yielded, so the number
+        of keys isn't limited by the number of bound parameters.
+
+        The table is dropped on exit, except after an error inside a
+        transaction: postgresql refuses statements until the
+        transaction is rolled back (which drops the table, as it was
+        created in it), and on sqlite, pysqlite commits the open
+        transaction before running any DDL, so a DROP would commit
+        the partial writes the caller is about to roll back. sqlite
+        key tables left that way are dropped before the next one is
+        created on the same DBAPI connection (CREATE commits anyway).
+
+        :param conn: connection the filtered queries are executed with
+        :param column: column to filter on; the key column is its type
+        :param keys: list of keys
+        '''
+        if not self._temp_tables or len(keys) <= KEY_TABLE_MIN:
+            yield keys
+            return
+        stale = conn.info.setdefault('metrique_keys', [])
+        while stale:
+            stale.pop().drop(bind=conn, checkfirst=True)
+        table = Table('metrique_keys_%s' % uuid4().hex, MetaData(),
+                      Column('key', column.type, primary_key=True,
+                             autoincrement=False),
+                      prefixes=['TEMPORARY'])
+        table.create(bind=conn)
+        ok = False
+        try:
+            conn.execute(table.insert(), [{'key': k} for k in set(keys)])
+            yield select([table.c.key])
+            ok = True
+        finally:
+            if ok or not conn.in_transaction():
+                table.drop(bind=conn)
+            elif conn.dialect.name == 'sqlite':
+                stale.append(table)
+
     def _parse_fields(self, table=None, fields=None, reflect=False, **kwargs):
         table = self.get_table(table)
         fields = parse.parse_fields(fields)
@@ -336,11 +413,47 @@ class SQLAlchemyProxy(object):
                 query = query.order_by(order_by)
         return query
 
+    def _ping(self, connection, branch):
+        '''
+        Test pooled connections as they're checked out; a connection
+        lost (eg, to a db restart) is invalidated and reconnected,
+        rather than failing the next query.
+        '''
+        if branch:
+            return
+        close_with_result = connection.should_close_with_result
+        connection.should_close_with_result = False
+        try:
+            connection.scalar(select([1]))
+        except DBAPIError as e:
+            if not e.connection_invalidated:
+                raise
+            connection.scalar(select([1]))
+        finally:
+            connection.should_close_with_result = close_with_result
+
     def _sqla_sqlite3(self, uri, isolation_level="READ UNCOMMITTED"):
         isolation_level = isolation_level or "READ UNCOMMITTED"
-        kwargs = dict(isolation_level=isolation_level)
+        # sqlalchemy doesn't pool file db connections by default; the
+        # pool hands a connection to one thread at a time
+        kwargs = dict(isolation_level=isolation_level, poolclass=QueuePool,
+                      connect_args={'check_same_thread': False})
+        pragmas = copy(SQLITE_PRAGMAS)
+        pragmas.update(self.config.get('sqlite_pragmas') or {})
+        self._sqlite_pragmas = {k: v for k, v in pragmas.iteritems()
+                                if v is not None}
+        # in WAL mode, sqlite's own locking lets readers work while
+        # another process writes; no need for an external lock file
+        journal_mode = unicode(pragmas.get('journal_mode') or '')
+        self._lock_required = journal_mode.upper() != 'WAL'
         return uri, kwargs
 
+    def _sqlite_connect(self, dbapi_conn, connection_record):
+        cursor = dbapi_conn.cursor()
+        for k, v in sorted(self._sqlite_pragmas.iteritems()):
+            cursor.execute('PRAGMA %s = %s' % (k, v))
+        cursor.close()
+
     @property
     def _sqlite_path(self):
         db = self.config.get('db')
@@ -375,8 +488,16 @@ class SQLAlchemyProxy(object):
         pg.base.PGDialect.get_isolation_level = iso
         pg.base.PGDialect._get_default_schema_name = r_none
         pg.psycopg2.PGDialect_psycopg2.set_isolation_level = iso
-        return self._sqla_postgresql(uri=uri, version=version,
-                                     isolation_level=isolation_level)
+        uri, kwargs = self._sqla_postgresql(uri=uri, version=version,
+                                            isolation_level=isolation_level)
+        # teiid doesn't support temp tables or COPY
+        self._bulk_copy = False
+        self._temp_tables = False
+        # so _oids are filtered on with IN lists of bound parameters;
+        # keep the default batches smaller
+        bs = self.config['batch_size']
+        self.config['batch_size'] = 5000 if bs == 50000 else bs
+        return uri, kwargs
 
     def _sqla_postgresql(self, uri, version=None,
                          isolation_level="READ COMMITTED"):
@@ -393,10 +514,12 @@ class SQLAlchemyProxy(object):
         types = {list: pg.ARRAY, tuple: pg.ARRAY, set: pg.ARRAY,
                  dict: JSONDict, datetime: UTCEpoch}
         self.type_map.update(types)
-        bs = self.config['batch_size']
-        # 999 batch_size is default for sqlite, postgres handles more at once
-        self.config['batch_size'] = 5000 if bs == 999 else bs
         self._lock_required = False
+        # optionally (bulk_copy), upsert with COPY into a staging table,
+        # rather than executemany; the staging table is dropped on commit,
+        # so not with autocommit connections
+        self._bulk_copy = bool(self.config.get('bulk_copy')) and \
+            isolation_level != 'AUTOCOMMIT'
         # default schema name is 'public' for postgres
         dsn = self.config['db_schema']
         self.config['db_schema'] = dsn or 'public'
@@ -423,6 +546,7 @@ class SQLAlchemyProxy(object):
         try:
             if create and name not in self.db_tables:
                 table.__table__.create()
+                self.inspector_reset()
         except Exception as e:
             logger.error('Create Table %s: FAIL (%s)' % (name, e))
             if except_:
@@ -477,7 +601,8 @@ class SQLAlchemyProxy(object):
     @property
     def db_tables(self, views=True):
         dsn = self.config.get('db_schema')
-        result = self.inspector.get_table_names(dsn)
+        # the (cached) inspector's lists are not to be modified
+        result = list(self.inspector.get_table_names(dsn))
         result += self.inspector.get_view_names(dsn) if views else []
         return sorted(result)
 
@@ -492,6 +617,8 @@ class SQLAlchemyProxy(object):
         if self._engine:
             if self.session:
                 self.session_dispose()
+            self._session_auto = None
+            self.inspector_reset()
             self._engine.dispose()
             return True
         else:
@@ -521,8 +648,13 @@ class SQLAlchemyProxy(object):
             uri, _kwargs = self._sqla_postgresql(uri)
         else:
             raise NotImplementedError("Unsupported engine: %s" % uri)
+        _kwargs['pool_size'] = int(self.config.get('pool_size') or 5)
         _kwargs.update(kwargs)
         self._engine = create_engine(uri, echo=False, **_kwargs)
+        if self._sqlite_pragmas:
+            event.listen(self._engine, 'connect', self._sqlite_connect)
+        if self.config.get('pool_pre_ping'):
+            event.listen(self._engine, 'engine_connect', self._ping)
         return self._engine
 
     def execute(self, query, cursor=False, retries=1):
@@ -603,7 +735,18 @@ class SQLAlchemyProxy(object):
 
     @property
     def inspector(self):
-        return inspect(self.engine)
+        # the inspector caches the catalog (table names, columns, ...)
+        # it's queried for; see inspector_reset()
+        if self._inspector is None:
+            self._inspector = inspect(self.engine)
+        return self._inspector
+
+    def inspector_reset(self):
+        '''
+        Drop the cached catalog; needed only if tables are created
+        or dropped other than with this proxy's autotable() or drop().
+        '''
+        self._inspector = None
 
     @property
     def proxy(self):
@@ -611,7 +754,10 @@ class SQLAlchemyProxy(object):
 
     @property
     def session_auto(self):
-        return self.session_new(autocommit=True)
+        # autocommit sessions only hold a connection while executing
+        if self._session_auto is None:
+            self._session_auto = self.session_new(autocommit=True)
+        return self._session_auto
 
     def session_dispose(self):
         self._session.close()
@@ -679,16 +825,23 @@ class SQLAlchemyProxy(object):
         fringe = str2list(oids)
         checked = set(fringe)
         loop_k = 0
-        while len(fringe) > 0:
-            if level and loop_k == abs(level):
-                break
-            query = '_oid in %s' % list(fringe)
-            docs = self.find(table=table, query=query, fields=[field],
-                             date=date, raw=True)
-            fringe = {oid for doc in docs for oid in (doc[field] or [])
-                      if oid not in checked}
-            checked |= fringe
-            loop_k += 1
+        # typed column, so container values are decoded
+        query = self._parse_query(table, date=date).\
+            with_only_columns([table.c[field]])
+        conn = self.engine.connect()
+        try:
+            while len(fringe) > 0:
+                if level and loop_k == abs(level):
+                    break
+                with self._keys(conn, table.c._oid, list(fringe)) as keys:
+                    rows = conn.execute(
+                        query.where(table.c._oid.in_(keys))).fetchall()
+                fringe = {oid for row in rows for oid in (row[field] or [])
+                          if oid not in checked}
+                checked |= fringe
+                loop_k += 1
+        finally:
+            conn.close()
         return sorted(checked)
 
     def dfind(self, query=None, fields=None, date=None, sort=None,
@@ -742,6 +895,7 @@ class SQLAlchemyProxy(object):
             [t.drop() for t in _tables]
             # clear out existing 'cached' metadata
             self._Base = None
+            self.inspector_reset()
         else:
             logger.warn("No tables found to drop, got %s" % _tables)
         return
@@ -780,7 +934,9 @@ class SQLAlchemyProxy(object):
             return [dict(r) for r in rows]
         else:
             if rows:
-                return Result(rows, date, columns=rows[0].keys())
+                # build column by column; no intermediate dict per row
+                columns = zip(rows[0].keys(), zip(*rows))
+                return Result.from_columns(columns, date)
             else:
                 return Result(rows, date)
 
@@ -802,6 +958,42 @@ class SQLAlchemyProxy(object):
         logger.debug("last %s.%s: %s" % (table, list2str(field), last))
         return last
 
+    def changed(self, since=None, table=None):
+        '''
+        Get the _oids of objects with any version started or ended
+        since the given date, along with the latest such date (epoch).
+
+        :param since: date (or epoch); if null, all _oids are returned
+        '''
+        table = self.get_table(table)
+        _start, _end = table.c._start, table.c._end
+        query = select([table.c._oid, func.max(_start), func.max(_end)])
+        since = dt2ts(since)
+        if since:
+            query = query.where(or_(_start >= since, _end >= since))
+        query = query.group_by(table.c._oid)
+        oids, last = [], None
+        for _oid, start, end in self.session_auto.execute(query):
+            oids.append(_oid)
+            last = max(last, start, end)
+        return sorted(oids), last
+
+    def versions(self, oids, fields=None, table=None):
+        '''
+        Get all versions of the objects with the given _oids, as dicts.
+
+        :param fields: columns to return; default is all
+        '''
+        table = self.get_table(table)
+        columns = [table.c[f] for f in str2list(fields)] or [table]
+        conn = self.engine.connect()
+        try:
+            with self._keys(conn, table.c._oid, oids) as keys:
+                query = select(columns).where(table.c._oid.in_(keys))
+                return [dict(r) for r in conn.execute(query)]
+        finally:
+            conn.close()
+
     def _get_delta_ts_file_path(self):
         fname = 'delta_ts__' + '_'.join(
             [self.config.get('host'), self.config.get('db'),
@@ -844,6 +1036,7 @@ class SQLAlchemyProxy(object):
         logger.info('Writing new index %s: %s' % (name, fields))
         result = index.create(self.engine)
         session.commit()
+        self.inspector_reset()
         return result
 
     def index_list(self):
@@ -913,65 +1106,250 @@ class SQLAlchemyProxy(object):
             # a mix of both)
             autosnap = all(o['_end'] is None for o in objects)
             logger.warn('AUTOSNAP auto-set to: %s' % autosnap)
+        if not self._temp_tables:
+            # _oids are filtered on with IN lists of bound parameters;
+            # upsert at most batch_size _oids (with all their versions)
+            # at once
+            batch_size = batch_size or self.config['batch_size']
+            groups = {}
+            for o in objects:
+                groups.setdefault(o['_oid'], []).append(o)
+            if len(groups) > batch_size:
+                _ids = []
+                for oids in batch_gen(sorted(groups), batch_size):
+                    batch = [o for _oid in oids for o in groups[_oid]]
+                    _ids.extend(self.upsert(batch, autosnap=autosnap,
+                                            batch_size=batch_size,
+                                            table=table))
+                return sorted(_ids)
+        if self._bulk_copy:
+            return self._upsert_copy(objects, autosnap=autosnap, table=table)
+        elif autosnap and self.engine.dialect.name == 'sqlite':
+            return self._upsert_sqlite(objects, table=table)
 
         # TODO remove the use of _id and _hash
         _ids = sorted(set([o['_id'] for o in objects]))
         oids = sorted(set([o['_oid'] for o in objects]))
         session = self.session_new()
         try:
+            # the key table is dropped once the new versions are inserted
+            conn = session.connection()
+            with self._keys(conn, table.c._oid, oids) as keys:
+                if autosnap:
+                    # Snapshot - relevant only for cubes which objects
+                    # stored always are pushed with _end:None
+                    # ('current value'). If we already have an object with
+                    # same _oid, but different _hash, we know we have a NEW
+                    # object state for the given _oid. In this case, we
+                    # update the existing object by adding current object's
+                    # _start -> existing _end and then add the current
+                    # object as=is; IOW rotate out the previous version by
+                    # giving it a _end and insert the new version as
+                    # current with _end:None
+                    existing = session.query(table).\
+                        filter(table.c._oid.in_(keys)).\
+                        filter(table.c._end.is_(None)).all()
+                    existing = {o._oid: o for o in existing}
+                    inserts = [o for o in objects if o['_oid'] not in existing]
+                    snap_k = len(inserts)
+                    dup_k = 0
+                    objects = [o for o in objects if o['_oid'] in existing]
+                    for o in objects:
+                        oe = existing[o['_oid']]
+                        if oe._hash != o['_hash']:
+                            new_id = '%s:%s' % (oe._oid, oe._start)
+                            session.execute(
+                                update(table).where(table.c.id == oe.id).
+                                values(_end=o['_start'], _id=new_id))
+                            _ids.append(new_id)
+                            inserts.append(o)
+                            snap_k += 1
+                        else:
+                            dup_k += 1
+                    logger.debug('%s existing objects snapshotted' % snap_k)
+                    logger.debug('%s duplicates not re-saved' % dup_k)
+                    objects = inserts
+                else:
+                    # History import
+                    # delete all existing versions for given _oids,
+                    # then we'll insert all the new historical versions
+                    # below
+                    # NOTE: THIS EXPECTS THAT THE CURRENT BATCH CONTAINS
+                    # ALL HISTORICAL VERSIONS OF A GIVEN _oid!
+                    session.query(table).filter(table.c._oid.in_(keys)).\
+                        delete(synchronize_session=False)
+
+                # insert new versions
+                session.flush()
+                if objects:
+                    session.execute(table.insert(), objects)
+            session.commit()
+        except Exception as e:
+            logger.error('Session Error: %s' % e)
+            session.rollback()
+            raise
+
+        return sorted(map(unicode, _ids))
+
+    def _upsert_copy(self, objects, autosnap, table):
+        '''
+        PostgreSQL (bulk) version of upsert; streams the objects into a
+        temp staging table with COPY, then rotates out the previous
+        versions (autosnap) or deletes all existing versions (history
+        import) and inserts the new versions with set-based statements.
+
+        With autosnap, objects are all current versions, so at most one
+        per _oid.
+        '''
+        if autosnap:
+            oids = set(o['_oid'] for o in objects)
+            if len(oids) != len(objects):
+                raise ValueError(
+                    'autosnap upsert expects at most one object per _oid')
+        dialect = self.engine.dialect
+        preparer = dialect.identifier_preparer
+        _table = preparer.format_table(table)
+        columns = [c for c in table.columns if c.name != 'id']
+        names = ', '.join(preparer.quote(c.name) for c in columns)
+        # same value conversions as with executemany
+        procs = [c.type.bind_processor(dialect) for c in columns]
+        data = StringIO()
+        for o in objects:
+            row = []
+            for c, proc in izip(columns, procs):
+                value = o.get(c.name)
+                value = proc(value) if proc else value
+                row.append(copy_value(value))
+            data.write(('\t'.join(row) + '\n').encode('utf8'))
+        data.seek(0)
+
+        _ids = sorted(set([o['_id'] for o in objects]))
+        conn = self.engine.raw_connection()
+        try:
+            cursor = conn.cursor()
+            # temp tables aren't WAL logged; dropped on commit
+            cursor.execute(
+                'CREATE TEMP TABLE metrique_staging ON COMMIT DROP AS '
+                'SELECT %s FROM %s WITH NO DATA' % (names, _table))
+            cursor.copy_expert(
+                'COPY metrique_staging (%s) FROM STDIN' % names, data)
             if autosnap:
-                # Snapshot - relevant only for cubes which objects
-                # stored always are pushed with _end:None ('current value')
-                # If we already have an object with same _oid, but different
-                # _hash, we know we have a NEW object state for the given _oid
-                # In this case, we update the existing object by adding
-                # current object's _start -> existing _end and then add
-                # the current object as=is; IOW rotate out the previous
-                # version by giving it a _end and insert the new version
-                # as current with _end:None
-                existing = session.query(table).\
-                    filter(table.c._oid.in_(oids)).\
-                    filter(table.c._end.is_(None)).all()
-                existing = {o._oid: o for o in existing}
-                inserts = [o for o in objects if o['_oid'] not in existing]
-                snap_k = len(inserts)
-                dup_k = 0
-                objects = [o for o in objects if o['_oid'] in existing]
-                for o in objects:
-                    oe = existing[o['_oid']]
-                    if oe._hash != o['_hash']:
-                        new_id = '%s:%s' % (oe._oid, oe._start)
-                        session.execute(
-                            update(table).where(table.c.id == oe.id).
-                            values(_end=o['_start'], _id=new_id))
-                        _ids.append(new_id)
-                        inserts.append(o)
-                        snap_k += 1
-                    else:
-                        dup_k += 1
+                # rotate out current versions with a new _hash; give
+                # them an _end and a historical _id
+                cursor.execute(
+                    'SELECT t.id, t._oid, t._start, s._start '
+                    'FROM %s t JOIN metrique_staging s ON t._oid = s._oid '
+                    'WHERE t._end IS NULL AND t._hash != s._hash' % _table)
+                snaps = StringIO()
+                snap_k = 0
+                for id_, _oid, _start, _end in cursor.fetchall():
+                    new_id = '%s:%s' % (_oid, _start)
+                    _ids.append(new_id)
+                    snaps.write(('%s\t%s\t%s\n' % (
+                        id_, copy_value(new_id),
+                        copy_value(_end))).encode('utf8'))
+                    snap_k += 1
+                if snap_k:
+                    snaps.seek(0)
+                    cursor.execute(
+                        'CREATE TEMP TABLE metrique_snaps (id integer, '
+                        '_id text, _end double precision) ON COMMIT DROP')
+                    cursor.copy_expert('COPY metrique_snaps FROM STDIN',
+                                       snaps)
+                    cursor.execute(
+                        'UPDATE %s t SET _end = r._end, _id = r._id '
+                        'FROM metrique_snaps r WHERE t.id = r.id' % _table)
                 logger.debug('%s existing objects snapshotted' % snap_k)
-                logger.debug('%s duplicates not re-saved' % dup_k)
-                objects = inserts
+                # insert all but the duplicates of current versions
+                cursor.execute(
+                    'INSERT INTO %s (%s) SELECT %s FROM metrique_staging s '
+                    'WHERE NOT EXISTS (SELECT 1 FROM %s t '
+                    'WHERE t._oid = s._oid AND t._end IS NULL '
+                    'AND t._hash = s._hash)' % (_table, names, names, _table))
             else:
-                # History import
-                # delete all existing versions for given _oids,
-                # then we'll insert all the new historical versions
-                # below
-                # NOTE: THIS EXPECTS THAT THE CURRENT BATCH CONTAINS
-                # ALL HISTORICAL VERSIONS OF A GIVEN _oid!
-                session.query(table).filter(table.c._oid.in_(oids)).\
-                    delete(synchronize_session=False)
-
-            # insert new versions
-            session.flush()
-            if objects:
-                session.execute(table.insert(), objects)
-            session.commit()
+                # History import; see upsert()
+                cursor.execute(
+                    'DELETE FROM %s WHERE _oid IN '
+                    '(SELECT _oid FROM metrique_staging)' % _table)
+                cursor.execute(
+                    'INSERT INTO %s (%s) SELECT %s FROM metrique_staging' % (
+                        _table, names, names))
+            logger.debug('%s objects inserted' % cursor.rowcount)
+            conn.commit()
         except Exception as e:
             logger.error('Session Error: %s' % e)
-            session.rollback()
+            conn.rollback()
             raise
+        finally:
+            conn.close()
+        return sorted(map(unicode, _ids))
+
+    def _upsert_sqlite(self, objects, table):
+        '''
+        SQLite (bulk) version of upsert with autosnap; inserts the
+        objects into a temp staging table, then rotates out the previous
+        versions and inserts the new versions with set-based statements.
 
+        Objects are all current versions, so at most one per _oid.
+        '''
+        oids = set(o['_oid'] for o in objects)
+        if len(oids) != len(objects):
+            raise ValueError(
+                'autosnap upsert expects at most one object per _oid')
+        preparer = self.engine.dialect.identifier_preparer
+        _table = preparer.format_table(table)
+        columns = [c for c in table.columns if c.name != 'id']
+        names = ', '.join(preparer.quote(c.name) for c in columns)
+        staging = Table('metrique_staging', MetaData(),
+                        *[Column(c.name, c.type) for c in columns],
+                        prefixes=['TEMPORARY'])
+        Index('metrique_staging_oid', staging.c._oid, unique=True)
+        _ids = sorted(set([o['_id'] for o in objects]))
+        conn = self.engine.connect()
+        # historical _ids are generated the same as in upsert()
+        conn.connection.create_function(
+            'metrique_id', 2, lambda _oid, _start: '%s:%s' % (_oid, _start))
+        trans = conn.begin()
+        try:
+            staging.create(bind=conn)
+            conn.execute(staging.insert(), objects)
+            # current versions with a new _hash are rotated out; they
+            # get an _end (new version's _start) and a historical _id
+            # driven by the staging _oids, so the _oid index is used;
+            # unary + keeps sqlite from picking the (less selective)
+            # _end index instead
+            changed = ('+_end IS NULL AND _oid IN (SELECT _oid FROM '
+                       'metrique_staging) AND _hash != (SELECT s._hash '
+                       'FROM metrique_staging s WHERE s._oid = %s._oid)' % (
+                           _table))
+            rows = conn.execute(
+                'SELECT metrique_id(_oid, _start) FROM %s WHERE %s' % (
+                    _table, changed)).fetchall()
+            _ids.extend(r[0] for r in rows)
+            if rows:
+                conn.execute(
+                    'UPDATE %s SET _end = (SELECT s._start FROM '
+                    'metrique_staging s WHERE s._oid = %s._oid), '
+                    '_id = metrique_id(_oid, _start) WHERE %s' % (
+                        _table, _table, changed))
+            logger.debug('%s existing objects snapshotted' % len(rows))
+            # insert all but the duplicates of current versions
+            result = conn.execute(
+                'INSERT INTO %s (%s) SELECT %s FROM metrique_staging s '
+                'WHERE NOT EXISTS (SELECT 1 FROM %s t '
+                'WHERE t._oid = s._oid AND t._end IS NULL '
+                'AND t._hash = s._hash)' % (_table, names, names, _table))
+            logger.debug('%s objects inserted' % result.rowcount)
+            staging.drop(bind=conn)
+            trans.commit()
+        except Exception as e:
+            logger.error('Session Error: %s' % e)
+            trans.rollback()
+            # temp tables outlive the transaction on pooled connections
+            conn.execute('DROP TABLE IF EXISTS metrique_staging')
+            raise
+        finally:
+            conn.close()
         return sorted(map(unicode, _ids))
 
     def user_exists(self, username):
@@ -1039,6 +1417,42 @@ class SQLAlchemyProxy(object):
         self.session_auto.execute(sql)
 
 
+def copy_value(value):
+    '''
+    Format a (bind processed) value as a PostgreSQL COPY (text format)
+    field; lists are formatted as array literals.
+    '''
+    if value is None:
+        return '\\N'
+    elif isinstance(value, (list, tuple, set)):
+        items = []
+        for item in value:
+            if item is None:
+                items.append('NULL')
+            else:
+                item = _copy_text(item)
+                items.append('"%s"' % item.replace(
+                    '\\', '\\\\').replace('"', '\\"'))
+        value = '{%s}' % ','.join(items)
+    else:
+        value = _copy_text(value)
+    return value.replace('\\', '\\\\').replace('\t', '\\t').replace(
+        '\n', '\\n').replace('\r', '\\r')
+
+
+def _copy_text(value):
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    elif isinstance(value, float):
+        # repr keeps full precision (eg, epoch micros); str doesn't
+        return repr(value)
+    elif isinstance(value, Mapping):
+        return json.dumps(value, default=json_encode_default,
+                          ensure_ascii=False)
+    else:
+        return to_encoding(value)
+
+
 def get_engine_uri(db, host='127.0.0.1', port=5432, dialect='sqlite',
                    driver=None, username=None, password=None,
                    connect_args=None, cache_dir=None):
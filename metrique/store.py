@@ -0,0 +1,477 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+# Author: "Chris Ward" <cward@redhat.com>
+
+'''
+metrique.store
+~~~~~~~~~~~~~~
+
+This module contains the object store backends MetriqueContainer
+can keep its objects in, keyed by object _id.
+
+By default, containers keep all objects in a plain dict. For
+containers holding more objects than fit in memory, SQLiteStore
+keeps the most recently used objects in memory and spills the rest
+to a sqlite key/value file in cache_dir.
+
+Objects themselves can be stored in compact form; as RecordViews,
+read-only mappings of a values tuple and a KeyTable shared by all
+records in the container.
+
+Values of low cardinality fields can be interned with an InternPool,
+so equal values share a single object.
+'''
+
+from __future__ import unicode_literals, absolute_import
+
+import logging
+logger = logging.getLogger('metrique')
+
+from bisect import bisect_left
+from collections import Mapping, MutableMapping, OrderedDict
+import cPickle
+from heapq import merge
+from itertools import izip
+import os
+import sqlite3
+import tempfile
+
+CACHE_DIR = os.environ.get('METRIQUE_CACHE') or '/tmp'
+
+# marks keys not set in a record; None is a valid value
+_MISSING = object()
+
+
+class InternPool(object):
+    '''
+    Pool of the unique values of a field; returns the pooled object
+    for values equal to, and of the same type as, one already seen.
+    Equal values of different types (eg, str and unicode) are pooled
+    apart, so interning never changes a value's type.
+
+    Once the pool holds more than max_size values, the field isn't
+    considered low cardinality; the pool is emptied and disabled, and
+    on_disable (if set) is called.
+
+    :param max_size: max number of unique values to pool
+    :param on_disable: function to call once the pool is disabled
+    '''
+    def __init__(self, max_size=None, on_disable=None):
+        self.max_size = int(max_size or 10000)
+        self.on_disable = on_disable
+        self.enabled = True
+        self.values = {}
+
+    def __call__(self, value):
+        if value is None or not self.enabled:
+            return value
+        values = self.values
+        value = values.setdefault((type(value), value), value)
+        if len(values) > self.max_size:
+            self.disable()
+        return value
+
+    def __len__(self):
+        return len(self.values)
+
+    def disable(self):
+        logger.debug('intern pool disabled; more than %s values' % (
+            self.max_size))
+        self.enabled = False
+        self.values = {}
+        if self.on_disable:
+            self.on_disable()
+
+
+class KeyTable(object):
+    '''
+    Append-only table of record keys (eg, schema fields), shared by
+    all the records built from it.
+
+    :param keys: initial keys, in order
+    '''
+    def __init__(self, keys=None):
+        self.keys = []
+        self.index = {}
+        for key in keys or []:
+            self.add(key)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, key):
+        i = self.index.get(key)
+        if i is None:
+            i = self.index[key] = len(self.keys)
+            self.keys.append(key)
+        return i
+
+    def record(self, obj):
+        ''' build a RecordView with the given obj's content '''
+        index = self.index
+        if any(k not in index for k in obj):
+            [self.add(k) for k in sorted(obj) if k not in index]
+        values = [_MISSING] * len(self.keys)
+        for k, v in obj.iteritems():
+            values[index[k]] = v
+        return RecordView(self, tuple(values))
+
+
+class RecordView(object):
+    '''
+    Read-only mapping of a record's values tuple, with keys from
+    a shared KeyTable. Use dict(record) to get a mutable copy.
+
+    The mapping methods are implemented here, rather than inherited
+    from collections.Mapping, which has no __slots__; so records
+    don't get an instance __dict__. RecordView is registered as a
+    (virtual) Mapping subclass instead.
+    '''
+    __slots__ = ('_table', '_values')
+    __hash__ = None
+
+    def __init__(self, table, values):
+        self._table = table
+        self._values = values
+
+    def __getitem__(self, key):
+        i = self._table.index.get(key)
+        if i is None or i >= len(self._values):
+            raise KeyError(key)
+        value = self._values[i]
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __iter__(self):
+        for key, value in izip(self._table.keys, self._values):
+            if value is not _MISSING:
+                yield key
+
+    def __len__(self):
+        return sum(1 for v in self._values if v is not _MISSING)
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def __eq__(self, other):
+        if not isinstance(other, Mapping):
+            return NotImplemented
+        return dict(self.iteritems()) == dict(other.items())
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    def __repr__(self):
+        return repr(dict(self.iteritems()))
+
+    def __reduce__(self):
+        # the key table isn't pickled along with each record
+        return (dict, (dict(self.iteritems()),))
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def iterkeys(self):
+        return iter(self)
+
+    def itervalues(self):
+        for value in self._values:
+            if value is not _MISSING:
+                yield value
+
+    def iteritems(self):
+        for key, value in izip(self._table.keys, self._values):
+            if value is not _MISSING:
+                yield key, value
+
+    def keys(self):
+        return list(self)
+
+    def values(self):
+        return list(self.itervalues())
+
+    def items(self):
+        return list(self.iteritems())
+
+Mapping.register(RecordView)
+
+
+class SQLiteStore(MutableMapping):
+    '''
+    Mapping which keeps up to hot_size objects in memory and spills
+    the least recently used to a (temporary) sqlite file.
+
+    Iterating over the store doesn't move objects in or out of memory;
+    only getting or setting individual objects does.
+
+    :param cache_dir: directory to create the spill file in
+    :param hot_size: max number of objects to keep in memory
+    :param spill_size: number of objects to spill at once
+    '''
+    def __init__(self, cache_dir=None, hot_size=None, spill_size=None):
+        self.cache_dir = cache_dir or CACHE_DIR
+        self.hot_size = int(hot_size or 100000)
+        self.spill_size = int(spill_size or max(1, self.hot_size // 10))
+        self._hot = OrderedDict()
+        self._spilled = set()
+        self._conn = None
+        self.path = None
+
+    def __del__(self):
+        self.close()
+
+    def __getitem__(self, key):
+        hot = self._hot
+        if key in hot:
+            # move to the end; most recently used
+            value = hot.pop(key)
+        elif key in self._spilled:
+            value = self._load(key)
+            self._unspill(key)
+        else:
+            raise KeyError(key)
+        hot[key] = value
+        self._spill()
+        return value
+
+    def __setitem__(self, key, value):
+        hot = self._hot
+        if key in hot:
+            del hot[key]
+        elif key in self._spilled:
+            self._unspill(key)
+        hot[key] = value
+        self._spill()
+
+    def __delitem__(self, key):
+        if key in self._hot:
+            del self._hot[key]
+        elif key in self._spilled:
+            self._unspill(key)
+        else:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in self._hot or key in self._spilled
+
+    def __iter__(self):
+        for key in self._hot.keys():
+            yield key
+        for key in list(self._spilled):
+            yield key
+
+    def __len__(self):
+        return len(self._hot) + len(self._spilled)
+
+    def __repr__(self):
+        return 'SQLiteStore(hot=%s, spilled=%s, path=%s)' % (
+            len(self._hot), len(self._spilled), self.path)
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            fd, self.path = tempfile.mkstemp(prefix='metrique_store_',
+                                             suffix='.sqlite',
+                                             dir=self.cache_dir)
+            os.close(fd)
+            self._conn = sqlite3.connect(self.path)
+            # scratch data only; no need to survive a crash
+            self._conn.execute('PRAGMA journal_mode = OFF')
+            self._conn.execute('PRAGMA synchronous = OFF')
+            self._conn.execute(
+                'CREATE TABLE store (key TEXT PRIMARY KEY, oid, value BLOB)')
+            self._conn.execute('CREATE INDEX store_oid ON store (oid)')
+            logger.debug('store spill file: %s' % self.path)
+        return self._conn
+
+    def _load(self, key):
+        row = self.conn.execute('SELECT value FROM store WHERE key = ?',
+                                (key,)).fetchone()
+        return cPickle.loads(str(row[0]))
+
+    def _unspill(self, key):
+        self.conn.execute('DELETE FROM store WHERE key = ?', (key,))
+        self._spilled.remove(key)
+
+    def _spill(self):
+        hot = self._hot
+        if len(hot) <= self.hot_size:
+            return
+        k = min(len(hot), self.spill_size + len(hot) - self.hot_size)
+        rows = []
+        for i in xrange(k):
+            key, value = hot.popitem(last=False)
+            rows.append((key, value.get('_oid'),
+                         buffer(cPickle.dumps(value, 2))))
+            self._spilled.add(key)
+        self.conn.executemany(
+            'INSERT OR REPLACE INTO store (key, oid, value) '
+            'VALUES (?, ?, ?)', rows)
+        self.conn.commit()
+        logger.debug('spilled %s objects to disk (%s total)' % (
+            k, len(self._spilled)))
+
+    def hot_values(self):
+        ''' values of the objects kept in memory '''
+        return self._hot.values()
+
+    def iteritems(self):
+        for item in self._hot.items():
+            yield item
+        if self._spilled:
+            cursor = self.conn.execute('SELECT key, value FROM store')
+            for key, value in cursor:
+                yield key, cPickle.loads(str(value))
+
+    def itervalues(self):
+        for key, value in self.iteritems():
+            yield value
+
+    def itervalues_by_oid(self):
+        '''
+        values sorted by _oid; the objects in memory are merged with
+        those spilled, which are streamed from disk in _oid order.
+
+        _oids are expected to be numbers or strings, which sort the
+        same in sqlite as in python.
+        '''
+        hot = sorted((v['_oid'], 0, i, v)
+                     for i, v in enumerate(self._hot.itervalues()))
+        if self._spilled:
+            cursor = self.conn.execute(
+                'SELECT oid, value FROM store ORDER BY oid')
+            spilled = ((oid, 1, i, cPickle.loads(str(value)))
+                       for i, (oid, value) in enumerate(cursor))
+            hot = merge(hot, spilled)
+        for item in hot:
+            yield item[-1]
+
+    def items(self):
+        return list(self.iteritems())
+
+    def values(self):
+        return list(self.itervalues())
+
+    def keys(self):
+        return list(self)
+
+    def clear(self):
+        self._hot.clear()
+        if self._spilled:
+            self.conn.execute('DELETE FROM store')
+            self.conn.commit()
+            self._spilled.clear()
+
+    def close(self):
+        ''' remove the spill file '''
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+            if os.path.exists(self.path):
+                os.remove(self.path)
+        self._hot.clear()
+        self._spilled.clear()
+
+
+class SortedKeys(object):
+    '''
+    Incrementally maintained, sorted list of (unique) keys.
+
+    Keys added and removed are buffered and merged into the sorted
+    list only once it's read again, so a run of n updates costs one
+    O(n) merge rather than n list inserts; reads between updates are
+    just list slices (or bisects, for range()).
+
+    The sorted list is replaced, not updated, on merge, so iterators
+    over the keys are unaffected by later updates.
+    '''
+    def __init__(self, keys=None):
+        self._keys = sorted(keys or [])
+        self._pending = set()
+        self._removed = set()
+
+    def __len__(self):
+        return len(self._keys) + len(self._pending) - len(self._removed)
+
+    def __iter__(self):
+        return iter(self.keys)
+
+    def __getitem__(self, i):
+        return self.keys[i]
+
+    def __repr__(self):
+        return 'SortedKeys(%s)' % len(self)
+
+    def add(self, key):
+        ''' add a key; it's expected NOT to be in the list already '''
+        if key in self._removed:
+            self._removed.discard(key)
+        else:
+            self._pending.add(key)
+
+    def remove(self, key):
+        ''' remove a key; it's expected to be in the list '''
+        if key in self._pending:
+            self._pending.discard(key)
+        else:
+            self._removed.add(key)
+
+    def clear(self):
+        self._keys = []
+        self._pending.clear()
+        self._removed.clear()
+
+    @property
+    def keys(self):
+        if self._pending or self._removed:
+            removed = self._removed
+            if removed:
+                keys = [k for k in self._keys if k not in removed]
+            else:
+                keys = list(self._keys)
+            # timsort merges the two sorted runs in linear time
+            keys.extend(sorted(self._pending))
+            keys.sort()
+            self._keys = keys
+            self._pending = set()
+            self._removed = set()
+        return self._keys
+
+    def range(self, start=None, stop=None):
+        ''' keys k, where start <= k < stop '''
+        keys = self.keys
+        i = 0 if start is None else bisect_left(keys, start)
+        j = len(keys) if stop is None else bisect_left(keys, stop)
+        return keys[i:j]
+
+
+STORES = {
+    'dict': dict,
+    'sqlite': SQLiteStore,
+}
+
+
+def get_store(store=None, **kwargs):
+    '''
+    Initiate a new store instance.
+
+    :param store: name of a known store (see STORES) or a class (callable)
+                  which returns a MutableMapping; default is dict
+    :param kwargs: passed to the store class (if not dict)
+    '''
+    store = store or 'dict'
+    if isinstance(store, basestring):
+        if store not in STORES:
+            raise ValueError('unknown store: %s' % store)
+        store = STORES[store]
+    return store() if store is dict else store(**kwargs)
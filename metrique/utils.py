@@ -50,6 +50,7 @@ from functools import partial
 import gc
 from getpass import getuser
 import glob
+import hashlib
 from hashlib import sha1
 from inspect import isfunction
 import itertools
@@ -65,6 +66,13 @@ except ImportError:
 
 import pstats
 
+try:
+    from pyblake2 import blake2b
+    HAS_BLAKE2 = True
+except ImportError:
+    blake2b = getattr(hashlib, 'blake2b', None)
+    HAS_BLAKE2 = blake2b is not None
+
 try:
     import pytz
     HAS_PYTZ = True
@@ -118,45 +126,108 @@ def active_virtualenv():
     return os.environ.get('VIRTUAL_ENV', '')
 
 
-def autoschema(objects, fast=False, exclude_keys=None):
-    logger.debug('autoschema generation started... Fast: %s' % fast)
-    is_defined(objects, 'object samples can not be null')
-    objects = tuple(objects) if is_array(objects, except_=False) else [objects]
-    schema = defaultdict(dict)
-    exclude_keys = exclude_keys or []
+# numeric types, narrowest first
+WIDEN_NUMERIC = (bool, int, long, float)
+WIDEN_DATES = (date, datetime)
+
+
+def widen_type(a, b):
+    '''
+    Get the narrowest type which can hold values of both types a and b;
+    eg, int and float -> float, date and datetime -> datetime. Null
+    types are ignored; otherwise incompatible types widen to unicode.
+    '''
+    if a in (None, NoneType):
+        return b
+    elif b in (None, NoneType) or a is b:
+        return a
+    elif a in WIDEN_NUMERIC and b in WIDEN_NUMERIC:
+        return max(a, b, key=WIDEN_NUMERIC.index)
+    elif a in WIDEN_DATES and b in WIDEN_DATES:
+        return datetime
+    else:
+        # anything can be represented as text
+        return unicode
+
+
+def _autoschema_types(args):
+    ''' get the widened types and container keys of the objects '''
+    objects, exclude_keys = args
+    types, containers = {}, set()
     for o in objects:
-        logger.debug('autoschema model object: %s' % o)
         for k, v in o.iteritems():
-            schema_type = schema.get(k, {}).get('type')
             if k in exclude_keys:
                 continue
-            elif schema_type not in [None, NoneType]:
-                # we already have this type
-                # FIXME: option to check rigerously all objects
-                # consistency; raise exception if values are of
-                # different type given same key, etc...
-                continue
+            _type = types.get(k)
+            if isinstance(v, (list, tuple, set)):
+                containers.add(k)
+                for item in v:
+                    _type = widen_type(_type, type(item))
             else:
-                _type = type(v)
-                if is_array(_type, except_=False):
-                    schema[k]['container'] = True
-                    # FIXME: if the first object happens to be null
-                    # we auto set to UnicodeText type...
-                    # (default for type(None))
-                    # but this isn't always going to be accurate...
-                    if len(v) > 1:
-                        _t = type(v[0])
-                    else:
-                        _t = NoneType
-                    schema[k]['type'] = _t
-                else:
-                    schema[k]['type'] = _type
-        if fast is True:  # finish after first sample
-            break
+                _type = widen_type(_type, type(v))
+            types[k] = _type
+    # note: NoneType isn't picklable; None is the same, to widen_type
+    types = {k: None if t is NoneType else t for k, t in types.iteritems()}
+    return types, containers
+
+
+def autoschema(objects, fast=False, exclude_keys=None, sample_size=None,
+               workers=None):
+    '''
+    Generate a schema based on the given sample objects.
+
+    Types of all (non-null) values of a key are widened to a type
+    which can hold them all (see widen_type); keys with list, tuple
+    or set values are containers of the widened type of their items.
+    Keys with only null values are of NoneType.
+
+    :param fast: use only the first object
+    :param sample_size: use only the first sample_size objects, plus
+                        up to sample_size others chosen at random
+    :param workers: number of processes to split the objects across
+    '''
+    logger.debug('autoschema generation started... Fast: %s' % fast)
+    is_defined(objects, 'object samples can not be null')
+    objects = list(objects) if is_array(objects, except_=False) else [objects]
+    exclude_keys = set(exclude_keys or [])
+    if fast:
+        objects = objects[:1]
+    elif sample_size:
+        objects = sample_objects(objects, sample_size)
+    workers = min(int(workers or 1), len(objects))
+    if workers > 1:
+        from multiprocessing import Pool
+        size = -(-len(objects) // workers)
+        chunks = [(objects[i:i + size], exclude_keys)
+                  for i in range(0, len(objects), size)]
+        pool = Pool(workers)
+        try:
+            results = pool.map(_autoschema_types, chunks)
+        finally:
+            pool.terminate()
+        types, containers = {}, set()
+        for _types, _containers in results:
+            for k, _type in _types.iteritems():
+                types[k] = widen_type(types.get(k), _type)
+            containers.update(_containers)
+    else:
+        types, containers = _autoschema_types((objects, exclude_keys))
+    schema = defaultdict(dict)
+    for k, _type in types.iteritems():
+        schema[k]['type'] = _type or NoneType
+        if k in containers:
+            schema[k]['container'] = True
     logger.debug(' ... schema generated: %s' % schema)
     return schema
 
 
+def sample_objects(objects, size):
+    ''' get the first size objects, plus up to size others at random '''
+    objects = list(objects)
+    rest = objects[size:]
+    return objects[:size] + random.sample(rest, min(size, len(rest)))
+
+
 def backup(paths, saveas=None, ext=None):
     paths = list2str(paths, delim=' ')
     saveas = saveas if saveas else 'out'
@@ -720,11 +791,120 @@ def _jsonhash_sha1(o):
     return sha1(repr(o)).hexdigest()
 
 
-def jsonhash(obj, root=True, exclude=None, hash_func=_jsonhash_sha1):
+# cache of jsonhasher()s, by (digest, compat, exclude)
+_JSONHASHERS = {}
+
+
+def _jsonhash_digest(digest):
+    if digest in ('blake2b', 'blake2'):
+        is_true(HAS_BLAKE2, '`pip install pyblake2` required')
+        # same digest length (hexdigest of 40 chars) as sha1
+        return partial(blake2b, digest_size=20)
+    elif digest in hashlib.algorithms:
+        return getattr(hashlib, digest)
+    else:
+        raise ValueError('unsupported hash digest: %s' % digest)
+
+
+# exact types which are repr()'d as is; tuples aren't walked by the
+# legacy jsonhash either
+_JSONHASH_SCALARS = frozenset([unicode, str, int, long, float, bool,
+                               type(None), datetime, date, tuple])
+
+
+def _jsonhash_repr(obj, write):
+    '''
+    Stream out the exact repr() of the sorted tuples the (legacy)
+    jsonhash builds for obj, without building the tuples.
+    '''
+    _type = type(obj)
+    # exact type checks first; the ABC isinstance() checks are slow
+    if _type is dict or (_type is not list and
+                         _type not in _JSONHASH_SCALARS and
+                         isinstance(obj, Mapping)):
+        # keys are unique, so sorting (k, v) pairs == sorting by key
+        write(b'[')
+        first = True
+        for k, v in sorted(obj.iteritems()):
+            if first:
+                first = False
+            else:
+                write(b', ')
+            write(b'(')
+            write(repr(k))
+            write(b', ')
+            if type(v) in _JSONHASH_SCALARS:
+                write(repr(v))
+            else:
+                _jsonhash_repr(v, write)
+            write(b')')
+        write(b']')
+    elif _type is list or (_type not in _JSONHASH_SCALARS and
+                           isinstance(obj, list)):
+        write(b'(')
+        for i, e in enumerate(obj):
+            if i:
+                write(b', ')
+            if type(e) in _JSONHASH_SCALARS:
+                write(repr(e))
+            else:
+                _jsonhash_repr(e, write)
+        if len(obj) == 1:
+            write(b',')
+        write(b')')
+    else:
+        write(repr(obj))
+
+
+def jsonhasher(digest='sha1', compat=True, exclude=None):
+    '''
+    Build a function which calculates an object's hash based on all
+    its field values.
+
+    :param digest: hashlib digest name (or 'blake2b') to use
+    :param compat: reproduce the legacy (sha1 of sorted tuples repr)
+                   input encoding; otherwise, use canonical json encoding
+    :param exclude: root level keys to exclude from the hash
+    '''
+    _digest = _jsonhash_digest(digest)
+    exclude = set(exclude or [])
+    dumps = partial(json.dumps, sort_keys=True, separators=(',', ':'),
+                    default=json_encode_default, ensure_ascii=True)
+
+    def hasher(obj):
+        if exclude and isinstance(obj, Mapping):
+            obj = {k: v for k, v in obj.iteritems() if k not in exclude}
+        if compat:
+            parts = []
+            _jsonhash_repr(obj, parts.append)
+            encoded = b''.join(parts)
+        else:
+            encoded = dumps(obj)
+        return unicode(_digest(encoded).hexdigest())
+    return hasher
+
+
+# the hasher jsonhash() uses when called with the default args
+_jsonhash_default = jsonhasher()
+
+
+def jsonhash(obj, root=True, exclude=None, hash_func=None, digest='sha1',
+             compat=True):
     '''
     calculate the objects hash based on all field values
+
+    See jsonhasher() for digest and compat args; if hash_func is passed,
+    it's called with the legacy sorted tuples representation of obj.
     '''
-    if isinstance(obj, Mapping):
+    if root and hash_func is None:
+        if not exclude and digest == 'sha1' and compat:
+            return _jsonhash_default(obj)
+        key = (digest, compat, frozenset(exclude or []))
+        hasher = _JSONHASHERS.get(key)
+        if hasher is None:
+            hasher = _JSONHASHERS[key] = jsonhasher(digest, compat, exclude)
+        return hasher(obj)
+    if type(obj) is dict or isinstance(obj, Mapping):
         # assumption: using in against set() is faster than in against list()
         if root and exclude:
             obj = {k: v for k, v in obj.iteritems() if k not in exclude}
@@ -741,7 +921,7 @@ def jsonhash(obj, root=True, exclude=None, hash_func=_jsonhash_sha1):
     else:
         result = obj
     if root:
-        result = unicode(hash_func(result))
+        result = unicode((hash_func or _jsonhash_sha1)(result))
     return result
 
 
@@ -146,6 +146,21 @@ def test_api():
     assert mc.df() is not None
     assert mc.df().empty is False
 
+    # columns are typed as in the schema; missing values are NaN / NaT
+    from datetime import datetime
+    schema = {'i': {'type': int}, 'f': {'type': float},
+              'd': {'type': datetime}, 'u': {'type': unicode}}
+    df = MetriqueContainer(schema=schema, objects=[
+        {'_oid': 1, 'i': 1, 'f': 1.5, 'd': _start, 'u': 'a'},
+        {'_oid': 2, 'i': 2}]).df()
+    assert df.i.dtype == 'int64'
+    assert df.f.dtype == 'float64'
+    assert df.d.dtype == 'datetime64[ns]'
+    assert df.u.dtype == object
+    assert df.f.isnull().sum() == 1
+    assert df.d.isnull().sum() == 1
+    assert df._end.isnull().all()
+
     # local persistence; filter method queries .objects buffer
     # .upsert dumps data to proxy db; but leaves the data in the buffer
     # .flush dumps data and removes all objects dumped
@@ -196,3 +211,895 @@ def test_api():
 
     # remove the db
     remove_file(_expected_db_path)
+
+
+def test_prep_compiled():
+    from datetime import datetime
+    from metrique import MetriqueContainer
+    from metrique.utils import utcnow, dt2ts
+
+    now = utcnow(as_datetime=True)
+    schema = {
+        'created': {'type': datetime},
+        'summary': {'type': unicode},
+        'count': {'type': int},
+        'tags': {'type': unicode, 'container': True},
+        'size': {'type': float, 'convert': lambda v: v * 2},
+        'any': {},
+    }
+    # (value, prepared value) pairs
+    values = {
+        'created': [(now, dt2ts(now)), ('2014-01-01', 1388534400.0),
+                    (0, 0.0), (None, None)],
+        'summary': [('a', 'a'), (u'b', u'b'), (1, u'1'), (None, None)],
+        'count': [(1, 1), ('2', 2), (3.0, 3), (None, None)],
+        'tags': [(['b', 'a'], ['a', 'b']), (('c',), ['c']), ([], []),
+                 (None, []), (buffer(b'"y"\n"x"'), ['x', 'y'])],
+        'size': [(1, 2.0), (2.5, 5.0), (None, None)],
+        'any': [(1, 1), ('a', 'a'), (None, None)],
+    }
+    c = MetriqueContainer(schema=schema)
+    preps = c._prep_compile(schema)
+    for key, _values in values.iteritems():
+        prep = preps[key][0]
+        for value, expected in _values:
+            result = prep(value)
+            assert result == expected
+            assert type(result) is type(expected)
+
+    # unknown fields get the default prep steps; lists are invalid
+    prep = preps[None][0]
+    assert prep(1) == 1
+    try:
+        prep([1])
+    except ValueError:
+        pass
+    else:
+        assert False
+
+    c.add({'_oid': 1, 'Count': '42', 'tags': 'a', 'summary': 1})
+    assert c['1']['count'] == 42
+    assert c['1']['tags'] == ['a']
+    assert c['1']['summary'] == '1'
+    # invalid values are normalized to None and saved in _e
+    c.add({'_oid': 2, 'count': 'x'})
+    assert c['2']['count'] is None
+    assert c['2']['_e'] == {'count': 'x'}
+
+    # replacing the schema recompiles the prep steps
+    c.config['schema'] = {'count': {'type': unicode}}
+    c.add({'_oid': 3, 'count': 42})
+    assert c['3']['count'] == '42'
+
+
+def test_extend_columns():
+    from datetime import datetime
+    import pandas as pd
+    from metrique import MetriqueContainer
+    from metrique.utils import ts2dt
+
+    schema = {
+        'created': {'type': datetime},
+        'summary': {'type': unicode},
+        'count': {'type': int},
+        'size': {'type': float},
+        'tags': {'type': unicode, 'container': True},
+    }
+    objs = [
+        {'_oid': 1, 'Created': ts2dt('2014-01-01 00:00:01.5'),
+         'summary': 'a', 'count': 1, 'size': 1, 'tags': ['b', 'a']},
+        {'_oid': 2, 'Created': None, 'summary': 'a', 'count': '2',
+         'size': 2.5, 'tags': None},
+        {'_oid': 3, 'summary': None, 'count': 'x', 'tags': 'c'},
+    ]
+    a = MetriqueContainer(schema=schema)
+    a.extend(objs)
+    b = MetriqueContainer(schema=schema)
+    b.extend_columns(objs)
+    # _start defaults to utcnow(); everything else should be the same
+    _a = [dict(o, _start=None) for o in a.values()]
+    _b = [dict(o, _start=None) for o in b.values()]
+    assert sorted(_a) == sorted(_b)
+    # missing keys are left out, same as extend()
+    assert 'size' not in b['3']
+    assert b['3']['count'] is None
+    assert b['3']['_e'] == {'count': 'x'}
+
+    # dataframe columns with numpy dtypes are typecast vectorized
+    # and nulls (NaN, NaT) are normalized to None
+    df = pd.DataFrame({
+        '_oid': [1, 2],
+        'created': [ts2dt('2014-01-01 00:00:01.5'), None],
+        'count': [1.0, None],
+        'size': [1, 2],
+    })
+    c = MetriqueContainer(schema=schema)
+    c.extend_columns(df)
+    assert c['1']['created'] == a['1']['created']
+    assert c['2']['created'] is None
+    assert c['1']['count'] == 1
+    assert c['2']['count'] is None
+    assert c['2']['size'] == 2.0
+    assert isinstance(c['2']['size'], float)
+    assert isinstance(c['1']['_oid'], int)
+
+    # no schema; one is generated from the first object
+    d = MetriqueContainer()
+    d.extend_columns([{'_oid': 1, 'a': 1}, {'_oid': 2, 'a': 2}])
+    assert d.schema['a'] == {'type': int}
+
+
+def test_hash_digest():
+    from metrique import MetriqueContainer
+
+    o = {'_oid': 1, 'a': 1}
+    a = MetriqueContainer(objects=[o])
+    b = MetriqueContainer(objects=[o], hash_digest='md5')
+    c = MetriqueContainer(objects=[o], hash_compat=False)
+    assert len(b['1']['_hash']) == 32
+    assert len(set([a['1']['_hash'], b['1']['_hash'], c['1']['_hash']])) == 3
+
+
+def test_extend_workers():
+    from metrique import MetriqueContainer
+
+    objs = [{'_oid': i, 'Col 1': i, 'col_2': '%s' % i} for i in range(100)]
+    objs.append({'_oid': 1, 'col_1': 'x', 'col_2': 'last'})
+    schema = {'col_1': {'type': int}, 'col_2': {'type': unicode}}
+    a = MetriqueContainer(schema=schema)
+    a.extend(objs)
+    b = MetriqueContainer(schema=schema)
+    b.extend(objs, workers=2, chunk_size=7)
+    assert len(b) == 100
+    # last object with a given _id wins, same as with add()
+    assert b['1']['col_2'] == 'last'
+    assert b['1']['_e'] == {'col_1': 'x'}
+    # _start defaults to utcnow(); everything else should be the same
+    _a = [dict(o, _start=None) for o in a.values()]
+    _b = [dict(o, _start=None) for o in b.values()]
+    assert sorted(_a) == sorted(_b)
+
+    c = MetriqueContainer(version=2, workers=2)
+    c.extend(objs[:10])
+    assert c['9']['_v'] == 2
+
+    # errors in workers are raised back; objects prepared before the
+    # failed one are kept, same as with extend(workers=1)
+    for workers in (1, 2):
+        try:
+            b = MetriqueContainer()
+            b.extend(objs[:10] + [{'col_1': 1}], workers=workers,
+                     chunk_size=5)
+        except TypeError:
+            assert len(b) == 10
+        else:
+            assert False
+
+
+def test_autoflush():
+    from metrique import MetriqueContainer
+    from metrique.utils import remove_file
+
+    db = 'admin'
+    name = 'autoflush_test'
+    _expected_db_path = os.path.join(cache_dir, 'admin.sqlite')
+    remove_file(_expected_db_path)
+
+    c = MetriqueContainer(name=name, db=db, autoflush=10)
+    for i in range(25):
+        c.add({'_oid': i, 'col_1': i})
+        # the store never holds more than the high-water mark
+        assert len(c.store) <= 10
+    # all objects are written by the time flush() returns
+    _ids = c.flush()
+    assert _ids == sorted(map(unicode, range(25)))
+    assert c.store == {}
+    assert c.count() == 25
+
+    # _oid groups are kept together; the last _oid added is held back
+    c = MetriqueContainer(name=name, db=db, autoflush_bytes=1)
+    c.add({'_oid': 1, 'col_1': 1})
+    c.add({'_oid': 2, 'col_1': 2})
+    assert c.keys() == ['2']
+    c.flush()
+
+    # historical versions are kept until flush(), however interleaved;
+    # they're upserted without autosnap, which deletes the _oid's rows
+    c = MetriqueContainer(name=name, db=db, autoflush=2)
+    c.drop()
+    for start in range(1, 4):
+        for oid in range(5):
+            c.add({'_oid': oid, 'col_1': start, '_start': start,
+                   '_end': start + 1})
+    assert len(c.store) == 15
+    c.flush()
+    assert c.count(date='~') == 15
+    objs = c.find('_oid == 1', date='~', raw=True, sort=['_start'])
+    assert [o['col_1'] for o in objs] == [1, 2, 3]
+
+    # complete history groups (with a current version) are flushed,
+    # without autosnap
+    c = MetriqueContainer(name=name, db=db, autoflush=4)
+    c.drop()
+    for oid in range(5):
+        for start in range(1, 4):
+            c.add({'_oid': oid, 'col_1': start, '_start': start,
+                   '_end': start + 1 if start < 3 else None})
+        assert len(c.store) <= 6
+    c.flush()
+    assert c.count(date='~') == 15
+    assert c.count() == 5
+
+    # ... and can't follow a current version already flushed
+    c = MetriqueContainer(name=name, db=db, autoflush=2)
+    c.add({'_oid': 1})
+    c.add({'_oid': 2})
+    c.add({'_oid': 3})
+    try:
+        c.add({'_oid': 1, '_start': 1, '_end': 2})
+    except ValueError:
+        pass
+    else:
+        assert False
+    c.flush()
+
+    # errors in the background writer are raised on the next add()...
+    c = MetriqueContainer(name=name, db=db, autoflush=2)
+
+    def upsert(*args, **kwargs):
+        raise RuntimeError('bla')
+    c.upsert = upsert
+    c.add({'_oid': 1})
+    c.add({'_oid': 2})
+    # (or, if the writer didn't fail yet, on the final flush())
+    try:
+        c.add({'_oid': 3})
+        c.flush()
+    except RuntimeError:
+        pass
+    else:
+        assert False
+
+    remove_file(_expected_db_path)
+
+
+def test_store_sqlite():
+    from metrique import MetriqueContainer
+    from metrique.store import SQLiteStore
+
+    objs = [{'_oid': i, 'col_1': i} for i in range(20)]
+    c = MetriqueContainer(objects=objs, store='sqlite', store_hot_size=5)
+    assert isinstance(c.store, SQLiteStore)
+    assert len(c) == 20
+    assert c['1']['col_1'] == 1
+    assert [o['_oid'] for o in c[0:3]] == [0, 1, 10]
+    assert sorted(o['col_1'] for o in c.itervalues()) == range(20)
+    assert len(c.filter({'col_1': 15})) == 1
+    c.clear()
+    assert len(c) == 0
+
+    # flushed in _oid groups, streamed from the store
+    c = MetriqueContainer(name='store_test', db='admin', store='sqlite',
+                          store_hot_size=5)
+    c.drop()
+    c.extend(objs)
+    c.extend([{'_oid': i, 'col_1': i, '_start': 1, '_end': 2}
+              for i in range(20)])
+    assert len(c.flush()) == 40
+    assert len(c) == 0
+    assert c.count(date='~') == 40
+    c.drop()
+
+
+def test_compact():
+    from metrique import MetriqueContainer
+    from metrique.store import RecordView
+    from metrique.utils import remove_file
+
+    objs = [{'_oid': i, 'col_1': i, '_start': 1} for i in range(10)]
+    a = MetriqueContainer(objects=objs)
+    c = MetriqueContainer(objects=objs, compact=True)
+    assert isinstance(c.store['1'], RecordView)
+    # read-only views are handed out, rather than copies
+    assert c['1'] is c.store['1']
+    assert all(isinstance(o, RecordView) for o in c.values())
+    assert sorted(map(dict, c.values())) == sorted(a.values())
+    assert c['1'] == a['1']
+    assert c[0:2] == a[0:2]
+    assert c.df().shape == a.df().shape
+
+    db = 'admin'
+    name = 'compact_test'
+    _expected_db_path = os.path.join(cache_dir, 'admin.sqlite')
+    remove_file(_expected_db_path)
+    c = MetriqueContainer(name=name, db=db, objects=objs, compact=True)
+    assert len(c.flush()) == 10
+    assert c.count() == 10
+    remove_file(_expected_db_path)
+
+
+def test_local_indexes():
+    from metrique import MetriqueContainer
+
+    objs = [{'_oid': i, 'col_1': i % 3, 'col_2': ['a', 'b'] if i else ['c']}
+            for i in range(10)]
+    objs.append({'_oid': 1, '_start': 1, '_end': 2, 'col_1': 42})
+    schema = {'col_1': {'type': int},
+              'col_2': {'type': unicode, 'container': True}}
+    c = MetriqueContainer(objects=objs, schema=schema,
+                          local_indexes=['col_1'])
+    d = MetriqueContainer(objects=objs, schema=schema)
+
+    assert '1' in c
+    assert 1 in c
+    assert '42' not in c
+    assert c._oids == range(10)
+    assert sorted(c._oid_index[1]) == ['1', '1:1.0']
+    assert c.fields == d.fields
+
+    # filters match ALL the given fields; with or without indexes
+    for where in ({'col_1': 1}, {'col_1': 1, '_oid': 4}, {'_oid': 1},
+                  {'col_1': 1, '_oid': 3}, {'col_2': ['a', 'b']},
+                  {'_id': '1:1.0'}, {'col_1': 42, 'col_2': ''}):
+        r = sorted(o['_id'] for o in c.filter(where))
+        assert r == sorted(o['_id'] for o in d.filter(where))
+    assert len(c.filter({'col_1': 1})) == 3
+    assert len(c.filter({'col_1': 1, '_oid': 4})) == 1
+    assert len(c.filter({'col_1': 1, '_oid': 3})) == 0
+
+    # indexes are kept up to date as objects are replaced and removed
+    c.add({'_oid': 4, 'col_1': 0})
+    assert len(c.filter({'col_1': 1})) == 2
+    c.pop('7')
+    del c['1:1.0']
+    assert len(c.filter({'col_1': 1})) == 1
+    assert c._oids == [0, 1, 2, 3, 4, 5, 6, 8, 9]
+    assert 42 not in c._indexes['col_1']
+
+    # indexes can be added later too
+    d.local_index('col_2')
+    assert len(d.filter({'col_2': ['a', 'b']})) == 9
+    assert len(d.filter({'col_2': ['c']})) == 1
+    d.clear()
+    assert d._oids == []
+    assert d.fields == []
+
+
+def test_find_local():
+    from metrique import MetriqueContainer
+    from metrique.utils import remove_file
+
+    db = 'admin'
+    name = 'find_local_test'
+    _expected_db_path = os.path.join(cache_dir, 'admin.sqlite')
+    remove_file(_expected_db_path)
+
+    objs = [{'_oid': i, 'col_1': i % 3, 'col_2': 'abc'[i % 3]}
+            for i in range(10)]
+    objs.append({'_oid': 1, '_start': 1, '_end': 2, 'col_1': 42,
+                 'col_2': 'a'})
+    c = MetriqueContainer(name=name, db=db, objects=objs,
+                          local_indexes=['col_1'])
+    c.upsert()
+
+    for query, date in [(None, None), (None, '~'), ('col_1 == 1', None),
+                        ('col_1 == 42', '~'), ('col_1 == 42', None),
+                        ('col_1 in [0, 2] and _oid > 3', None),
+                        ('_oid == 1', '~'), ('col_2 != "a"', None),
+                        ('_oid == 1 and col_1 == 1', None)]:
+        assert c.count(query, date=date, local=True) == \
+            c.count(query, date=date)
+        local = c.find(query, date=date, raw=True, local=True)
+        found = c.find(query, date=date, raw=True)
+        assert sorted(o['_id'] for o in local) == \
+            sorted(o['_id'] for o in found)
+
+    # objects missing the field match None, same with or without index
+    nulls = [{'_oid': 11, 'col_2': 'a'},
+             {'_oid': 12, 'col_1': None, 'col_2': 'a'}]
+    for indexes in (['col_1'], None):
+        d = MetriqueContainer(objects=objs + nulls, local_indexes=indexes)
+        r = d.find('col_1 == None', raw=True, sort='_oid', local=True)
+        assert [o['_oid'] for o in r] == [11, 12]
+
+    # comparisons with nulls are null, also when negated; as in SQL
+    c.extend(nulls[1:])
+    c.upsert()
+    for query in ('not col_1 > 0', 'not (col_1 > 0 or col_2 == "b")',
+                  'not col_1 in [1]', 'col_1 != 1', 'not col_1 == None'):
+        local = c.find(query, raw=True, local=True)
+        found = c.find(query, raw=True)
+        assert sorted(o['_id'] for o in local) == \
+            sorted(o['_id'] for o in found)
+
+    r = c.find('col_1 == 1', fields='col_2', sort='_oid', local=True)
+    assert sorted(r.columns) == ['_end', '_oid', '_start', 'col_2']
+    assert list(r._oid) == [1, 4, 7]
+    r = c.find('col_1 == 1', sort='_oid', descending=True, limit=2,
+               raw=True, local=True)
+    assert [o['_oid'] for o in r] == [7, 4]
+    assert c.find('_oid == 4', one=True, local=True)['col_2'] == 'b'
+    assert c.find('_oid == 4', fields='col_2', scalar=True,
+                  local=True) == 'b'
+
+    remove_file(_expected_db_path)
+
+
+def test_sorted_ids():
+    from metrique import MetriqueContainer
+
+    c = MetriqueContainer(objects=[{'_oid': i} for i in (3, 1, 2)])
+    assert c._ids == ['1', '2', '3']
+    assert list(c) == ['1', '2', '3']
+    c.add({'_oid': 0})
+    c.pop('2')
+    assert c._ids == ['0', '1', '3']
+    assert [o['_oid'] for o in c[1:]] == [1, 3]
+    # replacing an object doesn't duplicate its _id
+    c.add({'_oid': 1, 'a': 1})
+    assert c._ids == ['0', '1', '3']
+    c.clear()
+    assert c._ids == []
+
+
+def test_dedup():
+    from metrique import MetriqueContainer
+    from metrique.utils import remove_file
+
+    db = 'admin'
+    name = 'dedup_test'
+    _expected_db_path = os.path.join(cache_dir, 'admin.sqlite')
+    remove_file(_expected_db_path)
+
+    objs = [{'_oid': i, 'col_1': i} for i in range(10)]
+    c = MetriqueContainer(name=name, db=db, dedup=True)
+    c.dedup_clear()
+    c.extend(objs)
+    assert len(c) == 10
+    c.flush()
+    assert exists(c._dedup_path)
+
+    # the cache is persistent; unchanged objects are skipped (before
+    # they're prepped); changed and historical objects are not
+    c = MetriqueContainer(name=name, db=db, dedup=True)
+    objs[1] = {'_oid': 1, 'col_1': 42}
+    objs.append({'_oid': 2, 'col_1': 2, '_start': 1, '_end': 2})
+    c.extend(objs)
+    assert c.dedup_skipped == 9
+    assert sorted(c._ids) == ['1', '2:1.0']
+    c.flush()
+    assert c.count('col_1 == 42') == 1
+    c.extend(objs)
+    assert c.dedup_skipped == 19
+
+    # the cache file is only rewritten if it changed
+    os.utime(c._dedup_path, (0, 0))
+    c.flush()
+    assert os.path.getmtime(c._dedup_path) == 0
+
+    # version changes invalidate the cache
+    c = MetriqueContainer(name=name, db=db, dedup=True, version=1)
+    c.extend(objs[:3])
+    assert len(c) == 3
+
+    # ... and so does dropping the table
+    c.flush()
+    c.drop()
+    assert not exists(c._dedup_path)
+    c.extend(objs[:3])
+    assert len(c) == 3
+    c.flush()
+    assert c.count(date='~') == 3
+
+    # autoflushed objects are cached with their own fingerprints; not
+    # those of newer versions added while the writer is busy
+    from threading import Event
+    c = MetriqueContainer(name=name, db=db, dedup=True, autoflush=2)
+    c.dedup_clear()
+    busy = Event()
+    _upsert = c.upsert
+
+    def upsert(*args, **kwargs):
+        busy.wait()
+        return _upsert(*args, **kwargs)
+    c.upsert = upsert
+    c.extend([{'_oid': i, 'col_1': i} for i in range(3)])
+    c.add({'_oid': 0, 'col_1': 42})
+    busy.set()
+    c._autoflush_join()
+    assert c._dedup_cache[0] != c._dedup_pending[0]
+    c.flush()
+    c = MetriqueContainer(name=name, db=db, dedup=True)
+    c.extend([{'_oid': 0, 'col_1': 42}, {'_oid': 1, 'col_1': 1}])
+    assert c.dedup_skipped == 2
+
+    c.dedup_clear()
+    assert not exists(c._dedup_path)
+    remove_file(_expected_db_path)
+
+
+def test_sync():
+    from metrique import MetriqueContainer
+    from metrique.utils import remove_file
+
+    name = 'sync_test'
+    a_path = os.path.join(cache_dir, 'admin.sqlite')
+    b_path = os.path.join(cache_dir, 'sync_target.sqlite')
+    remove_file(a_path)
+    remove_file(b_path)
+
+    a = MetriqueContainer(name=name, db='admin')
+    b = MetriqueContainer(name=name, db='sync_target')
+    remove_file(a._sync_path(b))
+    a.extend([{'_oid': i, 'col_1': i, '_start': 1} for i in range(10)])
+    a.flush()
+    # the target table is created on first sync
+    assert len(a.sync(b)) == 10
+    assert b.count() == 10
+    # nothing changed since the last sync
+    assert a.sync(b) == []
+
+    # new versions and new objects are copied; with all versions
+    a.extend([{'_oid': 1, 'col_1': 42, '_start': 2},
+              {'_oid': 10, 'col_1': 10, '_start': 2}])
+    a.flush()
+    assert a.sync(b) == ['1', '10', '1:1.0']
+    assert b.count() == 11
+    assert b.count(date='~') == 12
+    assert b.count('col_1 == 42') == 1
+
+    # changes made to the target are undone by a full sync
+    b.extend([{'_oid': 2, 'col_1': 2, 'col_2': 'x', '_start': 1}])
+    b.flush()
+    assert a.sync(b) == []
+    assert a.sync(b, since=0) == ['2']
+    assert b.count(date='~') == 12
+    assert a.sync(b, full=True) == []
+
+    # versions written with dates older than the watermark (backfills)
+    # are only found by a full sync, or one since a date before them
+    a.extend([{'_oid': 11, 'col_1': 11, '_start': 1}])
+    a.flush()
+    assert a.sync(b) == []
+    assert a.sync(b, since='1970-01-01 00:00:01') == ['11']
+
+    # watermarks are per target db; same named dbs elsewhere are others
+    c = MetriqueContainer(name=name, db='sync_target')
+    assert a._sync_path(c) == a._sync_path(b)
+    c.proxy_config['host'] = 'elsewhere'
+    assert a._sync_path(c) != a._sync_path(b)
+    c.proxy_config['dialect'] = 'postgresql'
+    c.proxy_config['host'] = None
+    assert a._sync_path(c) != a._sync_path(b)
+
+    remove_file(a._sync_path(b))
+    remove_file(a_path)
+    remove_file(b_path)
+
+
+def test_stats():
+    from metrique import MetriqueContainer
+
+    schema = {'col_1': {'type': int}, 'col_2': {'type': unicode},
+              'col_3': {'type': int, 'container': True,
+                        'convert': lambda v: v + 1}}
+    objs = [{'_oid': i, 'col_1': '%s' % i, 'col_2': i, 'col_3': [i]}
+            for i in range(10)]
+    a = MetriqueContainer(objects=objs, schema=schema)
+    b = MetriqueContainer(objects=objs, schema=schema, stats=True)
+    # stats don't change the results
+    assert sorted(dict(o, _start=None) for o in a.values()) == \
+        sorted(dict(o, _start=None) for o in b.values())
+    assert a.stats()['stages'] == {}
+
+    stats = b.stats()
+    assert stats['objects'] == 10
+    assert stats['memory_bytes'] > 0
+    stages = stats['stages']
+    # objects are extended in a batch; each stage is timed per batch
+    for stage in ('prep', 'variants', 'object', 'store'):
+        assert stages[stage]['calls'] == 1
+        assert stages[stage]['objects'] == 10
+        assert stages[stage]['seconds'] >= 0
+    # value prep steps (the ones a field needs) and hashing are timed
+    # per value and object
+    assert stages['unwrap']['calls'] == 40
+    assert stages['typecast']['calls'] == 30
+    assert stages['convert']['calls'] == 10
+    assert stages['hash']['calls'] == 10
+
+    # ... and when extending
+    b.stats_reset()
+    assert b.stats()['stages']['prep'] == {'calls': 0, 'objects': 0,
+                                           'seconds': 0.0}
+    b.extend(objs)
+    assert b.stats()['stages']['prep']['calls'] == 1
+    assert b.stats()['stages']['prep']['objects'] == 10
+    b.extend_columns(objs)
+    assert b.stats()['stages']['prep_column']['calls'] == 1
+    assert b.stats()['stages']['object']['objects'] == 20
+
+    c = MetriqueContainer(objects=objs, store='sqlite', store_hot_size=5)
+    assert 0 < c.stats()['memory_bytes'] < a.stats()['memory_bytes']
+
+    # compact records count their (backing) values tuple too
+    import sys
+    from metrique.core_api import _sizeof
+    d = MetriqueContainer(objects=objs, schema=schema, compact=True)
+    record = d.store['1']
+    values = sum(sys.getsizeof(v) for v in record.itervalues())
+    assert _sizeof(record) == sys.getsizeof(record) + values + \
+        sys.getsizeof(record._values)
+
+
+def test_merge():
+    from metrique import MetriqueContainer
+
+    schema = {'col_1': {'type': int}}
+    objs = [{'_oid': i, 'col_1': '%s' % i} for i in range(10)]
+    a = MetriqueContainer(objects=objs, schema=schema)
+
+    # prepared objects are added as-is; no prep steps are run
+    b = MetriqueContainer(stats=True)
+    b.merge(a)
+    assert b.values() == a.values()
+    assert b.schema == schema
+    assert 'object' not in b.stats()['stages']
+    c = MetriqueContainer(schema=schema, stats=True, compact=True)
+    c.extend(a.values(), prepared=True)
+    assert sorted(map(dict, c.values())) == sorted(a.values())
+    assert 'object' not in c.stats()['stages']
+
+    # objects of compatible containers are merged on init too
+    d = MetriqueContainer(objects=a, stats=True)
+    assert d.values() == a.values()
+    assert 'object' not in d.stats()['stages']
+    # ... otherwise, they're prepared again
+    d = MetriqueContainer(objects=a, version=1, stats=True)
+    assert d['1']['_v'] == 1
+    assert d.stats()['stages']['object']['objects'] == 10
+
+    for kwargs in ({'version': 1}, {'hash_digest': 'md5'},
+                   {'schema': {'col_1': {'type': float}}}):
+        try:
+            MetriqueContainer(**kwargs).merge(a)
+        except ValueError:
+            pass
+        else:
+            assert False
+    try:
+        MetriqueContainer(version=1).extend(a.values(), prepared=True)
+    except ValueError:
+        pass
+    else:
+        assert False
+
+    # objects prepared with other settings can be prepared again
+    for kwargs in ({'version': 1}, {'hash_digest': 'md5'}):
+        e = MetriqueContainer(schema=schema, **kwargs)
+        assert not e._prep_compatible(a._prep_config())
+        e.extend(a.values())
+        assert len(e) == 10
+        assert e['1']['_v'] == e.version
+    assert MetriqueContainer()._prep_compatible(a._prep_config())
+
+    # prep configs are picklable (eg, returned by workers), whatever
+    # types and functions the schema holds
+    import cPickle
+    from types import NoneType
+    schema = {'col_1': {'type': NoneType},
+              'col_2': {'type': int, 'variants': {'x': lambda v, s: v}}}
+    f = MetriqueContainer(schema=schema)
+    config = cPickle.loads(cPickle.dumps(f._prep_config(), 2))
+    assert f._prep_compatible(config)
+    assert not a._prep_compatible(config)
+
+
+def test_as_of():
+    from metrique import MetriqueContainer
+    from metrique.utils import ts2dt
+
+    objs = [{'_oid': 1, 'col_1': 1, '_start': 1, '_end': 3},
+            {'_oid': 1, 'col_1': 3, '_start': 5},
+            {'_oid': 1, 'col_1': 2, '_start': 3, '_end': 5},
+            {'_oid': 2, 'col_1': 1, '_start': 2, '_end': 4}]
+    c = MetriqueContainer(objects=objs)
+
+    assert [o['col_1'] for o in c.versions(1)] == [1, 2, 3]
+    assert [o['_start'] for o in c.versions(2)] == [2.0]
+    assert c.versions(3) == []
+
+    assert c.as_of(0, oid=1) is None
+    assert c.as_of(1, oid=1)['col_1'] == 1
+    # _end is exclusive
+    assert c.as_of(3, oid=1)['col_1'] == 2
+    assert c.as_of(4.5, oid=1)['col_1'] == 2
+    assert c.as_of(ts2dt(100), oid=1)['col_1'] == 3
+    assert c.as_of(4, oid=2) is None
+    assert [o['_id'] for o in c.as_of(2)] == ['1:1.0', '2:2.0']
+    assert [o['_id'] for o in c.as_of(4)] == ['1:3.0']
+    assert c.as_of(0) == []
+
+    # the index is kept up to date as versions are added and removed
+    c.add({'_oid': 2, 'col_1': 2, '_start': 4})
+    assert [o['_id'] for o in c.as_of(4)] == ['1:3.0', '2']
+    c.pop('1:3.0')
+    assert c.as_of(4, oid=1) is None
+    assert len(c.versions(1)) == 2
+    c.clear()
+    assert c.versions(1) == []
+
+
+def test_autoschema():
+    from metrique import MetriqueContainer
+
+    objs = [{'_oid': i, 'Col 1': i, 'col_2': None, 'col_3': ['a']}
+            for i in range(10)]
+    objs[5]['Col 1'] = 1.5
+    objs[9]['col_2'] = 'x'
+    c = MetriqueContainer(autoschema_sample=10)
+    c.extend(objs)
+    # the schema is generated from the sample before any object
+    # is prepared; so there are no typecast errors
+    assert c.schema['col_1'] == {'type': float}
+    assert c.schema['col_2'] == {'type': unicode}
+    assert c.schema['col_3'] == {'type': unicode, 'container': True}
+    assert not any(o['_e'] for o in c.values())
+    assert c['0']['col_1'] == 0.0
+    assert c['1']['col_3'] == ['a']
+
+    c = MetriqueContainer(autoschema_sample=10)
+    c.extend_columns(objs)
+    assert c.schema['col_1'] == {'type': float}
+    assert not any(o['_e'] for o in c.values())
+
+    # DataFrames are sampled too; not only their first row
+    from datetime import datetime
+    import pandas as pd
+    df = pd.DataFrame({'_oid': range(10),
+                       'col_1': [None] * 9 + ['x'],
+                       'col_2': [datetime(2014, 1, i + 1) for i in range(10)],
+                       'col_3': range(10)})
+    c = MetriqueContainer(autoschema_sample=10)
+    c.extend_columns(df)
+    assert c.schema['col_1'] == {'type': unicode}
+    assert c.schema['col_2'] == {'type': datetime}
+    assert c.schema['col_3'] == {'type': int}
+    assert c['9']['col_1'] == 'x'
+    assert not any(o['_e'] for o in c.values())
+
+
+def test_intern():
+    from metrique import MetriqueContainer
+
+    schema = {'host': {'type': unicode}, 'tags': {'type': unicode,
+                                                  'container': True},
+              'uuid': {'type': unicode}, 'count': {'type': int}}
+    objs = [{'_oid': i, 'host': 'host%s' % (i % 2), 'tags': ['a%s' % 1],
+             'uuid': 'uuid%s' % i, 'count': i} for i in range(10)]
+    c = MetriqueContainer(objects=objs, schema=schema, intern_max=5)
+    # equal values share a single object
+    assert c.store['0']['host'] is c.store['2']['host']
+    assert c.store['0']['tags'][0] is c.store['1']['tags'][0]
+    # high cardinality fields aren't interned (any longer)
+    assert c._intern_pools['uuid'].enabled is False
+    assert c._intern_pools['host'].enabled is True
+    assert 'count' not in c._intern_pools
+    assert c.store['9']['uuid'] == 'uuid9'
+
+    d = MetriqueContainer(schema=schema, intern=False)
+    d.extend(objs)
+    assert d._intern_pools == {}
+    assert sorted(d.values()) == sorted(
+        dict(o, _start=d[o['_id']]['_start']) for o in c.values())
+    d = MetriqueContainer(schema=schema, intern_max=5)
+    d.extend_columns(objs)
+    assert d.store['0']['host'] is d.store['2']['host']
+
+    # equal str and unicode values keep their type; and so their _hash
+    objs = [{'_oid': 1, 'name': b'x'}, {'_oid': 2, 'name': u'x'}]
+    a = MetriqueContainer(objects=objs, schema={'name': {'type': str}})
+    b = MetriqueContainer(objects=objs, schema={'name': {'type': str}},
+                          intern=False)
+    assert type(a['1']['name']) is str
+    assert type(a['2']['name']) is unicode
+    assert a['2']['_hash'] == b['2']['_hash']
+
+
+def test_variants():
+    from metrique import MetriqueContainer
+    from metrique.core_api import batch_variant
+
+    calls = []
+
+    @batch_variant
+    def double(values, store):
+        calls.append(len(values))
+        return [v * 2 for v in values]
+
+    schema = {'age': {'type': int,
+                      'variants': {'is_old': lambda v, s: v > 40,
+                                   'age_2': double}}}
+    objs = [{'_oid': i, 'age': '%s' % (i * 10)} for i in range(10)]
+    objs.append({'_oid': 10})
+    c = MetriqueContainer(schema=schema, batch_size=4)
+    c.extend(objs)
+    # batch variants are called once per batch, with prepared values;
+    # objects without the field get no variants
+    assert calls == [4, 4, 2]
+    assert c['5']['is_old'] is True
+    assert c['4']['is_old'] is False
+    assert c['5']['age_2'] == 100
+    assert 'age_2' not in c['10']
+    # variants are hashed too
+    d = MetriqueContainer(schema={'age': {'type': int}}, objects=objs)
+    assert c['5']['_hash'] != d['5']['_hash']
+
+    c.add({'_oid': 1, 'age': 1})
+    assert c['1']['age_2'] == 2
+
+    del calls[:]
+    c = MetriqueContainer(schema=schema)
+    c.extend_columns(objs)
+    assert calls == [10]
+    assert c['5']['age_2'] == 100
+    assert 'age_2' not in c['10']
+
+    # per value variants see the objects before them in the store,
+    # including those of the same batch
+    schema = {'age': {'type': int,
+                      'variants': {'seen': lambda v, s: len(s)}}}
+    for workers in (1, 2):
+        c = MetriqueContainer(schema=schema, batch_size=100)
+        c.extend(objs, workers=workers)
+        assert [c[str(i)]['seen'] for i in range(10)] == range(10)
+
+
+def test_extend_error():
+    from metrique import MetriqueContainer
+
+    objs = [{'_oid': i, 'col_1': i} for i in range(10)]
+    objs[6] = {'col_1': 6}
+    for schema in (None, {'col_1': {'variants': {'x': lambda v, s: v}}}):
+        c = MetriqueContainer(schema=schema, batch_size=100)
+        # objects before the one without _oid are kept, as with add()
+        try:
+            c.extend(objs)
+        except TypeError:
+            pass
+        else:
+            assert False, 'expected TypeError'
+        assert sorted(c.keys()) == map(unicode, range(6))
+
+
+def test_coalesce():
+    from metrique import MetriqueContainer
+    from metrique.utils import remove_file
+
+    db = 'admin'
+    name = 'coalesce_test'
+    _expected_db_path = os.path.join(cache_dir, 'admin.sqlite')
+    remove_file(_expected_db_path)
+
+    objs = [{'_oid': 1, 'col_1': 1, '_start': 1, '_end': 2},
+            {'_oid': 1, 'col_1': 1, '_start': 2, '_end': 3},
+            {'_oid': 1, 'col_1': 2, '_start': 3, '_end': 4},
+            {'_oid': 1, 'col_1': 2, '_start': 4},
+            {'_oid': 2, 'col_1': 1, '_start': 1, '_end': 2},
+            # not adjacent; there's a gap
+            {'_oid': 2, 'col_1': 1, '_start': 3}]
+    c = MetriqueContainer(name=name, db=db, objects=objs, coalesce=True)
+    versions, dropped = c._coalesce(c.versions(1))
+    assert [(o['_start'], o['_end']) for o in versions] == [(1, 3), (3, None)]
+    assert [o['_id'] for o in versions] == ['1:1.0', '1']
+    assert sorted(dropped) == ['1:2.0', '1:3.0']
+
+    _ids = c.flush(autosnap=False)
+    # all versions flushed (and coalesced) are removed from the store
+    assert len(_ids) == 6
+    assert c.store == {}
+    assert c.count(date='~') == 4
+    assert c.count('_oid == 1', date='~') == 2
+    assert c.count('col_1 == 2') == 1
+
+    remove_file(_expected_db_path)
@@ -115,3 +115,16 @@ def test_func():
     # check default object version is set to 0
     o = metrique_object(**a)
     o['_v'] = 0
+
+
+def test_func_hasher():
+    from metrique.core_api import metrique_object
+    from metrique.utils import jsonhasher
+
+    a = {'_oid': 1, 'col_1': 1}
+    _hash = metrique_object(**a)['_hash']
+    hasher = jsonhasher(digest='md5', compat=False)
+    o = metrique_object(_hasher=hasher, **a)
+    assert o['_hash'] != _hash
+    assert len(o['_hash']) == 32
+    assert '_hasher' not in o
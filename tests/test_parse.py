@@ -74,3 +74,70 @@ def test_date_range():
     assert date_range(after) == _after
     assert date_range(before) == _before
     assert date_range(after_before) == _after_before
+
+
+def test_parse_local():
+    from metrique.parse import parse_local
+    from metrique.utils import ts2dt, dt2ts
+
+    objs = [
+        {'_oid': 1, 'a': 1, 'b': 'Hello', 'tags': ['x', 'y'],
+         '_start': dt2ts('2014-01-01'), '_end': None},
+        {'_oid': 2, 'a': 2, 'b': None, 'tags': [],
+         '_start': dt2ts('2014-01-01'), '_end': dt2ts('2014-01-05')},
+        {'_oid': 3, 'a': None, 'b': 'world', 'tags': ['y'],
+         '_start': dt2ts('2014-01-05'), '_end': None},
+    ]
+
+    def oids(query, date='~'):
+        pred, equalities = parse_local(query, date)
+        return [o['_oid'] for o in objs if pred(o)]
+
+    assert oids(None) == [1, 2, 3]
+    assert oids(None, date=None) == [1, 3]
+    assert oids('a == 1') == [1]
+    assert oids('a != 1') == [2]
+    # comparisons with nulls never match
+    assert oids('a < 2') == [1]
+    assert oids('a == None') == [3]
+    assert oids('a in [1, 3]') == [1]
+    assert oids('a not in [1, 3]') == [2]
+    assert oids('a >= 1 and b == "Hello"') == [1]
+    assert oids('a == 2 or b == "world"') == [2, 3]
+    # logic is three-valued, as in SQL; not (null) is null
+    assert oids('not a == 2') == [1]
+    assert oids('not a > 1') == [1]
+    assert oids('not (a > 1 and b == "world")') == [1]
+    assert oids('not (a > 1 or b == "world")') == [1]
+    assert oids('not a in [1]') == [2]
+    assert oids('a > 1 or b == "world"') == [2, 3]
+    assert oids('not b != regex("^H")') == [1]
+    assert oids('not empty(tags)') == [1, 3]
+    assert oids('a == None or a > 1') == [2, 3]
+    assert oids('not a != None') == [3]
+    # arrays match any item; or all items, for != and not in
+    assert oids('tags == "y"') == [1, 3]
+    assert oids('tags != "x"') == [2, 3]
+    assert oids('tags in ["x", "z"]') == [1]
+    assert oids('tags not in ["x"]') == [2, 3]
+    assert oids('empty(tags)') == [2]
+    assert oids('b == regex("^H")') == [1]
+    assert oids('b == iregex("^h")') == [1]
+    assert oids('b != regex("^H")') == [3]
+    assert oids('tags == regex("x")') == [1]
+    assert oids('_start < date("2014-01-02")') == [1, 2]
+    assert oids(None, date='2014-01-06') == [1, 3]
+    assert oids(None, date='~2014-01-02') == [1, 2]
+    assert oids(None, date='%s~' % ts2dt('2014-01-06')) == [1, 3]
+
+    pred, equalities = parse_local('a == 1 and b in ["x"] or a == 2', '~')
+    assert equalities == []
+    pred, equalities = parse_local('a == 1 and b in ["x"] and a > 2', '~')
+    assert equalities == [('a', [1]), ('b', ['x'])]
+
+    try:
+        parse_local('a == 1', fields=['b'])
+    except ValueError:
+        pass
+    else:
+        assert False
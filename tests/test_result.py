@@ -61,3 +61,29 @@ def test_unfinished_objects():
     oids = set(oids[oids].index)
     res1 = res.unfinished_objects()
     assert oids == set(res1._oid.unique())
+
+
+def test_from_columns():
+    from metrique.result import Result, epoch2datetime64
+    import numpy as np
+
+    data = [{'_start': 1388534401.123457, '_end': None, '_oid': 1, 'b': 2},
+            {'_start': 1.5, '_end': 1388534402.0, '_oid': 2, 'b': None}]
+    columns = [(k, [o[k] for o in data]) for k in ('_oid', '_start', '_end',
+                                                     'b')]
+    r = Result.from_columns(columns)
+    expected = Result(data)
+    assert list(r.columns) == ['_oid', '_start', '_end', 'b']
+    assert r._start.dtype == expected._start.dtype
+    assert r._end.dtype == expected._end.dtype
+    assert list(r._start) == list(expected._start)
+    assert r._end.isnull().tolist() == [True, False]
+    assert r._end[1] == expected._end[1]
+    assert list(r._end_isnull) == [True, False]
+
+    r = Result.from_columns({'_oid': [], '_start': [], '_end': []})
+    assert len(r) == 0
+
+    dt = epoch2datetime64([0.000001, None])
+    assert dt.dtype == np.dtype('M8[ns]')
+    assert dt.view('i8')[0] == 1000
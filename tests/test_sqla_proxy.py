@@ -167,6 +167,152 @@ def db_tester(proxy):
     assert 'ix_bla_col_1' in ix
 
 
+def test_copy_value():
+    from metrique.sqlalchemy import copy_value
+
+    assert copy_value(None) == '\\N'
+    assert copy_value(True) == 't'
+    assert copy_value(1) == '1'
+    assert copy_value(1413811815.123456) == '1413811815.123456'
+    assert copy_value(u'a\tb\nc\\') == u'a\\tb\\nc\\\\'
+    assert copy_value(u'\u2603') == u'\u2603'
+    assert copy_value({'a': None}) == '{"a": null}'
+    assert copy_value(['a', None, 'b"c', 1.5]) == \
+        '{"a",NULL,"b\\\\"c","1.5"}'
+
+
+def test_bulk_copy():
+    from metrique import metrique_object as O
+    from metrique.sqlalchemy import SQLAlchemyProxy
+
+    uri = 'postgresql://test@127.0.0.1:5432/test'
+    # COPY upserts are opt-in; and never with autocommit connections
+    p = SQLAlchemyProxy(db='test')
+    p._sqla_postgresql(uri)
+    assert p._bulk_copy is False
+    p = SQLAlchemyProxy(db='test', bulk_copy=True)
+    p._sqla_postgresql(uri)
+    assert p._bulk_copy is True
+    p = SQLAlchemyProxy(db='test', bulk_copy=True)
+    p._sqla_postgresql(uri, isolation_level='AUTOCOMMIT')
+    assert p._bulk_copy is False
+
+    # autosnap upserts take at most one (current) version per _oid
+    objs = [O(_oid=1, col_1=1), O(_oid=1, col_1=2)]
+    try:
+        p._upsert_copy(objs, autosnap=True, table=None)
+    except ValueError:
+        pass
+    else:
+        assert False, 'expected ValueError'
+
+
+
+def test_bulk_copy_sql():
+    from sqlalchemy.dialects.postgresql import psycopg2
+    from metrique import metrique_object as O
+    from metrique.utils import remove_file
+    from metrique.sqlalchemy import SQLAlchemyProxy
+
+    _expected_db_path = os.path.join(cache_dir, 'test.sqlite')
+    remove_file(_expected_db_path)
+
+    p = SQLAlchemyProxy(db='test', table='bla')
+    schema = {'col_1': {'type': int},
+              'tags': {'type': unicode, 'container': True}}
+    table = p.autotable(schema=schema, create=True)
+
+    # record the statements _upsert_copy runs against a postgresql
+    # (DBAPI) connection, without a postgresql server
+    class Cursor(object):
+        rowcount = 0
+
+        def __init__(self, log, rows):
+            self.log = log
+            self.rows = rows
+
+        def execute(self, sql):
+            self.log.append((sql, None))
+
+        def copy_expert(self, sql, data):
+            self.log.append((sql, data.read().decode('utf8')))
+
+        def fetchall(self):
+            return self.rows
+
+    class Connection(object):
+        def __init__(self, rows=None):
+            self.log = []
+            self.rows = rows or []
+            self.committed = self.closed = False
+
+        def cursor(self):
+            return Cursor(self.log, self.rows)
+
+        def commit(self):
+            self.committed = True
+
+        def rollback(self):
+            pass
+
+        def close(self):
+            self.closed = True
+
+    class Engine(object):
+        dialect = psycopg2.dialect()
+
+        def __init__(self, conn):
+            self.conn = conn
+
+        def raw_connection(self):
+            return self.conn
+
+    names = '_id, _oid, _hash, _start, _end, _v, __v__, _e, col_1, tags'
+    objs = [O(_oid=1, col_1=1, tags=[u'a', u'b c'], _start=2.5),
+            O(_oid=2, col_1=None, _start=2.5)]
+    rows = [(10, 1, 1.5, 2.5)]
+    conn = Connection(rows)
+    p._engine = Engine(conn)
+    _ids = p._upsert_copy(objs, autosnap=True, table=table)
+    assert conn.committed and conn.closed
+    assert _ids == ['1', '1:1.5', '2']
+    sql = [s for s, data in conn.log]
+    assert sql[0] == ('CREATE TEMP TABLE metrique_staging ON COMMIT DROP '
+                      'AS SELECT %s FROM bla WITH NO DATA' % names)
+    assert sql[1] == 'COPY metrique_staging (%s) FROM STDIN' % names
+    copied = [l.split('\t') for l in conn.log[1][1].splitlines()]
+    assert copied[0][:5] == ['1', '1', objs[0]['_hash'], '2.5', '\\N']
+    assert copied[0][8:] == ['1', '["a", "b c"]']
+    assert copied[1][8:] == ['\\N', '\\N']
+    assert sql[2] == ('SELECT t.id, t._oid, t._start, s._start '
+                      'FROM bla t JOIN metrique_staging s '
+                      'ON t._oid = s._oid '
+                      'WHERE t._end IS NULL AND t._hash != s._hash')
+    # rotated out versions get an _end and a historical _id
+    assert conn.log[4] == ('COPY metrique_snaps FROM STDIN',
+                           '10\t1:1.5\t2.5\n')
+    assert sql[5] == ('UPDATE bla t SET _end = r._end, _id = r._id '
+                      'FROM metrique_snaps r WHERE t.id = r.id')
+    assert sql[6] == ('INSERT INTO bla (%s) SELECT %s FROM '
+                      'metrique_staging s WHERE NOT EXISTS (SELECT 1 FROM '
+                      'bla t WHERE t._oid = s._oid AND t._end IS NULL '
+                      'AND t._hash = s._hash)' % (names, names))
+
+    # history import replaces all versions of the staged _oids
+    conn = Connection()
+    p._engine = Engine(conn)
+    objs = [O(_oid=1, col_1=1, _start=1.5, _end=2.5),
+            O(_oid=1, col_1=2, _start=2.5)]
+    assert p._upsert_copy(objs, autosnap=False, table=table) == [
+        '1', '1:1.5']
+    sql = [s for s, data in conn.log]
+    assert sql[2:] == [
+        'DELETE FROM bla WHERE _oid IN (SELECT _oid FROM metrique_staging)',
+        'INSERT INTO bla (%s) SELECT %s FROM metrique_staging' % (
+            names, names)]
+    p._engine = None
+    remove_file(_expected_db_path)
+
 def test_get_engine_uri():
     from metrique.sqlalchemy import get_engine_uri
 
@@ -204,6 +350,172 @@ def test_sqlite3():
     remove_file(_expected_db_path)
 
 
+def test_sqlite_pragmas():
+    from metrique.utils import remove_file
+    from metrique.sqlalchemy import SQLAlchemyProxy
+
+    _expected_db_path = os.path.join(cache_dir, 'test.sqlite')
+    remove_file(_expected_db_path)
+
+    p = SQLAlchemyProxy(db='test', table='bla')
+    pragma = lambda k: p.session_auto.execute('PRAGMA %s' % k).scalar()
+    assert pragma('journal_mode') == 'wal'
+    assert pragma('synchronous') == 1  # NORMAL
+    assert pragma('temp_store') == 2  # MEMORY
+    assert pragma('busy_timeout') == 60000
+    assert p._lock_required is False
+    p.engine_dispose()
+
+    p = SQLAlchemyProxy(db='test', table='bla',
+                        sqlite_pragmas={'journal_mode': 'DELETE',
+                                        'mmap_size': None})
+    assert pragma('journal_mode') == 'delete'
+    assert pragma('mmap_size') == 0
+    assert p._lock_required is True
+    p.engine_dispose()
+
+    remove_file(_expected_db_path)
+
+
+def test_sqlite_pool():
+    from metrique.utils import remove_file
+    from metrique.sqlalchemy import SQLAlchemyProxy
+
+    _expected_db_path = os.path.join(cache_dir, 'test.sqlite')
+    remove_file(_expected_db_path)
+
+    p = SQLAlchemyProxy(db='test', table='bla', pool_size=2,
+                        pool_pre_ping=True)
+    assert p.session_auto is p.session_auto
+    assert p.engine.pool.size() == 2
+    assert p.inspector is p.inspector
+
+    assert p.ls() == []
+    p.autotable(schema={'col_1': {'type': int}}, create=True)
+    # catalog is refreshed on autotable and drop
+    assert p.ls() == ['bla']
+    assert p.exists('bla')
+    p.drop()
+    assert p.ls() == []
+    p.autotable(schema={'col_1': {'type': int}}, create=True)
+    assert p.count() == 0
+    # views are listed too, once
+    p.session_auto.execute('CREATE VIEW bla_view AS SELECT * FROM bla')
+    p.inspector_reset()
+    assert p.db_tables == ['bla', 'bla_view']
+    assert p.db_tables == ['bla', 'bla_view']
+    p.engine_dispose()
+
+    remove_file(_expected_db_path)
+
+
+def test_upsert_sqlite():
+    from metrique import metrique_object as O
+    from metrique.utils import remove_file
+    from metrique.sqlalchemy import SQLAlchemyProxy
+
+    _expected_db_path = os.path.join(cache_dir, 'test.sqlite')
+    remove_file(_expected_db_path)
+
+    p = SQLAlchemyProxy(db='test', table='bla')
+    schema = {'col_1': {'type': int}, 'col_2': {'type': unicode}}
+    p.autotable(schema=schema, create=True)
+
+    objs = [O(_oid=i, col_1=i, col_2='a', _start=1.5) for i in range(4)]
+    assert p.upsert(objs) == ['0', '1', '2', '3']
+    # changed objects are rotated out; unchanged aren't saved again
+    objs = [O(_oid=i, col_1=i * 10, col_2='a\'"', _start=2.25)
+            for i in (1, 2)]
+    objs += [O(_oid=3, col_1=3, col_2='a', _start=2.25),
+             O(_oid=4, col_1=4, col_2='a', _start=2.25)]
+    assert p.upsert(objs) == ['1', '1:1.5', '2', '2:1.5', '3', '4']
+    assert p.count() == 5
+    assert p.count(date='~') == 7
+    r = p.find('_oid == 1', date='~', sort='_start', raw=True)
+    assert [(o['_id'], o['_start'], o['_end']) for o in r] == \
+        [('1:1.5', 1.5, 2.25), ('1', 2.25, None)]
+    assert r[1]['col_2'] == 'a\'"'
+    assert p.find('_oid == 3', one=True)['_start'] == 1.5
+    # current versions are one per _oid
+    objs = [O(_oid=1, col_1=1, _start=3), O(_oid=1, col_1=2, _start=4)]
+    try:
+        p.upsert(objs, autosnap=True)
+    except ValueError:
+        pass
+    else:
+        assert False, 'expected ValueError'
+    assert p.count(date='~') == 7
+
+    remove_file(_expected_db_path)
+
+
+def test_key_table():
+    from metrique import metrique_object as O
+    from metrique.utils import remove_file
+    from metrique.sqlalchemy import SQLAlchemyProxy
+
+    _expected_db_path = os.path.join(cache_dir, 'test.sqlite')
+    remove_file(_expected_db_path)
+
+    p = SQLAlchemyProxy(db='test', table='bla')
+    schema = {'col_1': {'type': int},
+              'children': {'type': int, 'container': True}}
+    p.autotable(schema=schema, create=True)
+
+    # more _oids than sqlite's limit of bound parameters
+    k = 1200
+    objs = [O(_oid=i, col_1=i, children=[i + k / 2] if i < k / 2 else [],
+              _start=1.5, _end=2.5) for i in range(k)]
+    assert len(p.upsert(objs, autosnap=False)) == k
+    # history import replaces all existing versions
+    assert len(p.upsert(objs, autosnap=False)) == k
+    assert p.count(date='~') == k
+
+    objs = [O(_oid=i, col_1=i, _start=2.5) for i in range(k)]
+    assert len(p.upsert(objs, autosnap=True)) == k
+    assert p.count(date='~') == k * 2
+    assert len(p.versions(range(k), fields='_id')) == k * 2
+
+    oids = p.deptree('children', range(k / 2), date='~')
+    assert sorted(map(int, oids)) == range(k)
+    oids = p.deptree('children', range(k / 2))
+    assert sorted(map(int, oids)) == range(k / 2)
+
+    # key tables are dropped on exit, even after a failure; inside a
+    # transaction, not until the next key table is created, as the
+    # DROP would commit the transaction
+    temp = 'SELECT count(*) FROM sqlite_temp_master WHERE type = "table"'
+    conn = p.engine.connect()
+    try:
+        with p._keys(conn, p.get_table().c._oid, range(k)):
+            raise RuntimeError
+    except RuntimeError:
+        pass
+    assert conn.execute(temp).scalar() == 0
+    trans = conn.begin()
+    try:
+        with p._keys(conn, p.get_table().c._oid, range(k)):
+            conn.execute(p.get_table().delete())
+            raise RuntimeError
+    except RuntimeError:
+        trans.rollback()
+    assert conn.execute(temp).scalar() == 1
+    assert p.count(date='~') == k * 2
+    with p._keys(conn, p.get_table().c._oid, range(k)) as keys:
+        assert len(conn.execute(keys).fetchall()) == k
+    assert conn.execute(temp).scalar() == 0
+    conn.close()
+
+    # without temp tables, _oids are upserted in batches of IN lists
+    p._temp_tables = False
+    p.config['batch_size'] = 500
+    objs = [O(_oid=i, col_1=i, _start=1.5, _end=2.5) for i in range(k)]
+    assert len(p.upsert(objs, autosnap=False)) == k
+    assert p.count(date='~') == k
+
+    remove_file(_expected_db_path)
+
+
 # test container type!
 #schema.update({'col_2': {'type': unicode, 'container': True}})
 
@@ -279,3 +591,41 @@ def test_postgresql():
         assert False
 
     assert p.ls() == []
+
+
+def test_postgresql_bulk_copy():
+    from sqlalchemy.exc import OperationalError
+    from metrique import metrique_object as O
+    from metrique.sqlalchemy import SQLAlchemyProxy
+    from metrique.utils import configure
+
+    config = configure(config_file=default_config, section_key='proxy',
+                       section_only=True)
+    config['db'] = 'test'
+    config['table'] = 'bla_copy'
+    config['dialect'] = 'postgresql'
+    config['bulk_copy'] = True
+    p = SQLAlchemyProxy(**config)
+    try:
+        p.initialize()
+        p.engine.connect().close()
+    except (ImportError, OperationalError):
+        return   # skip this test if postgresql isn't available
+    assert p._bulk_copy is True
+
+    db_tester(p)
+
+    schema = {'col_1': {'type': int},
+              'tags': {'type': unicode, 'container': True}}
+    p.autotable(schema=schema, create=True)
+    objs = [O(_oid=1, col_1=1, tags=[u'a', u'b "c"\t'], _start=1.5),
+            O(_oid=2, col_1=None, tags=None, _start=1.5)]
+    assert p.upsert(objs, autosnap=True) == ['1', '2']
+    # new version of 1 rotates out the current one; 2 is unchanged
+    objs = [O(_oid=1, col_1=2, tags=[], _start=2.5),
+            O(_oid=2, col_1=None, tags=None, _start=2.5)]
+    assert p.upsert(objs, autosnap=True) == ['1', '1:1.5', '2']
+    assert p.count(date='~') == 3
+    rows = p.find('_oid == 1', fields='tags', date='~', raw=True)
+    assert sorted(r['tags'] for r in rows) == [[], [u'a', u'b "c"\t']]
+    p.drop()
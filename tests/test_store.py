@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+# Author: "Chris Ward" <cward@redhat.com>
+
+from __future__ import unicode_literals, absolute_import
+
+import os
+
+from .utils import set_env
+from metrique.utils import debug_setup
+
+logger = debug_setup('metrique', level=10, log2stdout=True, log2file=False)
+
+env = set_env()
+exists = os.path.exists
+
+cache_dir = env['METRIQUE_CACHE']
+
+
+def test_sqlite_store():
+    from metrique.store import SQLiteStore
+
+    s = SQLiteStore(cache_dir=cache_dir, hot_size=4, spill_size=2)
+    for i in range(10):
+        s['%s' % i] = {'_id': '%s' % i, 'i': i}
+    assert len(s) == 10
+    assert len(s._hot) <= 4
+    assert exists(s.path)
+
+    assert sorted(s) == sorted('%s' % i for i in range(10))
+    assert '0' in s
+    assert '10' not in s
+    # spilled objects are loaded back in (and others spilled) on get
+    assert s['0'] == {'_id': '0', 'i': 0}
+    assert '0' in s._hot
+    assert sorted(v['i'] for v in s.itervalues()) == range(10)
+    assert s == {'%s' % i: {'_id': '%s' % i, 'i': i} for i in range(10)}
+
+    # replacing a spilled object doesn't leave the old one behind
+    s['1'] = {'_id': '1', 'i': 42}
+    assert s['1']['i'] == 42
+    assert len(s) == 10
+    assert s.pop('2')['i'] == 2
+    del s['3']
+    assert len(s) == 8
+    try:
+        s['3']
+    except KeyError:
+        pass
+    else:
+        assert False
+
+    # values are streamed in _oid order, hot and spilled merged
+    s.clear()
+    for i in range(10):
+        s['%s' % i] = {'_id': '%s' % i, '_oid': (i * 7) % 10}
+    assert s._spilled
+    assert [v['_oid'] for v in s.itervalues_by_oid()] == range(10)
+
+    s.clear()
+    assert len(s) == 0
+    path = s.path
+    s.close()
+    assert not exists(path)
+
+
+def test_get_store():
+    from metrique.store import get_store, SQLiteStore
+
+    assert get_store() == {}
+    assert isinstance(get_store('sqlite', cache_dir=cache_dir), SQLiteStore)
+    assert get_store(dict) == {}
+    try:
+        get_store('bla')
+    except ValueError:
+        pass
+    else:
+        assert False
+
+
+def test_record_view():
+    import cPickle
+    from metrique.store import KeyTable, RecordView
+
+    from collections import Mapping
+
+    t = KeyTable(['a', 'b'])
+    r = t.record({'a': 1, 'c': None})
+    assert isinstance(r, RecordView)
+    assert isinstance(r, Mapping)
+    # __slots__ only; no per record __dict__
+    assert not hasattr(r, '__dict__')
+    # new keys are appended to the shared key table
+    assert t.keys == ['a', 'b', 'c']
+    assert r == {'a': 1, 'c': None}
+    assert len(r) == 2
+    assert 'b' not in r
+    assert r['c'] is None
+    assert r.get('b', 42) == 42
+    # records built before a key was added don't have it
+    r2 = t.record({'d': 1})
+    assert 'd' not in r
+    assert r2 == {'d': 1}
+    try:
+        r['a'] = 2
+    except TypeError:
+        pass
+    else:
+        assert False
+    assert cPickle.loads(cPickle.dumps(r, 2)) == {'a': 1, 'c': None}
+
+
+def test_sorted_keys():
+    from metrique.store import SortedKeys
+
+    k = SortedKeys(['b', 'a'])
+    assert list(k) == ['a', 'b']
+    k.add('d')
+    k.add('c')
+    assert len(k) == 4
+    it = iter(k)
+    k.remove('a')
+    k.add('e')
+    k.remove('e')
+    # removed, then re-added before a merge
+    k.remove('b')
+    k.add('b')
+    # iterators aren't affected by later updates
+    assert list(it) == ['a', 'b', 'c', 'd']
+    assert len(k) == 3
+    assert list(k) == ['b', 'c', 'd']
+    assert k[1:] == ['c', 'd']
+    assert k[-1] == 'd'
+    assert k.range('c') == ['c', 'd']
+    assert k.range('a', 'c') == ['b']
+    k.clear()
+    assert list(k) == []
+
+
+def test_intern_pool():
+    from metrique.store import InternPool
+
+    disabled = []
+    pool = InternPool(max_size=2, on_disable=lambda: disabled.append(1))
+    a = pool(''.join(['a', 'b']))
+    assert pool(''.join(['a', 'b'])) is a
+    assert pool(None) is None
+    assert len(pool) == 1
+    # equal values of other types aren't merged
+    u = pool(u'ab')
+    assert type(u) is unicode and type(pool(b'ab')) is str
+    assert pool(u'ab') is u
+    pool = InternPool(max_size=2, on_disable=lambda: disabled.append(1))
+    a = pool(''.join(['a', 'b']))
+    pool('c')
+    assert pool.enabled and not disabled
+    # more than max_size values; pool is disabled
+    pool('d')
+    assert not pool.enabled and disabled == [1]
+    assert len(pool) == 0
+    b = ''.join(['a', 'b'])
+    assert pool(b) is b
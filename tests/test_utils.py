@@ -28,6 +28,41 @@ tmp_dir = env['METRIQUE_TMP']
 log_dir = env['METRIQUE_LOGS']
 
 
+def test_autoschema():
+    from datetime import date, datetime
+    from metrique.utils import autoschema, widen_type, sample_objects
+
+    NoneType = type(None)
+    assert widen_type(None, int) is int
+    assert widen_type(int, NoneType) is int
+    assert widen_type(bool, int) is int
+    assert widen_type(float, long) is float
+    assert widen_type(date, datetime) is datetime
+    assert widen_type(int, unicode) is unicode
+    assert widen_type(str, unicode) is unicode
+    assert widen_type(dict, int) is unicode
+
+    objs = [{'_oid': 1, 'a': None, 'b': 1, 'c': [], 'd': None, 'e': 'x'},
+            {'_oid': 2, 'a': 1, 'b': 1.5, 'c': [1, None], 'e': 1},
+            {'_oid': 3, 'a': 2, 'b': None, 'c': (2.5,), 'd': None}]
+    schema = {'a': {'type': int},
+              'b': {'type': float},
+              'c': {'type': float, 'container': True},
+              'd': {'type': NoneType},
+              'e': {'type': unicode}}
+    assert dict(autoschema(objs, exclude_keys=['_oid'])) == schema
+    assert dict(autoschema(objs, exclude_keys=['_oid'], workers=2)) == schema
+    assert autoschema(objs, fast=True)['a'] == {'type': NoneType}
+    assert autoschema(objs[0])['_oid'] == {'type': int}
+
+    objs = range(10)
+    sample = sample_objects(objs, 3)
+    assert len(sample) == 6
+    assert sample[:3] == [0, 1, 2]
+    assert len(set(sample)) == 6
+    assert sample_objects(objs, 20) == objs
+
+
 def test_backup():
     from metrique.utils import backup, rand_chars, remove_file
     f1 = os.path.join(cache_dir, '%s' % rand_chars(prefix='backup'))
@@ -677,6 +712,45 @@ def test_jsonhash():
     assert jsonhash(dct, exclude=['product']) == EX
 
 
+def test_jsonhasher():
+    from datetime import datetime
+    from hashlib import sha1
+    from metrique.utils import jsonhash, jsonhasher
+    from metrique.utils import HAS_BLAKE2
+
+    objs = [{},
+            {'a': []},
+            {'a': [1], 'b': [[1, 2], {'c': (1, {'d': 2})}]},
+            {'a': 1.1, 'b': None, 'c': True, 'd': 10L, 'e': datetime.now()},
+            {u'\u2603': u'\u2603', 'x': 'x', 1: {'y': [{}]}}]
+
+    # compat hashes are the same as the legacy (sorted tuples) hashes
+    legacy = lambda o: sha1(repr(o)).hexdigest()
+    for o in objs:
+        assert jsonhash(o) == jsonhash(o, hash_func=legacy)
+        assert jsonhash(o) == jsonhasher()(o)
+
+    hasher = jsonhasher(exclude=['b'])
+    assert hasher(objs[2]) == jsonhash(objs[2], exclude=['b'])
+
+    # canonical json hashes are consistent, but different from compat
+    hasher = jsonhasher(compat=False)
+    o = {'a': [1, 2], 'b': {'c': None}}
+    assert hasher(o) == hasher({'b': {'c': None}, 'a': [1, 2]})
+    assert hasher(o) != jsonhash(o)
+    assert jsonhash(o, compat=False) == hasher(o)
+
+    assert len(jsonhash(o, digest='md5')) == 32
+    if HAS_BLAKE2:
+        assert len(jsonhash(o, digest='blake2b')) == 40
+    try:
+        jsonhasher(digest='bla')
+    except ValueError:
+        pass
+    else:
+        assert False
+
+
 def test_list2str():
     from metrique.utils import list2str
     l = [1, 1.1, '1', None, 0]